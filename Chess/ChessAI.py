@@ -1,6 +1,10 @@
 from glob import glob
+import heapq
+import json
+import os
 import random
 from sys import maxsize
+import time
 
 
 pieceScore = {
@@ -16,6 +20,144 @@ CHECKMATE = 1000
 STALEMATE = 0
 DEPTH = 4
 
+# Pawn structure terms, in the same units as pieceScore
+DOUBLED_PAWN_PENALTY = 0.2
+ISOLATED_PAWN_PENALTY = 0.15
+# Bonus for a passed pawn by how many rows it has advanced from its starting row (0 to 5, one more is promotion)
+PASSED_PAWN_BONUS = [0, 0.05, 0.1, 0.2, 0.35, 0.6]
+
+PAWN_HASH_SIZE = 16384  # Number of entries in the pawn hash table
+
+# Transposition table bound flags
+EXACT = 0
+LOWERBOUND = 1  # Search failed high, real score is at least the stored score
+UPPERBOUND = 2  # Search failed low, real score is at most the stored score
+
+depthTimes = []  # (depth, seconds, nodes) of every iteration of the last Multi-PV search
+counter = 0  # Nodes searched by the last search
+
+TT_MAX_ENTRIES = 500000  # About 100 MB
+
+# Stopping findBestMovesMultiPV in the middle of an iteration: every STOP_CHECK_NODES nodes the search checks
+# stopTime (a time.perf_counter time, set from its timeLimit) and stopFlag (a function returning True when
+# the search should stop, set by ChessSharedTT in its workers)
+STOP_CHECK_NODES = 100
+stopTime = None
+stopFlag = None
+nextStopCheck = STOP_CHECK_NODES
+
+# Principal variation of the last findBestMoveNegaMaxAlphaBeta search as (zobristKey, moveID) of every
+# position on it, so the next search can pick it up where the game went
+lastPrincipalVariation = []
+
+# Captures losing material by static exchange evaluation are not searched this close to the leaves
+SEE_PRUNE_DEPTH = 1
+
+# Evaluation weights written by ChessTune, loaded at startup if the file exists
+WEIGHTS_FILE = os.environ.get("CHESS_WEIGHTS", os.path.join(os.path.dirname(os.path.abspath(__file__)), "weights.json"))
+
+
+class SearchStopped(Exception):
+    # Raised inside the search when stopTime has passed or stopFlag is set
+    pass
+
+
+class TranspositionTable():
+    """
+    GameState.zobristKey -> (depth, score, flag, bestMoveID) in a dict.
+    Kept between the searches of a game: every new search is one age older,
+    and when the table is full it drops to half, old and shallow entries first.
+    ChessSharedTT has the same methods.
+    """
+
+    def __init__(self, maxEntries=TT_MAX_ENTRIES):
+        self.entries = {}  # zobristKey -> (depth, score, flag, bestMoveID, age)
+        self.maxEntries = maxEntries
+        self.age = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        return entry[:4] if entry is not None else None
+
+    def store(self, key, depth, score, flag, moveID):
+        if len(self.entries) >= self.maxEntries and key not in self.entries:
+            self.dropOldEntries()
+        self.entries[key] = (depth, score, flag, moveID, self.age)
+
+    def dropOldEntries(self):
+        # Down to half the table, so this is done once every maxEntries / 2 new entries. The entries of the
+        # newest searches are kept, and of those the deepest, which cost the most to search again
+        kept = heapq.nlargest(self.maxEntries // 2, self.entries.items(), key=lambda item: (item[1][4], item[1][0]))
+        self.entries = dict(kept)
+
+    def newSearch(self):
+        self.age += 1
+
+    def clear(self):
+        # For a new game
+        self.entries.clear()
+        self.age = 0
+
+
+transpositionTable = TranspositionTable()
+
+
+class PawnHashTable():
+    """
+    Fixed size cache of pawn structure evaluations keyed by GameState.pawnKey.
+    Each key maps to a single slot and a new entry always replaces the old one.
+    """
+
+    def __init__(self, size=PAWN_HASH_SIZE):
+        self.size = size
+        self.entries = [None] * size
+        self.hits = 0
+        self.misses = 0
+
+    def probe(self, key):
+        """
+        Returns the stored (score, whitePassed, blackPassed) for key or None
+        """
+        entry = self.entries[key % self.size]
+        if entry is not None and entry[0] == key:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return None
+
+    def store(self, key, value):
+        self.entries[key % self.size] = (key, value)
+
+    def clear(self):
+        self.entries = [None] * self.size
+        self.hits = 0
+        self.misses = 0
+
+
+pawnHashTable = PawnHashTable()
+
+
+def loadWeights(path=WEIGHTS_FILE):
+    """
+    Use the evaluation weights of a file written by ChessTune.
+    Returns False if there is no such file
+    """
+    global DOUBLED_PAWN_PENALTY, ISOLATED_PAWN_PENALTY
+    if not os.path.exists(path):
+        return False
+    with open(path) as f:
+        weights = json.load(f)
+    pieceScore.update(weights["pieceScore"])
+    DOUBLED_PAWN_PENALTY = weights["doubledPawnPenalty"]
+    ISOLATED_PAWN_PENALTY = weights["isolatedPawnPenalty"]
+    # Older files have two more entries, for rows a pawn can't be on
+    PASSED_PAWN_BONUS[:] = weights["passedPawnBonus"][:len(PASSED_PAWN_BONUS)]
+    pawnHashTable.clear()  # Scores cached with the old weights
+    return True
+
+
+loadWeights()
+
 
 def findRandomMove(validMoves):
     """
@@ -129,18 +271,81 @@ def scoreBoard(gs):
     elif gs.stalemate:
         return STALEMATE
 
-    board = gs.board
+    if gs.accumulator is not None:  # Neural network evaluation, see ChessNNUE
+        return gs.accumulator.evaluate(gs.whiteToMove)
+
     score = 0
-    for row in board:
-        for square in row:
-            if square[0] == "w":
-                score += pieceScore[square[1]]
-            elif square[0] == "b":
-                score -= pieceScore[square[1]]
+    for piece, squares in gs.pieceLocations.items():
+        if piece[0] == "w":
+            score += pieceScore[piece[1]] * len(squares)
+        else:
+            score -= pieceScore[piece[1]] * len(squares)
+
+    score += scorePawnStructure(gs)[0]
 
     return score
 
 
+def scorePawnStructure(gs):
+    """
+    Doubled, isolated and passed pawns. Positive good for white.
+    Returns (score, whitePassed, blackPassed) where the passed pawn masks have
+    bit row * 8 + col set for every passed pawn. Cached by the pawn key.
+    """
+    entry = pawnHashTable.probe(gs.pawnKey)
+    if entry is None:
+        entry = evaluatePawns(gs)
+        pawnHashTable.store(gs.pawnKey, entry)
+    return entry
+
+
+def evaluatePawns(gs):
+    """
+    Pawn structure evaluation from scratch
+    """
+    doubled, isolated, passed, whitePassed, blackPassed = countPawnTerms(gs)
+    score = -DOUBLED_PAWN_PENALTY * doubled - ISOLATED_PAWN_PENALTY * isolated
+    score += sum(bonus * count for bonus, count in zip(PASSED_PAWN_BONUS, passed))
+    return score, whitePassed, blackPassed
+
+
+def countPawnTerms(gs):
+    """
+    Pawn structure terms, white minus black: (doubled pawns, isolated pawns,
+    passed pawns per PASSED_PAWN_BONUS index, whitePassed, blackPassed) with
+    the passed pawn masks as in scorePawnStructure. evaluatePawns weights
+    them, ChessTune uses them as features.
+    """
+    pawns = {"w": sorted(gs.pieceLocations["wp"]), "b": sorted(gs.pieceLocations["bp"])}
+    files = {"w": [0] * 8, "b": [0] * 8}
+    for color in ("w", "b"):
+        for r, c in pawns[color]:
+            files[color][c] += 1
+
+    doubled = isolated = 0
+    passed = [0] * len(PASSED_PAWN_BONUS)
+    passedMasks = {"w": 0, "b": 0}
+    for color, sign in (("w", 1), ("b", -1)):
+        enemy = "b" if color == "w" else "w"
+        for count in files[color]:
+            if count > 1:
+                doubled += sign * (count - 1)
+        for r, c in pawns[color]:
+            if (c == 0 or files[color][c - 1] == 0) and (c == 7 or files[color][c + 1] == 0):
+                isolated += sign
+            # Passed if no enemy pawn in front of it on its own or adjacent files
+            isPassed = True
+            for er, ec in pawns[enemy]:
+                if abs(ec - c) <= 1 and (er < r if color == "w" else er > r):
+                    isPassed = False
+                    break
+            if isPassed:
+                passedMasks[color] |= 1 << (r * 8 + c)
+                passed[6 - r if color == "w" else r - 1] += sign
+
+    return doubled, isolated, passed, passedMasks["w"], passedMasks["b"]
+
+
 def findBestMoveNegaMax(gs, validMoves):
     global nextMove, counter
     counter = 0
@@ -175,19 +380,65 @@ def findMoveNegaMax(gs, validMoves, depth, turnMultiplier):
 
 
 def findBestMoveNegaMaxAlphaBeta(gs, validMoves):
-    global nextMove, counter
+    """
+    Iterative deepening alpha beta with the transposition table. The table
+    and the principal variation are kept for the next move of the game
+    (call newGame to start over), so when the game follows the principal
+    variation its next move is searched first and the first iterations are
+    answered from the table.
+    """
+    global nextMove, counter, lastPrincipalVariation
     nextMove = None
     counter = 0
-    findMoveNegaMaxAlphaBeta(
-        gs, validMoves,
-        DEPTH,
-        -CHECKMATE, CHECKMATE,
-        1 if gs.whiteToMove else -1
-    )
+    if len(validMoves) == 0:
+        return None
+    transpositionTable.newSearch()
+    turnMultiplier = 1 if gs.whiteToMove else -1
+
+    # Re-root: the move the last principal variation expects from this position goes first
+    rootMoves = list(validMoves)
+    random.shuffle(rootMoves)
+    expectedMoveID = dict(lastPrincipalVariation).get(gs.zobristKey)
+    rootMoves.sort(key=lambda move: move.moveID != expectedMoveID)
+
+    for depth in range(1, DEPTH + 1):
+        alpha = -CHECKMATE - 1
+        for move in rootMoves:
+            gs.makeMove(move)
+            nextMoves = gs.getValidMoves()
+            score = -findMoveNegaMaxTT(
+                gs, nextMoves,
+                depth - 1,
+                -CHECKMATE - 1, -alpha,
+                -turnMultiplier
+            )
+            gs.undoMove()
+            if score > alpha:
+                alpha = score
+                nextMove = move
+        # Next iteration searches the best move first, the others in the order they were in
+        rootMoves.sort(key=lambda move: move != nextMove)
+    transpositionTable.store(gs.zobristKey, DEPTH, alpha, EXACT, nextMove.moveID)
+
+    lastPrincipalVariation = []
+    for move in getPrincipalVariation(gs, nextMove, 2 * DEPTH):
+        lastPrincipalVariation.append((gs.zobristKey, move.moveID))
+        gs.makeMove(move)
+    for i in range(len(lastPrincipalVariation)):
+        gs.undoMove()
     print(counter)
     return nextMove
 
 
+def newGame():
+    """
+    Forget the transposition table and principal variation of the last game
+    """
+    global lastPrincipalVariation
+    transpositionTable.clear()
+    lastPrincipalVariation = []
+
+
 def findMoveNegaMaxAlphaBeta(gs, validMoves, depth, alpha, beta, turnMultiplier):
     global nextMove, counter
     counter += 1
@@ -216,3 +467,229 @@ def findMoveNegaMaxAlphaBeta(gs, validMoves, depth, alpha, beta, turnMultiplier)
         if alpha >= beta:
             break
     return maxScore
+
+
+def findBestMovesMultiPV(gs, validMoves, numPV=3, depth=DEPTH, timeLimit=None):
+    """
+    Multi-PV search. Returns the numPV best moves as a list of
+    (move, score, pv) best first, score from the side to move's view and
+    pv the list of moves starting with move.
+    Uses iterative deepening: every iteration searches the root moves in the
+    order of the previous one and the transposition table is shared by all
+    of them. A root move only gets an exact score when it beats the current
+    numPV-th best, the others are cut off by the window.
+    With a timeLimit (seconds) the search stops once it has passed, also in
+    the middle of an iteration, and returns the result of the last finished
+    one. The first iteration always finishes. The same happens when
+    stopFlag returns True, except that the first iteration is stopped too
+    and the result is then empty.
+    (depth, seconds, nodes) of every finished iteration is left in depthTimes.
+    The transposition table of earlier searches is used too, call newGame
+    first for a search that doesn't depend on them.
+    """
+    global counter, depthTimes, stopTime, nextStopCheck
+    counter = 0
+    nextStopCheck = STOP_CHECK_NODES
+    depthTimes = []
+    transpositionTable.newSearch()
+    startTime = time.perf_counter()
+    turnMultiplier = 1 if gs.whiteToMove else -1
+    rootMoves = list(validMoves)
+    numPV = min(numPV, len(rootMoves))
+    results = []
+    rootPly = len(gs.moveLog)
+
+    try:
+        for currentDepth in range(1, depth + 1):
+            if timeLimit is not None and currentDepth > 1:
+                stopTime = startTime + timeLimit
+                if time.perf_counter() >= stopTime:
+                    break
+            scores = {}
+            best = []  # Exact scores of the best numPV moves so far, highest first
+            for move in rootMoves:
+                alpha = best[numPV - 1] if len(best) >= numPV else -CHECKMATE - 1
+                gs.makeMove(move)
+                nextMoves = gs.getValidMoves()
+                score = -findMoveNegaMaxTT(
+                    gs, nextMoves,
+                    currentDepth - 1,
+                    -CHECKMATE - 1, -alpha,
+                    -turnMultiplier
+                )
+                gs.undoMove()
+                scores[move.moveID] = score
+                if score > alpha:
+                    best.append(score)
+                    best.sort(reverse=True)
+
+            # Next iteration searches the best moves first
+            rootMoves.sort(key=lambda move: scores[move.moveID], reverse=True)
+            results = [(move, scores[move.moveID]) for move in rootMoves[:numPV]]
+            depthTimes.append((currentDepth, time.perf_counter() - startTime, counter))
+    except SearchStopped:
+        # The unfinished iteration left its moves on the board
+        while len(gs.moveLog) > rootPly:
+            gs.undoMove()
+    finally:
+        stopTime = None
+
+    return [(move, score, getPrincipalVariation(gs, move, depth)) for move, score in results]
+
+
+def findMoveNegaMaxTT(gs, validMoves, depth, alpha, beta, turnMultiplier):
+    """
+    Alpha beta with a transposition table, used by findBestMoveNegaMaxAlphaBeta
+    and the Multi-PV search
+    """
+    global counter
+    if len(validMoves) == 0:
+        counter += 1
+        return turnMultiplier * scoreBoard(gs)
+
+    alphaOrig = alpha
+    inCheck = gs.inCheck
+    entryMove = None
+    entry = transpositionTable.get(gs.zobristKey)
+    if entry is not None:
+        entryDepth, entryScore, entryFlag, entryMove = entry
+        if entryDepth >= depth:
+            if entryFlag == EXACT:
+                return entryScore
+            elif entryFlag == LOWERBOUND and entryScore > alpha:
+                alpha = entryScore
+            elif entryFlag == UPPERBOUND and entryScore < beta:
+                beta = entryScore
+            if alpha >= beta:
+                return entryScore
+
+    # Leaves are stored too, so the next search of the game finds the leaves of this one
+    if depth == 0:
+        score = quiescence(gs, validMoves, alpha, beta, turnMultiplier)
+        storeScore(gs.zobristKey, 0, score, alphaOrig, beta, entryMove)
+        return score
+    counter += 1
+    if counter >= nextStopCheck:
+        checkStop()
+
+    maxScore = -CHECKMATE - 1
+    bestMove = None
+    for move, see in orderMoves(gs, validMoves, entryMove):
+        # Losing captures near the leaves are very unlikely to be best
+        if see < 0 and depth <= SEE_PRUNE_DEPTH and not inCheck and bestMove is not None:
+            continue
+        gs.makeMove(move)
+        nextMoves = gs.getValidMoves()
+        score = -findMoveNegaMaxTT(
+            gs, nextMoves,
+            depth - 1,
+            -beta, -alpha,
+            -turnMultiplier
+        )
+        gs.undoMove()
+        if score > maxScore:
+            maxScore = score
+            bestMove = move
+        if maxScore > alpha:
+            alpha = maxScore
+        if alpha >= beta:
+            break
+
+    storeScore(gs.zobristKey, depth, maxScore, alphaOrig, beta, bestMove.moveID)
+    return maxScore
+
+
+def checkStop():
+    # Raise SearchStopped if the search has to stop, see STOP_CHECK_NODES
+    global nextStopCheck
+    nextStopCheck = counter + STOP_CHECK_NODES
+    if (stopTime is not None and time.perf_counter() >= stopTime) or (stopFlag is not None and stopFlag()):
+        raise SearchStopped()
+
+
+def storeScore(key, depth, score, alpha, beta, moveID):
+    # Store a score searched with the window (alpha, beta) with its bound flag
+    if score <= alpha:
+        flag = UPPERBOUND
+    elif score >= beta:
+        flag = LOWERBOUND
+    else:
+        flag = EXACT
+    transpositionTable.store(key, depth, score, flag, moveID)
+
+
+def quiescence(gs, validMoves, alpha, beta, turnMultiplier):
+    """
+    Searches captures only, until the position is quiet. The side to move can
+    always stand pat with the static score. Captures that lose material by
+    static exchange evaluation are skipped.
+    """
+    global counter
+    counter += 1
+    if counter >= nextStopCheck:
+        checkStop()
+
+    standPat = turnMultiplier * scoreBoard(gs)
+    if len(validMoves) == 0 or standPat >= beta:
+        return standPat
+    if standPat > alpha:
+        alpha = standPat
+
+    for move, see in orderMoves(gs, validMoves, None):
+        if move.pieceCaptured == "--" or see < 0:
+            continue
+        gs.makeMove(move)
+        nextMoves = gs.getValidMoves()
+        score = -quiescence(gs, nextMoves, -beta, -alpha, -turnMultiplier)
+        gs.undoMove()
+        if score > alpha:
+            alpha = score
+            if alpha >= beta:
+                break
+    return alpha
+
+
+def orderMoves(gs, validMoves, firstMoveID):
+    """
+    Returns [(move, see)]: the move with firstMoveID, then winning and equal captures by
+    static exchange evaluation, then quiet moves, then losing captures
+    """
+    ordered = []
+    for move in validMoves:
+        see = gs.staticExchangeEvaluation(move)
+        if move.moveID == firstMoveID:
+            order = (0, 0)
+        elif move.pieceCaptured == "--":
+            order = (2, 0)
+        elif see >= 0:
+            order = (1, -see)
+        else:
+            order = (3, -see)
+        ordered.append((order, move, see))
+    ordered.sort(key=lambda entry: entry[0])
+    return [(move, see) for order, move, see in ordered]
+
+
+def getPrincipalVariation(gs, firstMove, maxLength):
+    """
+    Follow the best moves stored in the transposition table from firstMove
+    """
+    pv = [firstMove]
+    gs.makeMove(firstMove)
+    while len(pv) < maxLength:
+        entry = transpositionTable.get(gs.zobristKey)
+        if entry is None or entry[3] is None:
+            break
+        # Make sure the stored move is legal here (keys can collide)
+        nextMove = None
+        for move in gs.getValidMoves():
+            if move.moveID == entry[3]:
+                nextMove = move
+                break
+        if nextMove is None:
+            break
+        pv.append(nextMove)
+        gs.makeMove(nextMove)
+    for i in range(len(pv)):
+        gs.undoMove()
+    return pv
@@ -0,0 +1,365 @@
+"""
+Legal move generation for many positions at once with NumPy.
+GameState.getValidMoves works on one position per call, which is what a
+game needs. For bulk work (perft, building datasets) most of that time is
+interpreter overhead, so here N positions are stacked into arrays
+(PositionBatch) and every step runs as a few NumPy operations over all of
+them:
+    - the pieces of every position become 64-bit bitboards
+    - the attacks of every piece of the side to move, sliding pieces with
+      Kogge-Stone fills, give the pseudo-legal moves of all positions
+    - every move is made on the bitboards and kept if the own king isn't
+      attacked afterwards
+The result is flat arrays of from square, to square and flags with the
+moves of position i at offsets[i]:offsets[i + 1], in the same rules as
+getValidMoves (pawns promote to queens only).
+    python ChessBatch.py "FEN" --perft 3
+    python ChessBatch.py --bench 2000
+"""
+import argparse
+import random
+import time
+import numpy as np
+import ChessEngine
+from ChessEngine import EMPTY, PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING, WHITE, BLACK, TYPE_MASK
+
+
+# Square s = row * 8 + col (row 0 is black's back rank, like GameState.board) is bit s of a bitboard
+ONE = np.uint64(1)
+ZERO = np.uint64(0)
+FULL = np.uint64(0xFFFFFFFFFFFFFFFF)
+NOT_COL0 = np.uint64(0xFEFEFEFEFEFEFEFE)
+NOT_COL7 = np.uint64(0x7F7F7F7F7F7F7F7F)
+ROW2 = np.uint64(0xFF << 16)
+ROW5 = np.uint64(0xFF << 40)
+
+# Move flags
+CAPTURE = 1
+EN_PASSANT = 2
+CASTLE = 4
+PROMOTION = 8
+
+# Sliding directions as (shift, mask of the squares a one step shift may land on)
+rookShifts = ((-8, FULL), (8, FULL), (1, NOT_COL0), (-1, NOT_COL7))
+bishopShifts = ((-7, NOT_COL0), (-9, NOT_COL7), (9, NOT_COL0), (7, NOT_COL7))
+
+CHUNK = 200000  # Positions per batch in perft
+
+
+def stepTable(steps):
+    # Bitboard of the squares one (dRow, dCol) step away from every square
+    table = np.zeros(64, np.uint64)
+    for square in range(64):
+        r, c = divmod(square, 8)
+        for dRow, dCol in steps:
+            if 0 <= r + dRow < 8 and 0 <= c + dCol < 8:
+                table[square] |= ONE << np.uint64((r + dRow) * 8 + c + dCol)
+    return table
+
+
+knightAttacks = stepTable([(dRow, dCol) for dRow, dCol, offset in ChessEngine.knightJumps])
+kingAttacks = stepTable([(dRow, dCol) for dRow, dCol, offset in ChessEngine.kingSteps])
+pawnAttacks = np.stack((stepTable([(-1, -1), (-1, 1)]), stepTable([(1, -1), (1, 1)])))  # [white, black][square]
+
+
+def shift(bitboards, amount):
+    return bitboards << np.uint64(amount) if amount > 0 else bitboards >> np.uint64(-amount)
+
+
+def slide(generators, empty, amount, mask):
+    """
+    Squares attacked along one direction from the set bits of generators,
+    up to and including the first occupied square (Kogge-Stone fill)
+    """
+    propagators = empty & mask
+    generators = generators | propagators & shift(generators, amount)
+    propagators = propagators & shift(propagators, amount)
+    generators = generators | propagators & shift(generators, 2 * amount)
+    propagators = propagators & shift(propagators, 2 * amount)
+    generators = generators | propagators & shift(generators, 4 * amount)
+    return shift(generators, amount) & mask
+
+
+def squareBits(squares):
+    return ONE << squares.astype(np.uint64)
+
+
+def unpackBits(bitboards):
+    # (len(bitboards), 64) array of the bits of every bitboard, column s is square s
+    return np.unpackbits(bitboards.astype("<u8").view(np.uint8).reshape(-1, 8), axis=1, bitorder="little")
+
+
+class PositionBatch():
+    """
+    N positions in arrays:
+        board        (N, 64) uint8 ChessEngine piece codes, square = row * 8 + col
+        whiteToMove  (N,) bool
+        castling     (N, 4) bool rights in CastleRights order: wks, bks, wqs, bqs
+        enpassant    (N,) int8 square a pawn can capture en passant onto, -1 if none
+    """
+
+    def __init__(self, board, whiteToMove, castling, enpassant):
+        self.board = board
+        self.whiteToMove = whiteToMove
+        self.castling = castling
+        self.enpassant = enpassant
+
+    def __len__(self):
+        return len(self.board)
+
+    def __getitem__(self, index):
+        # Positions index (a slice or an index array) as a new batch
+        return PositionBatch(self.board[index], self.whiteToMove[index], self.castling[index], self.enpassant[index])
+
+    @staticmethod
+    def fromBytes(data):
+        """
+        Batch of the positions in data, GameState.toBytes records one after another
+        """
+        records = np.frombuffer(data, np.uint8).reshape(-1, ChessEngine.POSITION_BYTES)
+        nibbles = np.stack((records[:, :32] >> 4, records[:, :32] & 15), axis=2).reshape(-1, 64)
+        board = np.where(nibbles & TYPE_MASK, np.where(nibbles & 8, BLACK, WHITE) | nibbles & TYPE_MASK, EMPTY)
+        flags = records[:, 32]
+        castling = (flags[:, None] >> np.arange(1, 5, dtype=np.uint8)) & 1 != 0
+        enpassant = np.where(records[:, 33] == 255, -1, records[:, 33]).astype(np.int8)
+        return PositionBatch(board.astype(np.uint8), flags & 1 != 0, castling, enpassant)
+
+    @staticmethod
+    def fromGameStates(states):
+        return PositionBatch.fromBytes(b"".join(gs.toBytes() for gs in states))
+
+    def toGameState(self, i):
+        board = [[ChessEngine.pieceNames[code] for code in self.board[i, r * 8:r * 8 + 8]] for r in range(8)]
+        castleRights = ChessEngine.CastleRights(*(bool(right) for right in self.castling[i]))
+        enpassantPossible = divmod(int(self.enpassant[i]), 8) if self.enpassant[i] >= 0 else ()
+        gs = ChessEngine.GameState.__new__(ChessEngine.GameState)
+        gs.setPosition(board, bool(self.whiteToMove[i]), castleRights, enpassantPossible)
+        return gs
+
+    def bitboards(self):
+        """
+        (ours, theirs): dicts piece type -> (N,) bitboards of the side to move and of the other side
+        """
+        pieces = {}
+        for color in (WHITE, BLACK):
+            for pieceType in (PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING):
+                packed = np.packbits(self.board == color | pieceType, axis=1, bitorder="little")
+                pieces[color | pieceType] = packed.view("<u8").reshape(-1).astype(np.uint64)
+        ours = {}
+        theirs = {}
+        for pieceType in (PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING):
+            ours[pieceType] = np.where(self.whiteToMove, pieces[WHITE | pieceType], pieces[BLACK | pieceType])
+            theirs[pieceType] = np.where(self.whiteToMove, pieces[BLACK | pieceType], pieces[WHITE | pieceType])
+        return ours, theirs
+
+
+def attacked(squares, occupied, enemy, whiteToMove):
+    """
+    True where squares[i] is attacked by the pieces enemy[type][i] with the
+    board occupied[i], whiteToMove[i] being the side the square belongs to
+    """
+    bits = squareBits(squares)
+    empty = ~occupied
+    attackers = knightAttacks[squares] & enemy[KNIGHT]
+    attackers |= kingAttacks[squares] & enemy[KING]
+    # Enemy pawns attack the square from where an own pawn on it would attack
+    attackers |= pawnAttacks[np.where(whiteToMove, 0, 1), squares] & enemy[PAWN]
+    rooksQueens = enemy[ROOK] | enemy[QUEEN]
+    bishopsQueens = enemy[BISHOP] | enemy[QUEEN]
+    for amount, mask in rookShifts:
+        attackers |= slide(bits, empty, amount, mask) & rooksQueens
+    for amount, mask in bishopShifts:
+        attackers |= slide(bits, empty, amount, mask) & bishopsQueens
+    return attackers != ZERO
+
+
+def generateMoves(batch):
+    """
+    Legal moves of every position of batch. Returns (fromSquares, toSquares,
+    flags, offsets): the moves of position i are at offsets[i]:offsets[i + 1]
+    """
+    n = len(batch)
+    whiteToMove = batch.whiteToMove
+    ours, theirs = batch.bitboards()
+    ourPieces = ours[PAWN] | ours[KNIGHT] | ours[BISHOP] | ours[ROOK] | ours[QUEEN] | ours[KING]
+    theirPieces = theirs[PAWN] | theirs[KNIGHT] | theirs[BISHOP] | theirs[ROOK] | theirs[QUEEN] | theirs[KING]
+    occupied = ourPieces | theirPieces
+    enpassantBits = np.where(batch.enpassant >= 0, squareBits(np.maximum(batch.enpassant, 0)), ZERO)
+
+    # Every piece of the side to move, position by position
+    ownColor = np.where(whiteToMove, WHITE, BLACK).astype(np.uint8)
+    positions, squares = np.nonzero(batch.board & ownColor[:, None])
+    types = batch.board[positions, squares] & TYPE_MASK
+    bits = squareBits(squares)
+    empty = ~occupied[positions]
+
+    targets = np.zeros(len(squares), np.uint64)
+    for pieceType, table in ((KNIGHT, knightAttacks), (KING, kingAttacks)):
+        selected = types == pieceType
+        targets[selected] = table[squares[selected]]
+    for pieceTypes, shifts in (((ROOK, QUEEN), rookShifts), ((BISHOP, QUEEN), bishopShifts)):
+        selected = np.isin(types, pieceTypes)
+        for amount, mask in shifts:
+            targets[selected] |= slide(bits[selected], empty[selected], amount, mask)
+    targets &= ~ourPieces[positions]
+
+    pawns = types == PAWN
+    white = whiteToMove[positions[pawns]]
+    pawnEmpty = empty[pawns]
+    singlePush = np.where(white, bits[pawns] >> np.uint64(8), bits[pawns] << np.uint64(8)) & pawnEmpty
+    doublePush = np.where(white, (singlePush & ROW5) >> np.uint64(8), (singlePush & ROW2) << np.uint64(8)) & pawnEmpty
+    captures = pawnAttacks[np.where(white, 0, 1), squares[pawns]] & (theirPieces | enpassantBits)[positions[pawns]]
+    targets[pawns] = singlePush | doublePush | captures
+
+    # One move per target bit
+    piece, toSquares = np.nonzero(unpackBits(targets))
+    movePositions = positions[piece]
+    fromSquares = squares[piece]
+    moveTypes = types[piece]
+    flags = np.where(batch.board[movePositions, toSquares] != EMPTY, CAPTURE, 0)
+    isPawn = moveTypes == PAWN
+    enpassant = isPawn & (toSquares == batch.enpassant[movePositions]) & (fromSquares % 8 != toSquares % 8)
+    flags |= np.where(enpassant, EN_PASSANT | CAPTURE, 0)
+    flags |= np.where(isPawn & ((toSquares < 8) | (toSquares >= 56)), PROMOTION, 0)
+
+    # Legal if the own king isn't attacked once the move is made
+    kingSquares = np.argmax(batch.board == (ownColor | KING)[:, None], axis=1)
+    moveWhite = whiteToMove[movePositions]
+    capturedSquares = np.where(enpassant, toSquares + np.where(moveWhite, 8, -8), toSquares)
+    captured = ~squareBits(capturedSquares)
+    after = occupied[movePositions] & ~squareBits(fromSquares) & captured | squareBits(toSquares)
+    enemy = {pieceType: theirs[pieceType][movePositions] & captured for pieceType in theirs}
+    king = np.where(moveTypes == KING, toSquares, kingSquares[movePositions])
+    legal = ~attacked(king, after, enemy, moveWhite)
+    movePositions, fromSquares, toSquares, flags = movePositions[legal], fromSquares[legal], toSquares[legal], flags[legal]
+
+    # Castling: not out of, through or into check, with the squares between king and rook empty
+    inCheck = attacked(kingSquares, occupied, theirs, whiteToMove)
+    castleMoves = []
+    for rights, direction, between, passing in (((0, 1), 1, (1, 2), (1, 2)), ((2, 3), -1, (1, 2, 3), (1, 2))):
+        possible = np.where(whiteToMove, batch.castling[:, rights[0]], batch.castling[:, rights[1]]) & ~inCheck
+        kingCols = kingSquares % 8
+        possible &= (kingCols + direction * max(between) >= 0) & (kingCols + direction * max(between) < 8)
+        for step in between:
+            possible &= (occupied & squareBits(np.clip(kingSquares + direction * step, 0, 63))) == ZERO
+        for step in passing:
+            possible &= ~attacked(np.clip(kingSquares + direction * step, 0, 63), occupied, theirs, whiteToMove)
+        castlePositions = np.nonzero(possible)[0]
+        castleMoves.append((castlePositions, kingSquares[castlePositions], kingSquares[castlePositions] + 2 * direction))
+
+    movePositions = np.concatenate([movePositions] + [positions for positions, start, end in castleMoves])
+    fromSquares = np.concatenate([fromSquares] + [start for positions, start, end in castleMoves])
+    toSquares = np.concatenate([toSquares] + [end for positions, start, end in castleMoves])
+    flags = np.concatenate([flags] + [np.full(len(positions), CASTLE) for positions, start, end in castleMoves])
+
+    order = np.argsort(movePositions, kind="stable")
+    offsets = np.zeros(n + 1, np.int64)
+    np.cumsum(np.bincount(movePositions, minlength=n), out=offsets[1:])
+    return (fromSquares[order].astype(np.int8), toSquares[order].astype(np.int8),
+            flags[order].astype(np.uint8), offsets)
+
+
+def applyMoves(batch, fromSquares, toSquares, flags, offsets):
+    """
+    Batch of the positions after every move of generateMoves(batch), in the same order
+    """
+    parents = np.repeat(np.arange(len(batch)), np.diff(offsets))
+    moves = np.arange(len(parents))
+    fromSquares = fromSquares.astype(np.int64)
+    toSquares = toSquares.astype(np.int64)
+    board = batch.board[parents]
+    pieces = board[moves, fromSquares]
+    capturedPieces = board[moves, toSquares]
+    white = batch.whiteToMove[parents]
+
+    board[moves, fromSquares] = EMPTY
+    board[moves, toSquares] = np.where(flags & PROMOTION, pieces & (WHITE | BLACK) | QUEEN, pieces)
+    enpassant = np.nonzero(flags & EN_PASSANT)[0]
+    board[enpassant, toSquares[enpassant] + np.where(white[enpassant], 8, -8)] = EMPTY
+    for castle, rookFrom, rookTo in ((toSquares > fromSquares, 1, -1), (toSquares < fromSquares, -2, 1)):
+        castles = np.nonzero((flags & CASTLE != 0) & castle)[0]
+        board[castles, toSquares[castles] + rookTo] = board[castles, toSquares[castles] + rookFrom]
+        board[castles, toSquares[castles] + rookFrom] = EMPTY
+
+    # Castle rights go with a king move, a rook leaving its corner or a rook captured on its corner
+    castling = batch.castling[parents]
+    castling[:, 0] &= (pieces != WHITE | KING) & ~((pieces == WHITE | ROOK) & (fromSquares == 63)) & \
+        ~((capturedPieces == WHITE | ROOK) & (toSquares == 63))
+    castling[:, 2] &= (pieces != WHITE | KING) & ~((pieces == WHITE | ROOK) & (fromSquares == 56)) & \
+        ~((capturedPieces == WHITE | ROOK) & (toSquares == 56))
+    castling[:, 1] &= (pieces != BLACK | KING) & ~((pieces == BLACK | ROOK) & (fromSquares == 7)) & \
+        ~((capturedPieces == BLACK | ROOK) & (toSquares == 7))
+    castling[:, 3] &= (pieces != BLACK | KING) & ~((pieces == BLACK | ROOK) & (fromSquares == 0)) & \
+        ~((capturedPieces == BLACK | ROOK) & (toSquares == 0))
+
+    doublePush = (pieces & TYPE_MASK == PAWN) & (np.abs(toSquares - fromSquares) == 16)
+    enpassantSquares = np.where(doublePush, (fromSquares + toSquares) // 2, -1).astype(np.int8)
+    return PositionBatch(board, ~white, castling, enpassantSquares)
+
+
+def moveIDs(fromSquares, toSquares):
+    """
+    Move.moveID of every move
+    """
+    fromSquares = fromSquares.astype(np.int32)
+    toSquares = toSquares.astype(np.int32)
+    return fromSquares // 8 * 1000 + fromSquares % 8 * 100 + toSquares // 8 * 10 + toSquares % 8
+
+
+def perft(batch, depth):
+    """
+    Number of move sequences of length depth from all positions of batch together
+    """
+    if depth == 0:
+        return len(batch)
+    fromSquares, toSquares, flags, offsets = generateMoves(batch)
+    if depth == 1:
+        return len(fromSquares)
+    children = applyMoves(batch, fromSquares, toSquares, flags, offsets)
+    return sum(perft(children[start:start + CHUNK], depth - 1) for start in range(0, len(children), CHUNK))
+
+
+def randomPositions(count, seed=0):
+    """
+    Positions from random games, for benchmarks
+    """
+    rng = random.Random(seed)
+    states = []
+    gs = ChessEngine.GameState()
+    while len(states) < count:
+        moves = gs.getValidMoves()
+        if len(moves) == 0 or len(gs.moveLog) >= 80:
+            gs = ChessEngine.GameState()
+            continue
+        gs.makeMove(rng.choice(moves))
+        states.append(gs.toBytes())
+    return b"".join(states)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Batched move generation")
+    parser.add_argument("fen", nargs="*")
+    parser.add_argument("--perft", type=int, default=3, help="Perft depth for the given positions")
+    parser.add_argument("--bench", type=int, help="Compare with getValidMoves on this many random positions")
+    args = parser.parse_args()
+
+    for fen in args.fen:
+        batch = PositionBatch.fromGameStates([ChessEngine.fromFEN(fen)])
+        for depth in range(1, args.perft + 1):
+            startTime = time.perf_counter()
+            nodes = perft(batch, depth)
+            print("%s perft %d: %d (%.2fs)" % (fen, depth, nodes, time.perf_counter() - startTime))
+
+    if args.bench:
+        data = randomPositions(args.bench)
+        startTime = time.perf_counter()
+        batch = PositionBatch.fromBytes(data)
+        fromSquares, toSquares, flags, offsets = generateMoves(batch)
+        batchTime = time.perf_counter() - startTime
+        startTime = time.perf_counter()
+        count = 0
+        for i in range(0, len(data), ChessEngine.POSITION_BYTES):
+            count += len(ChessEngine.fromBytes(data[i:i + ChessEngine.POSITION_BYTES]).getValidMoves())
+        singleTime = time.perf_counter() - startTime
+        print("%d positions, %d moves: batch %.3fs, getValidMoves %.3fs" % (args.bench, len(fromSquares), batchTime,
+                                                                           singleTime))
@@ -0,0 +1,183 @@
+"""
+Search benchmark.
+Searches a fixed set of middlegame and endgame positions at a fixed depth and
+at a fixed time, and a tactical test suite in EPD format. Writes the results
+as JSON which can be compared to a stored baseline:
+    python ChessBench.py --output bench.json
+    python ChessBench.py --baseline bench.json --threshold 0.1
+With --profile PREFIX (or CHESS_PROFILE=PREFIX) the fixed depth positions
+are profiled instead, see ChessProfile.
+The total node count at fixed depth doesn't depend on the machine, so a
+change in it means the search itself changed.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import ChessAI
+import ChessEngine
+import ChessPGN
+
+
+BENCH_DEPTH = 3
+BENCH_TIME = 2.0  # Seconds per position for the fixed time run
+TACTICS_DEPTH = 3
+THRESHOLD = 0.1  # Allowed slowdown before it counts as a regression
+
+BENCH_POSITIONS = [
+    ("opening", "r1bqkbnr/pppp1ppp/2n5/4p3/4P3/5N2/PPPP1PPP/RNBQKB1R w KQkq - 2 3"),
+    ("italian", "r1bqk2r/pppp1ppp/2n2n2/2b1p3/2B1P3/3P1N2/PPP2PPP/RNBQK2R w KQkq - 1 5"),
+    ("kiwipete", "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1"),
+    ("middlegame", "r2q1rk1/pp2bppp/2n1pn2/3p4/2PP4/2N1PN2/PP2BPPP/R2Q1RK1 w - - 0 9"),
+    ("rook endgame", "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1"),
+    ("pawn endgame", "8/8/1p3k2/p1p5/P1P2K2/1P6/8/8 w - - 0 1"),
+    ("queen endgame", "8/6k1/6p1/3Q3p/7P/6P1/2q2PK1/8 b - - 0 1"),
+]
+
+# Win At Chess positions: FEN fields then "bm <best move>; id <name>;"
+TACTICS_EPD = """\
+2rr3k/pp3pp1/1nnqbN1p/3pN3/2pP4/2P3Q1/PPB4P/R4RK1 w - - bm Qg6; id "WAC.001";
+5rk1/1ppb3p/p1pb4/6q1/3P1p1r/2P1R2P/PP1BQ1P1/5RKN w - - bm Rg3; id "WAC.003";
+r1bq2rk/pp3pbp/2p1p1pQ/7P/3P4/2PB1N2/PP3PPR/2KR4 w - - bm Qxh7+; id "WAC.004";
+5k2/6pp/p1qN4/1p1p4/3P4/2PKP2Q/PP3r2/3R4 b - - bm Qc4+; id "WAC.005";
+7k/p7/1R5K/6r1/6p1/6P1/8/8 w - - bm Rb7; id "WAC.006";
+rnbqkb1r/pppp1ppp/8/4P3/6n1/7P/PPPNPPP1/R1BQKBNR b KQkq - bm Ne3; id "WAC.007";
+r4q1k/p2bR1rp/2p2Q1N/5p2/5p2/2P5/PP3PPP/R5K1 w - - bm Rf7; id "WAC.008";
+3q1rk1/p4pp1/2pb3p/3p4/6Pr/1PNQ4/P1PB1PP1/4RRK1 b - - bm Bh2+; id "WAC.009";
+2br2k1/2q3rn/p2NppQ1/2p1P3/Pp5R/4P3/1P3PPP/3R2K1 w - - bm Rh7; id "WAC.010";
+"""
+
+
+def parseEPD(line):
+    """
+    Returns (name, fen, bestMoves) of an EPD line
+    """
+    fields = line.split(None, 4)
+    fen = " ".join(fields[:4])
+    operations = {}
+    for operation in fields[4].split(";") if len(fields) > 4 else []:
+        operation = operation.strip()
+        if operation:
+            opcode, _, operand = operation.partition(" ")
+            operations[opcode] = operand.strip().strip('"')
+    return operations.get("id", fen), fen, operations.get("bm", "").split()
+
+
+def search(fen, depth, timeLimit=None):
+    """
+    One search from scratch. Returns (best move, nodes, seconds, depthTimes)
+    """
+    ChessAI.pawnHashTable.clear()
+    ChessAI.newGame()  # The transposition table is kept between searches otherwise
+    gs = ChessEngine.fromFEN(fen)
+    validMoves = gs.getValidMoves()
+    startTime = time.perf_counter()
+    results = ChessAI.findBestMovesMultiPV(gs, validMoves, 1, depth, timeLimit)
+    seconds = time.perf_counter() - startTime
+    return results[0][0], ChessAI.counter, seconds, list(ChessAI.depthTimes)
+
+
+def runBench(depth=BENCH_DEPTH, moveTime=BENCH_TIME, tacticsDepth=TACTICS_DEPTH, epd=TACTICS_EPD):
+    report = {"depth": depth, "movetime": moveTime, "positions": []}
+
+    totalNodes = totalTime = 0
+    for name, fen in BENCH_POSITIONS:
+        move, nodes, seconds, depthTimes = search(fen, depth)
+        timedMove, timedNodes, timedSeconds, timedDepths = search(fen, 64, moveTime)
+        totalNodes += nodes
+        totalTime += seconds
+        report["positions"].append({
+            "name": name,
+            "fen": fen,
+            "bestmove": move.getChessNotation(),
+            "nodes": nodes,
+            "time": seconds,
+            "timeToDepth": [seconds for d, seconds, n in depthTimes],
+            "fixedTimeDepth": timedDepths[-1][0],
+            "fixedTimeNodes": timedNodes,
+            "fixedTimeNps": timedNodes / timedSeconds,
+        })
+    report["nodes"] = totalNodes
+    report["time"] = totalTime
+    report["nps"] = totalNodes / totalTime
+
+    solved = []
+    total = 0
+    for line in epd.splitlines():
+        if not line.strip():
+            continue
+        name, fen, bestMoves = parseEPD(line)
+        gs = ChessEngine.fromFEN(fen)
+        validMoves = gs.getValidMoves()
+        expected = [ChessPGN.parseSAN(gs, san, validMoves) for san in bestMoves]
+        move = search(fen, tacticsDepth)[0]
+        total += 1
+        if move in expected:
+            solved.append(name)
+    report["tactics"] = {"depth": tacticsDepth, "solved": len(solved), "total": total, "solvedIds": solved}
+    return report
+
+
+def compare(report, baseline, threshold=THRESHOLD):
+    """
+    Returns a list of regressions of report against baseline
+    """
+    problems = []
+    if report["depth"] == baseline["depth"] and report["nodes"] != baseline["nodes"]:
+        problems.append("node count changed: %d -> %d (search is not the same)" % (baseline["nodes"], report["nodes"]))
+    if report["nps"] < baseline["nps"] * (1 - threshold):
+        problems.append("nps dropped: %.0f -> %.0f" % (baseline["nps"], report["nps"]))
+    if report["time"] > baseline["time"] * (1 + threshold):
+        problems.append("time to depth %d rose: %.2fs -> %.2fs" % (report["depth"], baseline["time"], report["time"]))
+    if report["tactics"]["solved"] < baseline["tactics"]["solved"]:
+        problems.append("tactics solved dropped: %d -> %d" % (baseline["tactics"]["solved"], report["tactics"]["solved"]))
+    return problems
+
+
+def printReport(report):
+    for position in report["positions"]:
+        print("%-14s %-5s %8d nodes %7.2fs   depth %d in %.1fs, %.0f nps" % (
+            position["name"], position["bestmove"], position["nodes"], position["time"],
+            position["fixedTimeDepth"], report["movetime"], position["fixedTimeNps"]))
+    print("Total: %d nodes %.2fs %.0f nps" % (report["nodes"], report["time"], report["nps"]))
+    print("Tactics: %d / %d solved at depth %d" % (
+        report["tactics"]["solved"], report["tactics"]["total"], report["tactics"]["depth"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Search benchmark")
+    parser.add_argument("--depth", type=int, default=BENCH_DEPTH)
+    parser.add_argument("--movetime", type=float, default=BENCH_TIME)
+    parser.add_argument("--tactics-depth", type=int, default=TACTICS_DEPTH)
+    parser.add_argument("--epd", help="EPD file with the tactical positions")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results to compare with")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD)
+    parser.add_argument("--profile", default=os.environ.get("CHESS_PROFILE"),
+                        help="Profile the fixed depth search and write PREFIX.txt, .pstats and .collapsed")
+    args = parser.parse_args()
+
+    if args.profile:
+        import ChessProfile
+        ChessProfile.profile(ChessProfile.benchWorkload, (args.depth,), args.profile)
+        with open(args.profile + ".txt") as f:
+            print(f.read())
+        sys.exit(0)
+
+    epd = TACTICS_EPD
+    if args.epd:
+        with open(args.epd) as f:
+            epd = f.read()
+    report = runBench(args.depth, args.movetime, args.tactics_depth, epd)
+    printReport(report)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            problems = compare(report, json.load(f), args.threshold)
+        for problem in problems:
+            print("REGRESSION: " + problem)
+        sys.exit(1 if problems else 0)
@@ -1,3 +1,252 @@
+import random
+from collections import OrderedDict
+
+# ======================================================== Zobrist Keys ================================================================
+# Random 64-bit numbers for every piece on every square, the side to move, every combination of castling
+# rights and every en passant column. The key of a position is the XOR of the numbers of everything in it,
+# so it can be updated incrementally in makeMove. The pawn key only uses the numbers of the pawns.
+# Seeded so that keys are the same on every run.
+
+zobristRandom = random.Random(2022)
+zobristPieces = {color + piece: [[zobristRandom.getrandbits(64) for c in range(8)] for r in range(8)]
+                 for color in ('w', 'b') for piece in ('p', 'N', 'B', 'R', 'Q', 'K')}
+zobristPawns = {'wp': zobristPieces['wp'], 'bp': zobristPieces['bp']}
+zobristBlackToMove = zobristRandom.getrandbits(64)
+zobristCastle = [zobristRandom.getrandbits(64) for i in range(16)]  # Indexed by CastleRights.index()
+zobristEnpassant = [zobristRandom.getrandbits(64) for c in range(8)]  # Indexed by column
+
+# ======================================================== Exchange Values =============================================================
+# Piece values used by the static exchange evaluation. The king is worth more than everything else
+# so it is only used to capture last.
+
+exchangeValues = [0, 1, 3, 3, 5, 9, 100]  # Indexed by piece type: -, pawn, knight, bishop, rook, queen, king
+
+# ======================================================== Board Representation ========================================================
+# The board is a 10x12 mailbox: a flat bytearray of 120 squares holding the 8x8 board with a border of
+# OFFBOARD squares around it, two rows deep above and below so knight jumps land on the border too.
+# Square (row, col) is at index 21 + row * 10 + col, so moving a row is +-10 and a column +-1.
+# Every square holds a piece code (colour bit | piece type), EMPTY or OFFBOARD. OFFBOARD has no colour
+# bit, so generators stop on the border like on a friendly piece without any bounds checks.
+
+EMPTY = 0
+PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING = 1, 2, 3, 4, 5, 6
+WHITE = 8
+BLACK = 16
+OFFBOARD = 32
+TYPE_MASK = 7
+
+pieceTypes = {'p': PAWN, 'N': KNIGHT, 'B': BISHOP, 'R': ROOK, 'Q': QUEEN, 'K': KING}
+pieceCodes = {color + letter: colorBit | pieceType
+              for color, colorBit in (('w', WHITE), ('b', BLACK)) for letter, pieceType in pieceTypes.items()}
+pieceCodes['--'] = EMPTY  # 'wp', 'bK', ... -> piece code
+pieceNames = ['--'] * (OFFBOARD + 1)  # Piece code -> 'wp', 'bK', ... ('--' for empty and off board)
+for name, code in pieceCodes.items():
+    pieceNames[code] = name
+
+squareIndex = [[21 + r * 10 + c for c in range(8)] for r in range(8)]  # (row, col) -> index
+
+# Directions from the king for pins and checks: Up, Left, Down, Right, then the diagonals
+directionOffsets = (-10, -1, 10, 1, -11, -9, 9, 11)
+# Steps of the pieces as (dRow, dCol, offset)
+rookDirections = ((-1, 0, -10), (0, -1, -1), (1, 0, 10), (0, 1, 1))
+bishopDirections = ((-1, -1, -11), (1, 1, 11), (1, -1, 9), (-1, 1, -9))
+knightJumps = ((-2, -1, -21), (-2, 1, -19), (2, -1, 19), (2, 1, 21),
+               (1, 2, 12), (1, -2, 8), (-1, 2, -8), (-1, -2, -12))
+kingSteps = ((0, 1, 1), (0, -1, -1), (1, 0, 10), (-1, 0, -10),
+             (-1, 1, -9), (-1, -1, -11), (1, 1, 11), (1, -1, 9))
+
+
+def emptySquares():
+    # A bytearray board with every square empty and the border filled in
+    squares = bytearray([OFFBOARD]) * 120
+    for r in range(8):
+        start = squareIndex[r][0]
+        squares[start:start + 8] = bytes(8)
+    return squares
+
+
+def lineOffset(fromRow, fromCol, toRow, toCol):
+    # Offset of one step along the row, column or diagonal from one square towards the other, 0 if there is none
+    dRow = toRow - fromRow
+    dCol = toCol - fromCol
+    if dRow != 0 and dCol != 0 and abs(dRow) != abs(dCol):
+        return 0
+    return ((dRow > 0) - (dRow < 0)) * 10 + (dCol > 0) - (dCol < 0)
+
+
+class BoardView():
+    # Read-only 8x8 view of GameState.squares in the old format (board[row][col] == 'wp', '--', ...)
+    # for the UI and other code that doesn't need speed. Every row is built when it is read
+
+    def __init__(self, squares):
+        self.squares = squares
+
+    def __getitem__(self, row):
+        if not 0 <= row < 8:
+            raise IndexError(row)
+        start = 21 + row * 10
+        return [pieceNames[code] for code in self.squares[start:start + 8]]
+
+    def __len__(self):
+        return 8
+
+    def __iter__(self):
+        for row in range(8):
+            yield self[row]
+
+    def __eq__(self, other):
+        return list(self) == [list(row) for row in other]
+
+    def __repr__(self):
+        return repr(list(self))
+
+# ======================================================== Binary Encoding =============================================================
+# 4-bit code of every piece, used by GameState.toBytes / fromBytes: piece type, plus 8 for black
+
+POSITION_BYTES = 34
+
+
+def fromBytes(data):
+    # Build a GameState from the output of GameState.toBytes
+    board = []
+    for r in range(8):
+        row = []
+        for c in range(4):
+            byte = data[r * 4 + c]
+            for nibble in (byte >> 4, byte & 15):
+                if nibble & TYPE_MASK:
+                    row.append(pieceNames[(BLACK if nibble & 8 else WHITE) | nibble & TYPE_MASK])
+                else:
+                    row.append('--')
+        board.append(row)
+
+    flags = data[32]
+    castleRights = CastleRights(bool(flags & 2), bool(flags & 4), bool(flags & 8), bool(flags & 16))
+    enpassantPossible = divmod(data[33], 8) if data[33] != 255 else ()
+
+    gs = GameState.__new__(GameState)
+    gs.setPosition(board, bool(flags & 1), castleRights, enpassantPossible)
+    return gs
+
+
+# ======================================================== FEN =========================================================================
+
+def fromFEN(fen):
+    # Build a GameState from a FEN string. Raises ValueError if it isn't a valid FEN
+    fields = fen.split()
+    if not fields:
+        raise ValueError("Empty FEN")
+    board = []
+    for rank in fields[0].split('/'):
+        row = []
+        for ch in rank:
+            if ch.isdigit():
+                row.extend(['--'] * int(ch))
+            elif ch in 'pnbrqkPNBRQK':
+                row.append(('w' if ch.isupper() else 'b') + (ch.upper() if ch.upper() != 'P' else 'p'))
+            else:
+                raise ValueError("Invalid FEN piece %r in %s" % (ch, fields[0]))
+        board.append(row)
+    if len(board) != 8 or any(len(row) != 8 for row in board):
+        raise ValueError("Invalid FEN board: " + fields[0])
+
+    whiteToMove = len(fields) < 2 or fields[1] == 'w'
+    castling = fields[2] if len(fields) > 2 else '-'
+    castleRights = CastleRights('K' in castling, 'k' in castling, 'Q' in castling, 'q' in castling)
+    enpassantPossible = ()
+    if len(fields) > 3 and fields[3] != '-':
+        if len(fields[3]) != 2 or fields[3][0] not in Move.filesToCols or fields[3][1] not in Move.ranksToRows:
+            raise ValueError("Invalid FEN en passant square: " + fields[3])
+        enpassantPossible = (Move.ranksToRows[fields[3][1]], Move.filesToCols[fields[3][0]])
+    halfmoveClock = int(fields[4]) if len(fields) > 4 else 0
+    fullmoveNumber = int(fields[5]) if len(fields) > 5 else 1
+
+    gs = GameState.__new__(GameState)
+    gs.setPosition(board, whiteToMove, castleRights, enpassantPossible, halfmoveClock, fullmoveNumber)
+    return gs
+
+
+# ======================================================== Move Cache ==================================================================
+# Optional cache of getValidMoves results keyed by zobrist key, for work that reaches the same positions
+# again (undo / redo in the UI, analysing games that share openings). Off unless GameState.moveCache is set.
+# The memory cap is approximate: every move is counted as MOVE_BYTES and every entry as ENTRY_BYTES.
+
+MOVE_CACHE_MB = 16
+MOVE_BYTES = 400
+ENTRY_BYTES = 200
+
+
+class MoveCache():
+    # Least recently used entries are evicted first. One cache can be shared by several GameStates
+
+    def __init__(self, sizeMB=MOVE_CACHE_MB):
+        self.maxBytes = sizeMB * 1024 * 1024
+        self.bytes = 0
+        self.entries = OrderedDict()  # zobristKey -> (moves, inCheck, checkmate, stalemate)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry
+
+    def store(self, key, moves, inCheck, checkmate, stalemate):
+        if key in self.entries:
+            self.bytes -= ENTRY_BYTES + len(self.entries[key][0]) * MOVE_BYTES
+        self.entries[key] = (tuple(moves), inCheck, checkmate, stalemate)
+        self.entries.move_to_end(key)
+        self.bytes += ENTRY_BYTES + len(moves) * MOVE_BYTES
+        while self.bytes > self.maxBytes and self.entries:
+            oldKey, oldEntry = self.entries.popitem(last=False)
+            self.bytes -= ENTRY_BYTES + len(oldEntry[0]) * MOVE_BYTES
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+
+# ======================================================== History =====================================================================
+# GameState.seek jumps to any ply of the game from the nearest snapshot of the board instead of undoing or
+# redoing every move in between. Snapshots are kept every SNAPSHOT_INTERVAL plies
+
+SNAPSHOT_INTERVAL = 16
+SNAPSHOT_COST = 2  # Cost of restoring a snapshot, in moves made or undone
+
+
+# ======================================================== Move Index ==================================================================
+# Legal moves of a position by start square and by (start, end) squares, so the UI finds the move of a click
+# or the moves to highlight with a lookup instead of going through every legal move. GameState.getMoveIndex
+# builds one per position. Pawns only promote to queens, so a pair of squares has at most one legal move.
+
+
+class MoveIndex():
+
+    def __init__(self, moves, key, inCheck, checkmate, stalemate):
+        self.moves = tuple(moves)
+        self.key = key  # zobristKey of the position
+        self.inCheck = inCheck
+        self.checkmate = checkmate
+        self.stalemate = stalemate
+        self.byStart = {}  # (row, col) -> moves from that square
+        self.byStartEnd = {}  # ((row, col), (row, col)) -> the move between the squares
+        for move in self.moves:
+            start, end = (move.startRow, move.startCol), (move.endRow, move.endCol)
+            self.byStart.setdefault(start, []).append(move)
+            self.byStartEnd[(start, end)] = move
+
+    def movesFrom(self, start):
+        return self.byStart.get(start, [])
+
+    def findMove(self, start, end):
+        # The legal move from start to end, None if there is none
+        return self.byStartEnd.get((start, end))
 
 
 class GameState():
@@ -5,12 +254,13 @@ class GameState():
     # ======================================================== Variables Define ========================================================
     def __init__(self) -> None:
 
-        # Board is an 8*8 2d list. Each element has 2 characters.
+        # Start position as an 8*8 2d list. Each element has 2 characters.
         # The first character represent the color of the piece.
         # The second character represents the type of the piece.
         # '--' represent any space without any piece.
+        # setPosition turns it into the mailbox board (see Board Representation)
 
-        self.board = [
+        board = [
             ['bR', 'bN', 'bB', 'bQ', 'bK', 'bB', 'bN', 'bR'],
             ['bp', 'bp', 'bp', 'bp', 'bp', 'bp', 'bp', 'bp'],
             ['--', '--', '--', '--', '--', '--', '--', '--'],
@@ -21,29 +271,79 @@ class GameState():
             ['wR', 'wN', 'wB', 'wQ', 'wK', 'wB', 'wN', 'wR'],
         ]
 
-        self.whiteToMove = True
+        self.setPosition(board, True, CastleRights(True, True, True, True), ())
+
+    # ======================================================== Set Position ============================================================
+
+    def setPosition(self, board, whiteToMove, castleRights, enpassantPossible, halfmoveClock=0, fullmoveNumber=1):
+        # Start from any position. The move log is empty afterwards, so moves
+        # made before this position can't be undone. board is an 8*8 2d list of piece names.
+        # halfmoveClock and fullmoveNumber are the FEN counters of the position, for getFEN
+        self.squares = emptySquares()
+        for r in range(8):
+            for c in range(8):
+                self.squares[squareIndex[r][c]] = pieceCodes[board[r][c]]
+        # board[row][col] still gives piece names for the UI
+        self.board = BoardView(self.squares)
+        self.whiteToMove = whiteToMove
         self.moveLog = []
+        self.startHalfmoveClock = halfmoveClock
+        self.startPly = 2 * (fullmoveNumber - 1) + (0 if whiteToMove else 1)  # Plies before this position
         self.moveFunctions = {'p': self.getPawnMoves, 'R': self.getPawnMoves, 'N': self.getKnightMoves, 'R': self.getRookMoves,
                               'B': self.getBishopMoves, 'Q': self.getQueenMoves, 'K': self.getKingMoves}
 
+        # Squares of every piece on the board: piece -> set of (row, col)
+        # Kept in sync by makeMove / undoMove so generators don't have to scan all 64 squares
+        self.pieceLocations = self.computePieceLocations()
+        for king, color in (('wK', "white"), ('bK', "black")):
+            if len(self.pieceLocations[king]) != 1:
+                raise ValueError("Position has %d %s kings, it needs one" % (len(self.pieceLocations[king]), color))
+
         # To keep track of kings location for track the checking stuff
-        self.whiteKingLocation = (7, 4)
-        self.blackKingLocation = (0, 4)
+        self.whiteKingLocation = next(iter(self.pieceLocations['wK']))
+        self.blackKingLocation = next(iter(self.pieceLocations['bK']))
 
         self.inCheck = False
         self.pins = []
         self.checks = []
 
-        self.enpassantPossible = ()  # Coords where an enpassant capture is possible
+        self.enpassantPossible = enpassantPossible  # Coords where an enpassant capture is possible
         self.enpassantPossibleLog = [self.enpassantPossible]
 
-        self.currentCastlingRight = CastleRights(True, True, True, True)
+        self.currentCastlingRight = castleRights
         self.castleRightsLog = [CastleRights(self.currentCastlingRight.wks, self.currentCastlingRight.bks,
                                              self.currentCastlingRight.wqs, self.currentCastlingRight.bqs)]
+
+        # Zobrist key of the whole position, used by the transposition table in ChessAI
+        self.zobristKey = self.computeZobristKey()
+        self.zobristKeyLog = [self.zobristKey]
+
+        # Zobrist key of the pawn skeleton only, used by the pawn hash table in ChessAI
+        self.pawnKey = self.computePawnKey()
+        self.pawnKeyLog = [self.pawnKey]
+
         self.undoFlag = False
         self.checkmate = False
         self.stalemate = False
 
+        # MoveCache used by getValidMoves, None for no caching
+        self.moveCache = None
+        # MoveIndex of the last position getMoveIndex was called for
+        self.moveIndex = None
+
+        # Incrementally updated evaluation state (ChessNNUE.Accumulator), None if not used
+        self.accumulator = None
+
+        # Moves after the current ply that seek went back over, the next one last, with the log entries
+        # of their positions: (move, castleRights, enpassantPossible, zobristKey, pawnKey).
+        # Only valid in the position it was left for, (redoPly, redoKey)
+        self.redoLog = []
+        self.redoPly = 0
+        self.redoKey = self.zobristKey
+        # ply -> (zobristKey, squares, whiteToMove) of the board at multiples of SNAPSHOT_INTERVAL. Taken by
+        # seek as it passes them, not by makeMove, so the search doesn't pay for them
+        self.snapshots = {0: (self.zobristKey, bytes(self.squares), self.whiteToMove)}
+
         # TODO: Add the following features
         # self.protects = [][]
         # self.threatens = [][]
@@ -54,10 +354,12 @@ class GameState():
     def makeMove(self, move):
         # Takes Move as a parameter and executes it.
         # This function won't work for Casteling, Pawn Promotion and en-passant
-        self.board[move.startRow][move.startCol] = '--'
-        self.board[move.endRow][move.endCol] = move.pieceMoved
+        squares = self.squares
+        squares[move.startIndex] = EMPTY
+        squares[move.endIndex] = move.pieceMovedCode
         self.moveLog.append(move)  # log the move so we can undo it later
         self.whiteToMove = not self.whiteToMove  # Swap players
+        self.updatePieceLocations(move)
         # Update the king's location if moved
         if move.pieceMoved == 'wK':
             self.whiteKingLocation = (move.endRow, move.endCol)
@@ -66,15 +368,15 @@ class GameState():
 
         # Pawn promotion
         if move.isPawnPromotion:
-            self.board[move.endRow][move.endCol] = move.pieceMoved[0] + 'Q'
+            squares[move.endIndex] = move.pieceMovedCode & ~TYPE_MASK | QUEEN
 
         # Enpassant
         if move.enPassant:
-            self.board[move.startRow][move.endCol] = '--'  # Capturing the pawn
+            squares[move.startIndex + move.endCol - move.startCol] = EMPTY  # Capturing the pawn
 
         # Update enpassantPossible variable
         # To make sure only on 2 square pawn advance it updates
-        if move.pieceMoved[1] == 'p' and abs(move.startRow - move.endRow) == 2:
+        if move.pieceMovedCode & TYPE_MASK == PAWN and abs(move.startRow - move.endRow) == 2:
             self.enpassantPossible = (
                 (move.startRow + move.endRow) // 2, move.startCol)
         else:
@@ -84,15 +386,12 @@ class GameState():
         if move.isCastleMove:
             if move.endCol - move.startCol == 2:  # Kingside castle move
                 # Moves the rook
-                self.board[move.endRow][move.endCol -
-                                        1] = self.board[move.endRow][move.endCol + 1]
-                self.board[move.endRow][move.endCol +
-                                        1] = '--'  # Erase old rook
+                squares[move.endIndex - 1] = squares[move.endIndex + 1]
+                squares[move.endIndex + 1] = EMPTY  # Erase old rook
             else:  # Queenside castle move
                 # Moves the rook
-                self.board[move.endRow][move.endCol +
-                                        1] = self.board[move.endRow][move.endCol - 2]
-                self.board[move.endRow][move.endCol - 2] = '--'
+                squares[move.endIndex + 1] = squares[move.endIndex - 2]
+                squares[move.endIndex - 2] = EMPTY
 
         self.enpassantPossibleLog.append(self.enpassantPossible)
 
@@ -101,13 +400,25 @@ class GameState():
         self.castleRightsLog.append(CastleRights(self.currentCastlingRight.wks, self.currentCastlingRight.bks,
                                                  self.currentCastlingRight.wqs, self.currentCastlingRight.bqs))
 
+        # Update pawn key - only when a pawn moves or a pawn is captured
+        self.updatePawnKey(move)
+        self.pawnKeyLog.append(self.pawnKey)
+
+        self.updateZobristKey(move)
+        self.zobristKeyLog.append(self.zobristKey)
+
+        if self.accumulator is not None:
+            self.accumulator.makeMove(move)
+
     # ======================================================== Undo Move ===============================================================
     def undoMove(self):
         if len(self.moveLog) != 0:  # Make sure tht there is a move to undo
             move = self.moveLog.pop()
-            self.board[move.startRow][move.startCol] = move.pieceMoved
-            self.board[move.endRow][move.endCol] = move.pieceCaptured
+            squares = self.squares
+            squares[move.startIndex] = move.pieceMovedCode
+            squares[move.endIndex] = move.pieceCapturedCode
             self.whiteToMove = not self.whiteToMove  # Switch turns back
+            self.undoPieceLocations(move)
 
             # Update the king's location
             if move.pieceMoved == 'wK':
@@ -118,9 +429,9 @@ class GameState():
             # Undo enpassant
             if move.enPassant:
                 # Leave landing square blank
-                self.board[move.endRow][move.endCol] = '--'
+                squares[move.endIndex] = EMPTY
                 # Puts the pawn back on the corrct square it was captured from
-                self.board[move.startRow][move.endCol] = move.pieceCaptured
+                squares[move.startIndex + move.endCol - move.startCol] = move.pieceCapturedCode
 
             self.enpassantPossibleLog.pop()
             self.enpassantPossible = self.enpassantPossibleLog[-1]
@@ -129,24 +440,146 @@ class GameState():
 
             self.castleRightsLog.pop()  # Get rid of new castle rights from the move we are undoing
             # Set the current castle rights to the last move we did
-            self.currentCastlingRight = self.castleRightsLog[-1]
+            # (a copy, so the next move doesn't change the log entry)
+            lastRights = self.castleRightsLog[-1]
+            self.currentCastlingRight = CastleRights(lastRights.wks, lastRights.bks, lastRights.wqs, lastRights.bqs)
+
+            # Undo pawn key and zobrist key
+            self.pawnKeyLog.pop()
+            self.pawnKey = self.pawnKeyLog[-1]
+            self.zobristKeyLog.pop()
+            self.zobristKey = self.zobristKeyLog[-1]
 
             # Undo Castle Move
             if move.isCastleMove:
                 if move.endCol - move.startCol == 2:  # Kingside castle move
                     # Puts rook back to its pre location
-                    self.board[move.endRow][move.endCol +
-                                            1] = self.board[move.endRow][move.endCol - 1]
-                    self.board[move.endRow][move.endCol - 1] = '--'
+                    squares[move.endIndex + 1] = squares[move.endIndex - 1]
+                    squares[move.endIndex - 1] = EMPTY
 
                 else:  # Queenside Castle move
-                    self.board[move.endRow][move.endCol -
-                                            2] = self.board[move.endRow][move.endCol + 1]
-                    self.board[move.endRow][move.endCol + 1] = '--'
+                    squares[move.endIndex - 2] = squares[move.endIndex + 1]
+                    squares[move.endIndex + 1] = EMPTY
+
+            # After the board is back, the accumulator may compute it from scratch
+            if self.accumulator is not None:
+                self.accumulator.undoMove()
 
             self.checkmate = False
             self.stalemate = False
 
+    # ======================================================= History ===================================================================
+
+    def historyLength(self):
+        # Plies of the game, including the moves seek went back over
+        self.checkRedoLog()
+        return len(self.moveLog) + len(self.redoLog)
+
+    def seek(self, ply):
+        # Go to the position after ply moves of the game, back or forward (up to historyLength), from the
+        # nearest snapshot when that is cheaper than undoing or redoing every move in between
+        self.checkRedoLog()
+        current = len(self.moveLog)
+        if not 0 <= ply <= current + len(self.redoLog):
+            raise IndexError("Ply %d is not in the game (0 to %d)" % (ply, current + len(self.redoLog)))
+        # The accumulator would be updated for every move replayed, it is computed once at the end instead.
+        # Undoing moves from there computes it again at the first one
+        accumulator, self.accumulator = self.accumulator, None
+
+        snapshot = self.nearestSnapshot(ply)
+        if snapshot is not None and ply - snapshot + SNAPSHOT_COST < abs(ply - current):
+            self.restoreSnapshot(snapshot)
+        while len(self.moveLog) > ply:
+            self.stepBack()
+        while len(self.moveLog) < ply:
+            self.stepForward()
+
+        if accumulator is not None:
+            accumulator.stack = [accumulator.compute(self)]
+            self.accumulator = accumulator
+        self.redoPly, self.redoKey = len(self.moveLog), self.zobristKey
+
+    def redoMove(self):
+        # Make the next move of the game again after seek went back. Returns the move, None if there is none
+        self.checkRedoLog()
+        if not self.redoLog:
+            return None
+        move = self.redoLog[-1][0]
+        self.seek(len(self.moveLog) + 1)
+        return move
+
+    def checkRedoLog(self):
+        # The redo log is dropped once another move is played from the position it was left for
+        if (len(self.moveLog), self.zobristKey) != (self.redoPly, self.redoKey):
+            self.redoLog = []
+            self.redoPly, self.redoKey = len(self.moveLog), self.zobristKey
+
+    def stepBack(self):
+        self.redoLog.append((self.moveLog[-1], self.castleRightsLog[-1], self.enpassantPossibleLog[-1],
+                             self.zobristKey, self.pawnKey))
+        self.undoMove()
+        self.takeSnapshot()
+
+    def stepForward(self):
+        self.makeMove(self.redoLog.pop()[0])
+        self.takeSnapshot()
+
+    def takeSnapshot(self):
+        ply = len(self.moveLog)
+        if ply % SNAPSHOT_INTERVAL == 0 and self.snapshots.get(ply, (None,))[0] != self.zobristKey:
+            self.snapshots[ply] = (self.zobristKey, bytes(self.squares), self.whiteToMove)
+
+    def nearestSnapshot(self, ply):
+        # Last ply at or before ply with a snapshot of this game's position, None if there is none
+        current = len(self.moveLog)
+        for snapshotPly in range(ply - ply % SNAPSHOT_INTERVAL, -1, -SNAPSHOT_INTERVAL):
+            snapshot = self.snapshots.get(snapshotPly)
+            if snapshot is None:
+                continue
+            # A snapshot of a line that was played over has another key
+            if snapshotPly <= current:
+                key = self.zobristKeyLog[snapshotPly]
+            else:
+                key = self.redoLog[current - snapshotPly][3]
+            if snapshot[0] == key:
+                return snapshotPly
+        return None
+
+    def restoreSnapshot(self, ply):
+        # Set the board to the snapshot at ply and move the moves and log entries in between from the logs to
+        # the redo log or back, which leaves the same state as undoing or redoing them
+        current = len(self.moveLog)
+        if ply > current:
+            for move, castleRights, enpassantPossible, zobristKey, pawnKey in reversed(self.redoLog[current - ply:]):
+                self.moveLog.append(move)
+                self.castleRightsLog.append(castleRights)
+                self.enpassantPossibleLog.append(enpassantPossible)
+                self.zobristKeyLog.append(zobristKey)
+                self.pawnKeyLog.append(pawnKey)
+            del self.redoLog[current - ply:]
+        else:
+            for i in range(current - 1, ply - 1, -1):
+                self.redoLog.append((self.moveLog[i], self.castleRightsLog[i + 1], self.enpassantPossibleLog[i + 1],
+                                     self.zobristKeyLog[i + 1], self.pawnKeyLog[i + 1]))
+            del self.moveLog[ply:]
+            del self.castleRightsLog[ply + 1:]
+            del self.enpassantPossibleLog[ply + 1:]
+            del self.zobristKeyLog[ply + 1:]
+            del self.pawnKeyLog[ply + 1:]
+
+        zobristKey, squares, self.whiteToMove = self.snapshots[ply]
+        self.squares[:] = squares
+        self.pieceLocations = self.computePieceLocations()
+        self.whiteKingLocation = next(iter(self.pieceLocations['wK']))
+        self.blackKingLocation = next(iter(self.pieceLocations['bK']))
+        self.enpassantPossible = self.enpassantPossibleLog[-1]
+        lastRights = self.castleRightsLog[-1]
+        self.currentCastlingRight = CastleRights(lastRights.wks, lastRights.bks, lastRights.wqs, lastRights.bqs)
+        self.zobristKey = self.zobristKeyLog[-1]
+        self.pawnKey = self.pawnKeyLog[-1]
+        self.checkmate = False
+        self.stalemate = False
+
     # ======================================================= Update Castle Rights ======================================================
 
     def updateCastleRights(self, move):
@@ -167,11 +600,11 @@ class GameState():
                     self.currentCastlingRight.wks = False
 
         elif move.pieceMoved == 'bR':
-            if move.startRow == 0:  # Rook on the bottom row
+            if move.startRow == 0:  # Rook on the top row
                 if move.startCol == 0:  # Left Rook
-                    self.currentCastlingRight.wqs = False
+                    self.currentCastlingRight.bqs = False
                 elif move.startCol == 7:  # Right Rook
-                    self.currentCastlingRight.wks = False
+                    self.currentCastlingRight.bks = False
 
         # If a rook is captured
         if move.pieceCaptured == 'wR':
@@ -188,10 +621,251 @@ class GameState():
                 elif move.endCol == 7:
                     self.currentCastlingRight.bks = False
 
+    # ======================================================= Piece Locations ===========================================================
+
+    def computePieceLocations(self):
+        # Piece lists from scratch. makeMove / undoMove keep them up to date after this
+        pieceLocations = {color + piece: set() for color in ('w', 'b') for piece in ('p', 'N', 'B', 'R', 'Q', 'K')}
+        for r in range(8):
+            for c in range(8):
+                code = self.squares[squareIndex[r][c]]
+                if code != EMPTY:
+                    pieceLocations[pieceNames[code]].add((r, c))
+        return pieceLocations
+
+    def updatePieceLocations(self, move):
+        self.pieceLocations[move.pieceMoved].remove((move.startRow, move.startCol))
+
+        if move.pieceCaptured != '--':
+            if move.enPassant:  # The captured pawn is beside the starting square
+                self.pieceLocations[move.pieceCaptured].remove((move.startRow, move.endCol))
+            else:
+                self.pieceLocations[move.pieceCaptured].remove((move.endRow, move.endCol))
+
+        if move.isPawnPromotion:
+            self.pieceLocations[move.pieceMoved[0] + 'Q'].add((move.endRow, move.endCol))
+        else:
+            self.pieceLocations[move.pieceMoved].add((move.endRow, move.endCol))
+
+        if move.isCastleMove:
+            rooks = self.pieceLocations[move.pieceMoved[0] + 'R']
+            if move.endCol - move.startCol == 2:  # Kingside castle move
+                rooks.remove((move.endRow, move.endCol + 1))
+                rooks.add((move.endRow, move.endCol - 1))
+            else:  # Queenside castle move
+                rooks.remove((move.endRow, move.endCol - 2))
+                rooks.add((move.endRow, move.endCol + 1))
+
+    def undoPieceLocations(self, move):
+        if move.isPawnPromotion:
+            self.pieceLocations[move.pieceMoved[0] + 'Q'].remove((move.endRow, move.endCol))
+        else:
+            self.pieceLocations[move.pieceMoved].remove((move.endRow, move.endCol))
+        self.pieceLocations[move.pieceMoved].add((move.startRow, move.startCol))
+
+        if move.pieceCaptured != '--':
+            if move.enPassant:
+                self.pieceLocations[move.pieceCaptured].add((move.startRow, move.endCol))
+            else:
+                self.pieceLocations[move.pieceCaptured].add((move.endRow, move.endCol))
+
+        if move.isCastleMove:
+            rooks = self.pieceLocations[move.pieceMoved[0] + 'R']
+            if move.endCol - move.startCol == 2:  # Kingside castle move
+                rooks.remove((move.endRow, move.endCol - 1))
+                rooks.add((move.endRow, move.endCol + 1))
+            else:  # Queenside castle move
+                rooks.remove((move.endRow, move.endCol + 1))
+                rooks.add((move.endRow, move.endCol - 2))
+
+    # ======================================================= Pawn Key ==================================================================
+
+    def computePawnKey(self):
+        # Pawn key from scratch. makeMove keeps it up to date incrementally after this
+        key = 0
+        for piece in ('wp', 'bp'):
+            for r, c in self.pieceLocations[piece]:
+                key ^= zobristPawns[piece][r][c]
+        return key
+
+    def updatePawnKey(self, move):
+        if move.pieceMoved[1] == 'p':
+            self.pawnKey ^= zobristPawns[move.pieceMoved][move.startRow][move.startCol]
+            if not move.isPawnPromotion:  # A promoted pawn leaves the pawn skeleton
+                self.pawnKey ^= zobristPawns[move.pieceMoved][move.endRow][move.endCol]
+
+        # If a pawn is captured
+        if move.pieceCaptured[1] == 'p':
+            if move.enPassant:  # The captured pawn is beside the starting square
+                self.pawnKey ^= zobristPawns[move.pieceCaptured][move.startRow][move.endCol]
+            else:
+                self.pawnKey ^= zobristPawns[move.pieceCaptured][move.endRow][move.endCol]
+
+    # ======================================================= Zobrist Key ===============================================================
+
+    def computeZobristKey(self):
+        # Zobrist key from scratch. makeMove keeps it up to date incrementally after this
+        key = 0
+        for piece, squares in self.pieceLocations.items():
+            for r, c in squares:
+                key ^= zobristPieces[piece][r][c]
+        if not self.whiteToMove:
+            key ^= zobristBlackToMove
+        key ^= zobristCastle[self.currentCastlingRight.index()]
+        if self.enpassantPossible != ():
+            key ^= zobristEnpassant[self.enpassantPossible[1]]
+        return key
+
+    def updateZobristKey(self, move):
+        # Called at the end of makeMove, after the logs were updated
+        self.zobristKey = self.moveZobristKey(move, self.castleRightsLog[-2], self.castleRightsLog[-1],
+                                              self.enpassantPossibleLog[-2], self.enpassantPossible)
+
+    def zobristKeyAfter(self, move):
+        # Key of the position after move without making it, e.g. to look the position up in a table
+        rights = self.currentCastlingRight
+        self.currentCastlingRight = CastleRights(rights.wks, rights.bks, rights.wqs, rights.bqs)
+        self.updateCastleRights(move)
+        newRights = self.currentCastlingRight
+        self.currentCastlingRight = rights
+        if move.pieceMovedCode & TYPE_MASK == PAWN and abs(move.startRow - move.endRow) == 2:
+            enpassantPossible = ((move.startRow + move.endRow) // 2, move.startCol)
+        else:
+            enpassantPossible = ()
+        return self.moveZobristKey(move, rights, newRights, self.enpassantPossible, enpassantPossible)
+
+    def moveZobristKey(self, move, oldRights, newRights, oldEnpassant, newEnpassant):
+        # The current key changed by move, given the castle rights and en passant squares before and after it
+        key = self.zobristKey ^ zobristBlackToMove
+        key ^= zobristPieces[move.pieceMoved][move.startRow][move.startCol]
+        if move.isPawnPromotion:
+            key ^= zobristPieces[move.pieceMoved[0] + 'Q'][move.endRow][move.endCol]
+        else:
+            key ^= zobristPieces[move.pieceMoved][move.endRow][move.endCol]
+
+        if move.pieceCaptured != '--':
+            if move.enPassant:
+                key ^= zobristPieces[move.pieceCaptured][move.startRow][move.endCol]
+            else:
+                key ^= zobristPieces[move.pieceCaptured][move.endRow][move.endCol]
+
+        if move.isCastleMove:
+            rook = zobristPieces[move.pieceMoved[0] + 'R'][move.endRow]
+            if move.endCol - move.startCol == 2:  # Kingside castle move
+                key ^= rook[move.endCol + 1] ^ rook[move.endCol - 1]
+            else:  # Queenside castle move
+                key ^= rook[move.endCol - 2] ^ rook[move.endCol + 1]
+
+        key ^= zobristCastle[oldRights.index()] ^ zobristCastle[newRights.index()]
+
+        if oldEnpassant != ():
+            key ^= zobristEnpassant[oldEnpassant[1]]
+        if newEnpassant != ():
+            key ^= zobristEnpassant[newEnpassant[1]]
+        return key
+
+    # ======================================================= FEN ===============================================================
+
+    def getFEN(self):
+        # FEN string of the position. The move counters continue from the ones setPosition was given
+        ranks = []
+        for row in self.board:
+            rank = ''
+            empty = 0
+            for square in row:
+                if square == '--':
+                    empty += 1
+                    continue
+                if empty:
+                    rank += str(empty)
+                    empty = 0
+                rank += square[1].upper() if square[0] == 'w' else square[1].lower()
+            if empty:
+                rank += str(empty)
+            ranks.append(rank)
+
+        castle = self.currentCastlingRight
+        castling = ('K' if castle.wks else '') + ('Q' if castle.wqs else '') + \
+            ('k' if castle.bks else '') + ('q' if castle.bqs else '')
+        enpassant = Move.colsToFiles[self.enpassantPossible[1]] + Move.rowsToRanks[self.enpassantPossible[0]] \
+            if self.enpassantPossible != () else '-'
+        return ' '.join(['/'.join(ranks), 'w' if self.whiteToMove else 'b', castling or '-', enpassant,
+                         str(self.halfmoveClock()), str((self.startPly + len(self.moveLog)) // 2 + 1)])
+
+    def halfmoveClock(self):
+        # Plies since the last capture or pawn move, for the fifty move rule
+        for i in range(len(self.moveLog) - 1, -1, -1):
+            move = self.moveLog[i]
+            if move.pieceCaptured != '--' or move.pieceMoved[1] == 'p':
+                return len(self.moveLog) - 1 - i
+        return self.startHalfmoveClock + len(self.moveLog)
+
+    # ======================================================= Binary Encoding ===========================================================
+
+    def toBytes(self):
+        # Compact fixed size encoding of the position (POSITION_BYTES bytes):
+        # 32 bytes with one 4-bit piece code per square, 1 byte of flags (side to move and
+        # castling rights) and 1 byte for the en passant square (255 if none).
+        # The move log is not encoded.
+        data = bytearray(POSITION_BYTES)
+        for r in range(8):
+            for c in range(0, 8, 2):
+                first, second = self.squares[squareIndex[r][c]], self.squares[squareIndex[r][c + 1]]
+                data[r * 4 + c // 2] = (first & TYPE_MASK | (first & BLACK) >> 1) << 4 | \
+                    second & TYPE_MASK | (second & BLACK) >> 1
+
+        castle = self.currentCastlingRight
+        data[32] = self.whiteToMove | castle.wks << 1 | castle.bks << 2 | castle.wqs << 3 | castle.bqs << 4
+        if self.enpassantPossible != ():
+            data[33] = self.enpassantPossible[0] * 8 + self.enpassantPossible[1]
+        else:
+            data[33] = 255
+        return bytes(data)
+
+    def __reduce__(self):
+        # Pickle (and so multiprocessing) sends the compact encoding instead of the full object
+        return fromBytes, (self.toBytes(),)
+
+    # ======================================================= Move From ID ==============================================================
+
+    def moveFromID(self, moveID):
+        # The Move with moveID in the current position, for code that keeps only moveIDs. moveID must be legal
+        startRow, startCol, endRow, endCol = moveID // 1000, moveID // 100 % 10, moveID // 10 % 10, moveID % 10
+        pieceType = self.squares[squareIndex[startRow][startCol]] & TYPE_MASK
+        enPassant = pieceType == PAWN and startCol != endCol and self.squares[squareIndex[endRow][endCol]] == EMPTY
+        pawnPromotion = pieceType == PAWN and endRow in (0, 7)
+        isCastleMove = pieceType == KING and abs(endCol - startCol) == 2
+        return Move((startRow, startCol), (endRow, endCol), self.squares, enPassant, pawnPromotion, isCastleMove)
+
     # ======================================================= Get Valid Moves ===========================================================
 
     def getValidMoves(self):
-        # All moves considering checks
+        # All moves considering checks. Looked up in moveCache first if there is one
+        if self.moveCache is not None:
+            entry = self.moveCache.get(self.zobristKey)
+            if entry is not None:
+                moves, self.inCheck, self.checkmate, self.stalemate = entry
+                return list(moves)  # Callers may reorder or change the list
+
+        moves = self.generateValidMoves()
+        if self.moveCache is not None:
+            self.moveCache.store(self.zobristKey, moves, self.inCheck, self.checkmate, self.stalemate)
+        return moves
+
+    def getMoveIndex(self):
+        # MoveIndex of the legal moves. Built once per position: asking again before a move is made or
+        # undone returns the same index
+        index = self.moveIndex
+        if index is None or index.key != self.zobristKey:
+            moves = self.getValidMoves()
+            index = MoveIndex(moves, self.zobristKey, self.inCheck, self.checkmate, self.stalemate)
+            self.moveIndex = index
+        else:
+            self.inCheck, self.checkmate, self.stalemate = index.inCheck, index.checkmate, index.stalemate
+        return index
+
+    def generateValidMoves(self):
+        # All moves considering checks, generated from scratch
         moves = []
         self.inCheck, self.pins, self.checks, ally = self.checkForPinsAndChecks()
         if self.whiteToMove:
@@ -202,40 +876,8 @@ class GameState():
             kingCol = self.blackKingLocation[1]
 
         if self.inCheck:
-            if len(self.checks) == 1:  # Only 1 check ; block check or move king
-                moves = self.getAllPossibleMoves()
-
-                # To block a check you must move a piece in one of the squares
-                # between the enemy and the king
-                check = self.checks[0]  # Check info
-                checkRow = check[0]
-                checkCol = check[1]
-                # Enemy piece causing the check
-                pieceChecking = self.board[checkRow][checkCol]
-                # If the checking enemy is knight the only valid move is capturing the knight
-                if pieceChecking[1] == 'N':
-                    validSquares = [(checkRow, checkCol)]
-                else:
-                    validSquares = []
-                    for i in range(1, 8):
-                        # Check 2 and 3 are the check directions
-                        validSquare = (
-                            kingRow + check[2] * i, kingCol + check[3] * i)
-                        validSquares.append(validSquare)
-                        # Once you get to the enemy piece checking
-                        if validSquare[0] == checkRow and validSquare[1] == checkCol:
-                            break
-
-                # Get rid of any moves tht dont block check. And/or move the king
-                for i in range(len(moves) - 1, -1, -1):
-                    # Move doesnt move king so it must block or capture
-                    if moves[i].pieceMoved[1] != 'K':
-                        # The move wont block check or capture the checking piece enemy
-                        if not (moves[i].endRow, moves[i].endCol) in validSquares:
-                            moves.remove(moves[i])
-
-            else:  # Double Checks! King MUST move.
-                self.getKingMoves(kingRow, kingCol, moves)
+            # Only 1 check: block check, capture the checker or move king. Double check: king must move
+            moves = self.getCheckEvasions(kingRow, kingCol)
 
         else:  # Not in check, so all moves are fine!
             moves = self.getAllPossibleMoves()
@@ -262,100 +904,224 @@ class GameState():
     def getAllPossibleMoves(self):
         # All moves without considering checks
         moves = []
-        for r in range(len(self.board)):  # number of rows
-            # number of columns in given rows
-            for c in range(len(self.board[r])):
-                turn = self.board[r][c][0]
-                if (turn == 'w' and self.whiteToMove) or (turn == 'b' and not self.whiteToMove):
-                    piece = self.board[r][c][1]
-                    # Calls the appropriate move function based on piece type
-                    self.moveFunctions[piece](r, c, moves)
+        turn = 'w' if self.whiteToMove else 'b'
+        # Only visit the squares that hold a piece of the side to move
+        for piece in ('p', 'N', 'B', 'R', 'Q', 'K'):
+            for r, c in self.pieceLocations[turn + piece]:
+                # Calls the appropriate move function based on piece type
+                self.moveFunctions[piece](r, c, moves)
 
         return moves
 
+    # ======================================================== Check Evasions =============================================================
+
+    def getCheckEvasions(self, kingRow, kingCol):
+        # Moves out of check, generated directly instead of filtering all moves. With a single check
+        # pieces may capture the checking piece or move in between it and the king, with a double check
+        # only the king moves. Pinned pieces can do neither: their pin ray only meets the check ray at the king
+        moves = []
+        if len(self.checks) == 1:
+            squares = self.squares
+            checkIndex, d = self.checks[0]
+            # Squares that stop the check: the checking piece and (except for a knight) the squares between
+            targets = {checkIndex}
+            if squares[checkIndex] & TYPE_MASK != KNIGHT:
+                square = squareIndex[kingRow][kingCol] + d
+                while square != checkIndex:
+                    targets.add(square)
+                    square += d
+
+            pinned = {pin[0] for pin in self.pins}
+            turn = 'w' if self.whiteToMove else 'b'
+            for r, c in self.pieceLocations[turn + 'p']:
+                if squareIndex[r][c] not in pinned:
+                    self.getPawnEvasions(r, c, moves, targets, checkIndex)
+            for piece in ('N', 'B', 'R', 'Q'):
+                for r, c in self.pieceLocations[turn + piece]:
+                    index = squareIndex[r][c]
+                    if index in pinned:
+                        continue
+                    if piece == 'N':
+                        steps = knightJumps
+                    else:
+                        steps = bishopDirections if piece == 'B' else rookDirections if piece == 'R' \
+                            else rookDirections + bishopDirections
+                    for dRow, dCol, step in steps:
+                        endIndex = index + step
+                        endRow = r + dRow
+                        endCol = c + dCol
+                        while True:
+                            if endIndex in targets:
+                                moves.append(Move((r, c), (endRow, endCol), squares))
+                                break  # Every square further on this ray is past the target
+                            if piece == 'N' or squares[endIndex] != EMPTY:
+                                break
+                            endIndex += step
+                            endRow += dRow
+                            endCol += dCol
+
+        self.getKingMoves(kingRow, kingCol, moves)
+        return moves
+
+    def getPawnEvasions(self, r, c, moves, targets, checkIndex):
+        # Moves of the (not pinned) pawn at row, col that end on one of targets or capture the checking
+        # piece en passant
+        squares = self.squares
+        index = squareIndex[r][c]
+        if self.whiteToMove:
+            moveAmount, startRow, backRow, enemyColor = -1, 6, 0, BLACK
+            kingRow, kingCol = self.whiteKingLocation
+        else:
+            moveAmount, startRow, backRow, enemyColor = 1, 1, 7, WHITE
+            kingRow, kingCol = self.blackKingLocation
+        forward = moveAmount * 10
+        pawnPromotion = r + moveAmount == backRow
+
+        if squares[index + forward] == EMPTY:
+            if index + forward in targets:
+                moves.append(Move((r, c), (r + moveAmount, c), squares, pawnPromotion=pawnPromotion))
+            elif r == startRow and index + 2 * forward in targets and squares[index + 2 * forward] == EMPTY:
+                moves.append(Move((r, c), (r + 2 * moveAmount, c), squares))
+
+        for side in (-1, 1):
+            endIndex = index + forward + side
+            if endIndex in targets and squares[endIndex] & enemyColor:
+                moves.append(Move((r, c), (r + moveAmount, c + side), squares, pawnPromotion=pawnPromotion))
+            elif (r + moveAmount, c + side) == self.enpassantPossible:
+                # Blocks on the landing square, or takes the pawn that gives check
+                if (endIndex in targets or index + side == checkIndex) and \
+                        not self.enpassantRevealsCheck(r, c, c + side, kingRow, kingCol, enemyColor):
+                    moves.append(Move((r, c), (r + moveAmount, c + side), squares, enPassant=True))
+
     # ======================================================== Check Pins & Checks ======================================================
 
     def checkForPinsAndChecks(self):
-        pins = []  # Squares where the allies pinned piece is and direction pinned from
-        checks = []  # Squares where enemy is applying a check
+        pins = []  # Squares where the allies pinned piece is and direction pinned from, as (index, offset)
+        checks = []  # Squares where enemy is applying a check, as (index, offset)
         inCheck = False
+        squares = self.squares
 
         if self.whiteToMove:
-            enemyColor = 'b'
-            allyColor = 'w'
+            enemyColor = BLACK
+            allyColor = WHITE
             startRow = self.whiteKingLocation[0]
             startCol = self.whiteKingLocation[1]
         else:
-            enemyColor = 'w'
-            allyColor = 'b'
+            enemyColor = WHITE
+            allyColor = BLACK
             startRow = self.blackKingLocation[0]
             startCol = self.blackKingLocation[1]
+        kingIndex = squareIndex[startRow][startCol]
 
         # Check outward from king for pins and checks and keep track of pins
-        directions = ((-1, 0), (0, -1), (1, 0), (0, 1),
-                      (-1, -1), (-1, 1), (1, -1), (1, 1))
-        for j in range(len(directions)):
-            d = directions[j]
+        for j in range(len(directionOffsets)):
+            d = directionOffsets[j]
             possiblePin = ()  # Reset possible pins
+            endIndex = kingIndex
             for i in range(1, 8):
-                endRow = startRow + d[0] * i
-                endCol = startCol + d[1] * i
-                if 0 <= endRow < 8 and 0 <= endCol < 8:
-                    endPiece = self.board[endRow][endCol]
-
-                    if endPiece[0] == allyColor and endPiece[1] != 'K':
-                        # We wrote '!= "k"' here cuz we check all possible moves of our king
-                        # by adding a phantom king (virtual move which aint showed to player)
-                        # and the phantom king checks the directions leading to it and sees the
-                        # real king which causes trouble for us!
-                        if possiblePin == ():  # 1st allied piece can be pinned
-                            possiblePin = (endRow, endCol, d[0], d[1])
-                        else:  # 2nd allied piece, so no pin or check possible in this direction
-                            break
-                    elif endPiece[0] == enemyColor:
-                        type = endPiece[1]
-                        # 5 possibilities here in this complex conditional
-                        # 1) Orthogonally away from king and piece is a rook
-                        # 2) Diagonally away from king and the piece is a bishop
-                        # 3) 1 square away from king and the piece is pawn
-                        # 4) Any direction and the piece is a queen
-                        # 5) Any direction 1 square away and piece is a king
-                        # (this is necessary for a king to prevent other kings moving to his territory)
-
-                        if (0 <= j <= 3 and type == 'R') or \
-                            (4 <= j <= 7 and type == 'B') or \
-                            (i == 1 and type == 'p' and ((enemyColor == 'w' and 6 <= j <= 7) or (enemyColor == 'b' and 4 <= j <= 5))) or \
-                            (type == 'Q') or \
-                                (i == 1 and type == 'K'):
-                            if possiblePin == ():  # No ally piece blocking the way, so check!
-                                inCheck = True
-                                checks.append((endRow, endCol, d[0], d[1]))
-                                break
+                endIndex += d
+                endPiece = squares[endIndex]
+                if endPiece == EMPTY:
+                    continue
+                if endPiece == OFFBOARD:
+                    break
 
-                            else:  # Piece blocking, so its pin.
-                                pins.append(possiblePin)
-                                break
+                if endPiece & allyColor and endPiece & TYPE_MASK != KING:
+                    # We wrote '!= KING' here cuz we check all possible moves of our king
+                    # by adding a phantom king (virtual move which aint showed to player)
+                    # and the phantom king checks the directions leading to it and sees the
+                    # real king which causes trouble for us!
+                    if possiblePin == ():  # 1st allied piece can be pinned
+                        possiblePin = (endIndex, d)
+                    else:  # 2nd allied piece, so no pin or check possible in this direction
+                        break
+                elif endPiece & enemyColor:
+                    type = endPiece & TYPE_MASK
+                    # 5 possibilities here in this complex conditional
+                    # 1) Orthogonally away from king and piece is a rook
+                    # 2) Diagonally away from king and the piece is a bishop
+                    # 3) 1 square away from king and the piece is pawn
+                    # 4) Any direction and the piece is a queen
+                    # 5) Any direction 1 square away and piece is a king
+                    # (this is necessary for a king to prevent other kings moving to his territory)
+
+                    if (0 <= j <= 3 and type == ROOK) or \
+                        (4 <= j <= 7 and type == BISHOP) or \
+                        (i == 1 and type == PAWN and ((enemyColor == WHITE and 6 <= j <= 7) or (enemyColor == BLACK and 4 <= j <= 5))) or \
+                        (type == QUEEN) or \
+                            (i == 1 and type == KING):
+                        if possiblePin == ():  # No ally piece blocking the way, so check!
+                            inCheck = True
+                            checks.append((endIndex, d))
+                            break
 
-                        else:  # Enemy piece not applying check
+                        else:  # Piece blocking, so its pin.
+                            pins.append(possiblePin)
                             break
-                else:
-                    break
+
+                    else:  # Enemy piece not applying check
+                        break
 
         # Check for knight checks
-        knightMoves = ((-2, -1), (-2, 1), (2, -1), (2, 1),
-                       (1, 2), (1, -2), (-1, 2), (-1, -2))
-        for m in knightMoves:
-            endRow = startRow + m[0]
-            endCol = startCol + m[1]
-            if 0 <= endRow < 8 and 0 <= endCol < 8:
-                endPiece = self.board[endRow][endCol]
-                # Enemy knight attacking the king
-                if endPiece[0] == enemyColor and endPiece[1] == 'N':
-                    inCheck = True
-                    checks.append((endRow, endCol, m[0], m[1]))
+        enemyKnight = enemyColor | KNIGHT
+        for m in knightJumps:
+            endIndex = kingIndex + m[2]
+            # Enemy knight attacking the king
+            if squares[endIndex] == enemyKnight:
+                inCheck = True
+                checks.append((endIndex, m[2]))
 
         return inCheck, pins, checks, (startRow, startCol)
 
+    # ======================================================== Gives Check ==============================================================
+
+    def givesCheck(self, move):
+        # True if move, of the side to move, checks the enemy king. Found without making the move: either the
+        # moved piece attacks the king from its end square or it uncovers a rook, bishop or queen behind it
+        if move.isCastleMove or move.enPassant or move.isPawnPromotion:  # Rare, so the move is just made
+            self.makeMove(move)
+            inCheck = self.checkForPinsAndChecks()[0]
+            self.undoMove()
+            return inCheck
+
+        squares = self.squares
+        kingRow, kingCol = self.blackKingLocation if self.whiteToMove else self.whiteKingLocation
+        kingIndex = squareIndex[kingRow][kingCol]
+        allyColor = move.pieceMovedCode & (WHITE | BLACK)
+        type = move.pieceMovedCode & TYPE_MASK
+
+        # Direct check from the end square
+        if type == PAWN:
+            if kingIndex - move.endIndex in ((-11, -9) if allyColor == WHITE else (9, 11)):
+                return True
+        elif type == KNIGHT:
+            if {abs(kingRow - move.endRow), abs(kingCol - move.endCol)} == {1, 2}:
+                return True
+        elif type != KING:
+            d = lineOffset(move.endRow, move.endCol, kingRow, kingCol)
+            if d != 0 and (type == QUEEN or (type == ROOK) == (d in (-10, -1, 10, 1))):
+                endIndex = move.endIndex + d
+                while endIndex != kingIndex and (squares[endIndex] == EMPTY or endIndex == move.startIndex):
+                    endIndex += d
+                if endIndex == kingIndex:
+                    return True
+
+        # Discovered check: the start square is the first piece on a line from the king, and the move leaves it
+        d = lineOffset(kingRow, kingCol, move.startRow, move.startCol)
+        if d == 0 or d == lineOffset(kingRow, kingCol, move.endRow, move.endCol):
+            return False
+        endIndex = kingIndex + d
+        while squares[endIndex] == EMPTY:
+            endIndex += d
+        if endIndex != move.startIndex:
+            return False
+        endIndex += d
+        while squares[endIndex] == EMPTY:
+            endIndex += d
+        endPiece = squares[endIndex]
+        return bool(endPiece & allyColor) and \
+            endPiece & TYPE_MASK in ((ROOK, QUEEN) if d in (-10, -1, 10, 1) else (BISHOP, QUEEN))
+
     # ======================================================== In Check =================================================================
 
     def inCheck(self):
@@ -380,19 +1146,85 @@ class GameState():
         return False
 
 
+    # ======================================================== Static Exchange Evaluation ================================================
+
+    def staticExchangeEvaluation(self, move):
+        # Material won by the side making the capture when both sides keep recapturing on the end square
+        # with their least valuable attacker, and each may stop when recapturing would lose more.
+        # Pins are ignored. In pawns, 0 for moves that don't capture anything
+        if move.pieceCapturedCode == EMPTY:
+            return 0
+        removed = {move.startIndex}
+        if move.enPassant:
+            removed.add(move.startIndex + move.endCol - move.startCol)
+
+        gain = [exchangeValues[move.pieceCapturedCode & TYPE_MASK]]
+        attackerValue = exchangeValues[QUEEN if move.isPawnPromotion else move.pieceMovedCode & TYPE_MASK]
+        color = move.pieceCapturedCode & (WHITE | BLACK)
+        while True:
+            attacker = self.getLeastValuableAttacker(move.endIndex, color, removed)
+            if attacker is None:
+                break
+            # Score if the piece on the square is captured and nothing recaptures
+            gain.append(attackerValue - gain[-1])
+            if max(-gain[-2], gain[-1]) < 0:  # Neither side can improve by going on
+                break
+            attackerValue = exchangeValues[self.squares[attacker] & TYPE_MASK]
+            removed.add(attacker)
+            color ^= WHITE | BLACK
+
+        for i in range(len(gain) - 1, 0, -1):
+            gain[i - 1] = -max(-gain[i - 1], gain[i])
+        return gain[0]
+
+    def getLeastValuableAttacker(self, target, color, removed):
+        # Index of the least valuable piece of color attacking the square at index target, pieces on removed
+        # squares are treated as gone (so pieces behind them can attack). None if there is no attacker
+        squares = self.squares
+        for d in ((9, 11) if color == WHITE else (-11, -9)):
+            if squares[target + d] == color | PAWN and target + d not in removed:
+                return target + d
+
+        for m in knightJumps:
+            if squares[target + m[2]] == color | KNIGHT and target + m[2] not in removed:
+                return target + m[2]
+
+        # First piece in every direction: bishops before rooks before queens before the king
+        best = None
+        bestValue = 1000
+        for j, d in enumerate(directionOffsets):
+            endIndex = target
+            for i in range(1, 8):
+                endIndex += d
+                endPiece = squares[endIndex]
+                if endPiece == OFFBOARD:
+                    break
+                if endPiece == EMPTY or endIndex in removed:
+                    continue
+                if endPiece & color:
+                    type = endPiece & TYPE_MASK
+                    if type == QUEEN or (type == ROOK and j <= 3) or (type == BISHOP and j >= 4) or (type == KING and i == 1):
+                        if exchangeValues[type] < bestValue:
+                            best = endIndex
+                            bestValue = exchangeValues[type]
+                break
+        return best
+
 # =========================================================== Species Moves ============================================================
 
     # -------------------------------------------------------- Pawn Moves --------------------------------------------------------
 
     def getPawnMoves(self, r, c, moves):
         # Get all pawn moves for the pawn located at row, col and add these moves to the list
+        squares = self.squares
+        index = squareIndex[r][c]
         piecePinned = False
         pinDirection = ()
 
         for i in range(len(self.pins) - 1, -1, -1):
-            if self.pins[i][0] == r and self.pins[i][1] == c:
+            if self.pins[i][0] == index:
                 piecePinned = True
-                pinDirection = (self.pins[i][2], self.pins[i][3])
+                pinDirection = self.pins[i][1]
                 self.pins.remove(self.pins[i])
                 break
 
@@ -400,224 +1232,191 @@ class GameState():
             moveAmount = -1
             startRow = 6
             backRow = 0
-            enemyColor = 'b'
+            enemyColor = BLACK
             kingRow, kingCol = self.whiteKingLocation
 
         else:
             moveAmount = 1
             startRow = 1
             backRow = 7
-            enemyColor = 'w'
+            enemyColor = WHITE
             kingRow, kingCol = self.blackKingLocation
 
+        forward = moveAmount * 10  # Offset of one square forward
         pawnPromotion = False
 
-        if self.board[r + moveAmount][c] == '--':  # 1 square move
-            if not piecePinned or pinDirection == (moveAmount, 0):
+        if squares[index + forward] == EMPTY:  # 1 square move
+            if not piecePinned or pinDirection == forward:
                 if r + moveAmount == backRow:  # if piece gets to back rank then it is a pawn promotion
                     pawnPromotion = True
                 moves.append(Move((r, c), (r + moveAmount, c),
-                             self.board, pawnPromotion=pawnPromotion))
+                             squares, pawnPromotion=pawnPromotion))
 
                 # 2 square moves
-                if r == startRow and self.board[r + 2 * moveAmount][c] == '--':
+                if r == startRow and squares[index + 2 * forward] == EMPTY:
                     moves.append(
-                        Move((r, c), (r + 2 * moveAmount, c), self.board))
-
-        if c - 1 >= 0:  # Capture to left
-            if not piecePinned or pinDirection == (moveAmount, -1):
-                if self.board[r + moveAmount][c - 1][0] == enemyColor:
-                    if r + moveAmount == backRow:  # if piece gets to back rank then it is a pawn promotion
-                        pawnPromotion = True
-                    moves.append(Move((r, c), (r + moveAmount, c - 1),
-                                 self.board, pawnPromotion=pawnPromotion))
-
-                if (r + moveAmount, c - 1) == self.enpassantPossible:
-                    attackingPiece = blockingPiece = False
-                    if kingRow == r:  # Solving the weird enpassant bug
-                        if kingCol < c:  # king is on the left of the pawn
-                            # inside range between the king and the pawn; outside range between pawn border
-                            insideRange = range(kingCol + 1, c - 1)
-                            outsideRange = range(c + 1, 8)
-                        else:  # King right of pawn
-                            insideRange = range(kingCol - 1, c, -1)
-                            outsideRange = range(c - 2, -1, -1)
-
-                        for i in insideRange:
-                            # Some other piece beside enpassant pawn blocks
-                            if self.board[r][i] != '--':
-                                blockingPiece = True
-                        for i in outsideRange:
-                            square = self.board[r][i]
-                            # Attacking Piece
-                            if square[0] == enemyColor and (square[1] == 'R' or square[1] == 'Q'):
-                                attackingPiece = True
-                            elif square != '--':
-                                blockingPiece = True
-                    if not attackingPiece or blockingPiece:
-                        moves.append(
-                            Move((r, c), (r + moveAmount, c - 1), self.board, enPassant=True))
-
-        if c + 1 <= 7:  # Capture to right
-            if not piecePinned or pinDirection == (moveAmount, 1):
-                if self.board[r + moveAmount][c + 1][0] == enemyColor:
-                    if r + moveAmount == backRow:  # if piece gets to back rank then it is a pawn promotion
-                        pawnPromotion = True
-                    moves.append(Move((r, c), (r + moveAmount, c + 1),
-                                 self.board, pawnPromotion=pawnPromotion))
-
-                if (r + moveAmount, c + 1) == self.enpassantPossible:
-                    attackingPiece = blockingPiece = False
-                    if kingRow == r:  # Solving the weird enpassant bug
-                        if kingCol < c:  # king is on the left of the pawn
-                            # inside range between the king and the pawn; outside range between pawn border
-                            insideRange = range(kingCol + 1, c)
-                            outsideRange = range(c + 2, 8)
-                        else:  # King right of pawn
-                            insideRange = range(kingCol - 1, c + 1, -1)
-                            outsideRange = range(c - 1, -1, -1)
-
-                        for i in insideRange:
-                            # Some other piece beside enpassant pawn blocks
-                            if self.board[r][i] != '--':
-                                blockingPiece = True
-                        for i in outsideRange:
-                            square = self.board[r][i]
-                            # Attacking Piece
-                            if square[0] == enemyColor and (square[1] == 'R' or square[1] == 'Q'):
-                                attackingPiece = True
-                            elif square != '--':
-                                blockingPiece = True
-                    if not attackingPiece or blockingPiece:
-                        moves.append(
-                            Move((r, c), (r + moveAmount, c + 1), self.board, enPassant=True))
+                        Move((r, c), (r + 2 * moveAmount, c), squares))
+
+        # Capture to left; off the board when c == 0, which is never an enemy or the enpassant square
+        if not piecePinned or pinDirection == forward - 1:
+            if squares[index + forward - 1] & enemyColor:
+                if r + moveAmount == backRow:  # if piece gets to back rank then it is a pawn promotion
+                    pawnPromotion = True
+                moves.append(Move((r, c), (r + moveAmount, c - 1),
+                             squares, pawnPromotion=pawnPromotion))
+
+            if (r + moveAmount, c - 1) == self.enpassantPossible:
+                if not self.enpassantRevealsCheck(r, c, c - 1, kingRow, kingCol, enemyColor):
+                    moves.append(
+                        Move((r, c), (r + moveAmount, c - 1), squares, enPassant=True))
+
+        # Capture to right
+        if not piecePinned or pinDirection == forward + 1:
+            if squares[index + forward + 1] & enemyColor:
+                if r + moveAmount == backRow:  # if piece gets to back rank then it is a pawn promotion
+                    pawnPromotion = True
+                moves.append(Move((r, c), (r + moveAmount, c + 1),
+                             squares, pawnPromotion=pawnPromotion))
+
+            if (r + moveAmount, c + 1) == self.enpassantPossible:
+                if not self.enpassantRevealsCheck(r, c, c + 1, kingRow, kingCol, enemyColor):
+                    moves.append(
+                        Move((r, c), (r + moveAmount, c + 1), squares, enPassant=True))
+
+    def enpassantRevealsCheck(self, r, c, captureCol, kingRow, kingCol, enemyColor):
+        # Solving the weird enpassant bug: capturing en passant takes two pawns off row r at once, which
+        # can open the row between the king and an enemy rook or queen
+        if kingRow != r:
+            return False
+        squares = self.squares
+        rowStart = squareIndex[r][0]
+        left, right = min(c, captureCol), max(c, captureCol)
+        if kingCol < left:  # king is on the left of the pawns
+            # inside range between the king and the pawns; outside range between pawns and border
+            insideRange = range(kingCol + 1, left)
+            outsideRange = range(right + 1, 8)
+        else:  # King right of pawns
+            insideRange = range(kingCol - 1, right, -1)
+            outsideRange = range(left - 1, -1, -1)
+
+        for i in insideRange:
+            # Some other piece beside the pawns blocks
+            if squares[rowStart + i] != EMPTY:
+                return False
+        for i in outsideRange:
+            square = squares[rowStart + i]
+            if square != EMPTY:  # First piece past the pawns: attacking if it is an enemy rook or queen
+                return square == enemyColor | ROOK or square == enemyColor | QUEEN
+        return False
+
+    # -------------------------------------------------------- Sliding Moves --------------------------------------------------------
+
+    def getSlidingMoves(self, r, c, moves, directions, pinDirection):
+        # Add the moves of a rook or bishop at row, col along directions, (dRow, dCol, offset) tuples.
+        # A pinned piece only moves along its pinDirection (either way), () if it is not pinned
+        squares = self.squares
+        index = squareIndex[r][c]
+        enemyColor = BLACK if self.whiteToMove else WHITE
+        for dRow, dCol, d in directions:
+            if pinDirection != () and pinDirection != d and pinDirection != -d:
+                continue
+            endRow = r + dRow
+            endCol = c + dCol
+            endIndex = index + d
+            while True:
+                endPiece = squares[endIndex]
+                if endPiece == EMPTY:  # Empty space valid
+                    moves.append(
+                        Move((r, c), (endRow, endCol), squares))
+                elif endPiece & enemyColor:  # Enemy piece valid
+                    moves.append(
+                        Move((r, c), (endRow, endCol), squares))
+                    break
+                else:  # Friendly piece or off board invalid
+                    break
+                endRow += dRow
+                endCol += dCol
+                endIndex += d
 
     # -------------------------------------------------------- Rook Moves --------------------------------------------------------
 
     def getRookMoves(self, r, c, moves):
         # Get all Rook moves for the Rook located at row, col and add these moves to the list
-        piecePinned = False
+        index = squareIndex[r][c]
         pinDirection = ()
 
         for i in range(len(self.pins) - 1, -1, -1):
-            if self.pins[i][0] == r and self.pins[i][1] == c:
-                piecePinned = True
-                pinDirection = (self.pins[i][2], self.pins[i][3])
-                if self.board[r][c][1] != 'Q':  # Cant remove queen from pin on rook moves,
+            if self.pins[i][0] == index:
+                pinDirection = self.pins[i][1]
+                if self.squares[index] & TYPE_MASK != QUEEN:  # Cant remove queen from pin on rook moves,
                     # only remove it on bishop moves
                     self.pins.remove(self.pins[i])
                 break
 
         # Up , Left, Down, Right
-        directions = ((-1, 0), (0, -1), (1, 0), (0, 1))
-        enemyColor = 'b' if self.whiteToMove else 'w'
-        for d in directions:
-            for i in range(1, 8):
-                endRow = r + d[0] * i
-                endCol = c + d[1] * i
-                if 0 <= endRow < 8 and 0 <= endCol < 8:  # On board
-                    if not piecePinned or pinDirection == d or pinDirection == (-d[0], -d[1]):
-                        endPiece = self.board[endRow][endCol]
-                        if endPiece == '--':  # Empty space valid
-                            moves.append(
-                                Move((r, c), (endRow, endCol), self.board))
-                        elif endPiece[0] == enemyColor:  # Enemy piece valid
-                            moves.append(
-                                Move((r, c), (endRow, endCol), self.board))
-                            break
-
-                        else:  # Friendly piece invalid
-                            break
-                else:  # Off board
-                    break
+        self.getSlidingMoves(r, c, moves, rookDirections, pinDirection)
 
     # -------------------------------------------------------- Bishop Moves --------------------------------------------------------
     def getBishopMoves(self, r, c, moves):
         # Get all Bishop moves for the Bishop located at row, col and add these moves to the list
-        piecePinned = False
+        index = squareIndex[r][c]
         pinDirection = ()
 
         for i in range(len(self.pins) - 1, -1, -1):
-            if self.pins[i][0] == r and self.pins[i][1] == c:
-                piecePinned = True
-                pinDirection = (self.pins[i][2], self.pins[i][3])
+            if self.pins[i][0] == index:
+                pinDirection = self.pins[i][1]
                 self.pins.remove(self.pins[i])
                 break
 
-        directions = ((-1, -1), (1, 1), (1, -1), (-1, 1))  # 4 diaganols
-        enemyColor = 'b' if self.whiteToMove else 'w'
-        for d in directions:
-            for i in range(1, 8):  # Can move maximumly 7 squares
-                endRow = r + d[0] * i
-                endCol = c + d[1] * i
-                if 0 <= endRow < 8 and 0 <= endCol < 8:  # Is the end-point on the board?
-                    if not piecePinned or pinDirection == d or pinDirection == (-d[0], -d[1]):
-                        endPiece = self.board[endRow][endCol]
-                        if endPiece == '--':  # Empty Space Valid
-                            moves.append(
-                                Move((r, c), (endRow, endCol), self.board))
-                        elif endPiece[0] == enemyColor:  # Enemy color Valid
-                            moves.append(
-                                Move((r, c), (endRow, endCol), self.board))
-                            break
-                        else:  # Friendly Piece Invalid
-                            break
-                else:  # Off Board
-                    break
+        # 4 diaganols
+        self.getSlidingMoves(r, c, moves, bishopDirections, pinDirection)
 
     # -------------------------------------------------------- Knight Moves --------------------------------------------------------
     def getKnightMoves(self, r, c, moves):
         # Get all Knight moves for the Knight located at row, col and add these moves to the list
-        piecePinned = False
+        squares = self.squares
+        index = squareIndex[r][c]
         for i in range(len(self.pins) - 1, -1, -1):
-            if self.pins[i][0] == r and self.pins[i][1] == c:
-                piecePinned = True
+            if self.pins[i][0] == index:
                 self.pins.remove(self.pins[i])
-                break
+                return  # A pinned knight can't move
 
-        knightMoves = ((-2, -1), (-2, 1), (2, -1), (2, 1),
-                       (1, 2), (1, -2), (-1, 2), (-1, -2))
-        allyColor = 'w' if self.whiteToMove else 'b'
-        for m in knightMoves:
-            endRow = r + m[0]
-            endCol = c + m[1]
-            if 0 <= endRow < 8 and 0 <= endCol < 8:
-                if not piecePinned:
-                    endPiece = self.board[endRow][endCol]
-                    # Not an ally piece (empty or enemy piece)
-                    if endPiece[0] != allyColor:
-                        moves.append(
-                            Move((r, c), (endRow, endCol), self.board))
+        allyColor = WHITE if self.whiteToMove else BLACK
+        for dRow, dCol, d in knightJumps:
+            endPiece = squares[index + d]
+            # Not an ally piece (empty or enemy piece) and on the board
+            if endPiece != OFFBOARD and not endPiece & allyColor:
+                moves.append(
+                    Move((r, c), (r + dRow, c + dCol), squares))
 
     # -------------------------------------------------------- King Moves --------------------------------------------------------
     def getKingMoves(self, r, c, moves):
         # Get all King moves for the King located at row, col and add these moves to the list
-        kingMoves = ((0, 1), (0, -1), (1, 0), (-1, 0),
-                     (-1, 1), (-1, -1), (1, 1), (1, -1))
-        allyColor = 'w' if self.whiteToMove else 'b'
-        for i in range(8):
-            endRow = r + kingMoves[i][0]
-            endCol = c + kingMoves[i][1]
-            if 0 <= endRow < 8 and 0 <= endCol < 8:  # Target place on the board
-                endPiece = self.board[endRow][endCol]
-
-                if endPiece[0] != allyColor:    # Target place either empty or enemy on it
-                    # Place king on target square and check for checks
-                    if allyColor == 'w':
-                        self.whiteKingLocation = (endRow, endCol)
-                    else:
-                        self.blackKingLocation = (endRow, endCol)
-                    inCheck, pins, checks, ally = self.checkForPinsAndChecks()
+        squares = self.squares
+        index = squareIndex[r][c]
+        allyColor = WHITE if self.whiteToMove else BLACK
+        for dRow, dCol, d in kingSteps:
+            endPiece = squares[index + d]
+            # Target place on the board and either empty or enemy on it
+            if endPiece != OFFBOARD and not endPiece & allyColor:
+                endRow = r + dRow
+                endCol = c + dCol
+                # Place king on target square and check for checks
+                if allyColor == WHITE:
+                    self.whiteKingLocation = (endRow, endCol)
+                else:
+                    self.blackKingLocation = (endRow, endCol)
+                inCheck, pins, checks, ally = self.checkForPinsAndChecks()
 
-                    if not inCheck:
-                        moves.append(
-                            Move((r, c), (endRow, endCol), self.board))
+                if not inCheck:
+                    moves.append(
+                        Move((r, c), (endRow, endCol), squares))
 
-                    # Place king back on its own location
-                    if allyColor == 'w':
-                        self.whiteKingLocation = (r, c)
-                    else:
-                        self.blackKingLocation = (r, c)
+                # Place king back on its own location
+                if allyColor == WHITE:
+                    self.whiteKingLocation = (r, c)
+                else:
+                    self.blackKingLocation = (r, c)
 
     # -------------------------------------------------------- Queen Moves --------------------------------------------------------
     def getQueenMoves(self, r, c, moves):
@@ -639,17 +1438,19 @@ class GameState():
             self.getQueensideCastleMoves(r, c, moves, allyColor)
 
     def getKingsideCastleMoves(self, r, c, moves, allyColor):
-        if self.board[r][c + 1] == '--' and self.board[r][c + 2] == '--':
+        index = squareIndex[r][c]
+        if self.squares[index + 1] == EMPTY and self.squares[index + 2] == EMPTY:
             if not self.squareUnderAttack(r, c + 1) and not self.squareUnderAttack(r, c + 2):
                 moves.append(
-                    Move((r, c), (r, c + 2), self.board, isCastleMove=True))
+                    Move((r, c), (r, c + 2), self.squares, isCastleMove=True))
             pass
 
     def getQueensideCastleMoves(self, r, c, moves, allyColor):
-        if self.board[r][c - 1] == '--' and self.board[r][c - 2] == '--' and self.board[r][c - 3] == '--':
+        index = squareIndex[r][c]
+        if self.squares[index - 1] == EMPTY and self.squares[index - 2] == EMPTY and self.squares[index - 3] == EMPTY:
             if not self.squareUnderAttack(r, c - 1) and not self.squareUnderAttack(r, c - 2):
                 moves.append(
-                    Move((r, c), (r, c - 2), self.board, isCastleMove=True))
+                    Move((r, c), (r, c - 2), self.squares, isCastleMove=True))
 
 
 class Move():
@@ -664,14 +1465,20 @@ class Move():
     colsToFiles = {v: k for k, v in filesToCols.items()}
 
     def __init__(self, startSq, endSq, board, enPassant=False, pawnPromotion=False, isCastleMove=False):
+        # board is GameState.squares (or GameState.board)
+        squares = board.squares if isinstance(board, BoardView) else board
         self.startSq = startSq
         self.endSq = endSq
         self.startRow = int(startSq[0])
         self.startCol = int(startSq[1])
         self.endRow = int(endSq[0])
         self.endCol = int(endSq[1])
-        self.pieceMoved = board[self.startRow][self.startCol]
-        self.pieceCaptured = board[self.endRow][self.endCol]
+        self.startIndex = 21 + self.startRow * 10 + self.startCol
+        self.endIndex = 21 + self.endRow * 10 + self.endCol
+        self.pieceMovedCode = squares[self.startIndex]
+        self.pieceCapturedCode = squares[self.endIndex]
+        self.pieceMoved = pieceNames[self.pieceMovedCode]
+        self.pieceCaptured = pieceNames[self.pieceCapturedCode]
         self.pawnPromotion = pawnPromotion
         self.moveID = self.startRow * 1000 + self.startCol * \
             100 + self.endRow * 10 + self.endCol
@@ -679,13 +1486,15 @@ class Move():
 
         # Pawn promotion
         self.isPawnPromotion = False
-        if (self.pieceMoved == 'wp' and self.endRow == 0) or (self.pieceMoved == 'bp' and self.endRow == 7):
+        if (self.pieceMovedCode == WHITE | PAWN and self.endRow == 0) or \
+                (self.pieceMovedCode == BLACK | PAWN and self.endRow == 7):
             self.isPawnPromotion = True
 
         # Enpassant
         self.enPassant = enPassant
         if self.enPassant:
-            self.pieceCaptured = 'wp' if self.pieceMoved == 'bp' else 'bp'
+            self.pieceCapturedCode = self.pieceMovedCode ^ (WHITE | BLACK)  # Pawn of the other colour
+            self.pieceCaptured = pieceNames[self.pieceCapturedCode]
 
     def __eq__(self, other):
         if isinstance(other, Move):
@@ -707,3 +1516,7 @@ class CastleRights():
         self.bks = bks
         self.wqs = wqs
         self.bqs = bqs
+
+    def index(self):
+        # Number from 0 to 15 for the combination of rights
+        return self.wks | self.bks << 1 | self.wqs << 2 | self.bqs << 3
@@ -0,0 +1,354 @@
+"""
+Monte Carlo tree search (PUCT) over GameState, an alternative to the
+alpha-beta searches of ChessAI.
+The tree grows by one position per descent. Every descent picks the child
+with the best Q + U, where Q is the average value of the child and
+U = EXPLORATION * prior * sqrt(parent visits) / (1 + child visits), so moves
+with a high prior and few visits are tried first. The priors come from the
+same move ordering ideas as the alpha-beta search: winning captures,
+promotions and checks.
+Nodes live in NumPy arrays, the children of a node next to each other, so a
+node costs a few dozen bytes and a child is picked with a few vector
+operations. Leaves are evaluated in batches: BATCH_SIZE descents are made
+one after the other, each adding a virtual loss to the nodes on its path
+so the next one goes somewhere else, and then all the leaf positions are
+handed to the evaluator at once. An evaluator is any function from a list
+of positions (GameState.toBytes) to their scores in pawns for the side to
+move, for example the NNUE batch evaluation or a pool of processes.
+The search stops after its time limit or node budget and can be stopped
+between any two batches, the most visited root move is the best move.
+    python ChessMCTS.py "FEN" --time 5 --workers 4
+"""
+import argparse
+import math
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import ChessAI
+import ChessEngine
+import ChessNNUE
+
+
+TIME_LIMIT = 5  # Seconds per move
+BATCH_SIZE = 16  # Leaves evaluated at a time
+EXPLORATION = 1.5
+VIRTUAL_LOSS = 1  # Losses added to every node on the path of a leaf waiting for its value
+FPU_REDUCTION = 0.2  # Unvisited children count as this much worse than their parent
+VALUE_SCALE = 2  # Scores in pawns become values in -1..1 as tanh(score / VALUE_SCALE)
+INITIAL_NODES = 1 << 14
+
+# Move priors: softmax over a score in pawns
+CHECK_PRIOR = 1
+PROMOTION_PRIOR = 8
+
+# Node states
+UNEXPANDED = 0
+EXPANDED = 1
+MATED = 2  # Side to move is checkmated
+DRAWN = 3  # Stalemate
+
+
+class Tree():
+    """
+    Search tree in arrays indexed by node number, node 0 is the root. The
+    children of a node are numChildren consecutive nodes from firstChild.
+    valueSum is from the view of the side that made the move to the node.
+    """
+
+    def __init__(self, capacity=INITIAL_NODES):
+        self.size = 1
+        self.moveID = np.zeros(capacity, np.int32)  # Move from the parent
+        self.prior = np.ones(capacity, np.float32)
+        self.visits = np.zeros(capacity, np.int32)
+        self.valueSum = np.zeros(capacity, np.float64)
+        self.virtualLoss = np.zeros(capacity, np.int32)
+        self.firstChild = np.zeros(capacity, np.int32)
+        self.numChildren = np.zeros(capacity, np.int32)
+        self.state = np.zeros(capacity, np.int8)
+
+    def addChildren(self, node, moveIDs, priors):
+        first = self.size
+        if first + len(moveIDs) > len(self.visits):
+            self.grow(2 * (first + len(moveIDs)))
+        self.size += len(moveIDs)
+        self.moveID[first:self.size] = moveIDs
+        self.prior[first:self.size] = priors
+        self.firstChild[node] = first
+        self.numChildren[node] = len(moveIDs)
+        self.state[node] = EXPANDED
+
+    def grow(self, capacity):
+        for name in ("moveID", "prior", "visits", "valueSum", "virtualLoss", "firstChild", "numChildren", "state"):
+            array = getattr(self, name)
+            grown = np.zeros(capacity, array.dtype)
+            grown[:len(array)] = array
+            setattr(self, name, grown)
+
+    def children(self, node):
+        return range(self.firstChild[node], self.firstChild[node] + self.numChildren[node])
+
+
+class MCTS():
+    """
+    Searches the position gs is in when it is created. gs is used for the
+    descents and is back in that position after every batch.
+    """
+
+    def __init__(self, gs, evaluator=None, batchSize=BATCH_SIZE):
+        self.gs = gs
+        self.evaluator = evaluator if evaluator is not None else staticEvaluator
+        self.batchSize = batchSize
+        self.tree = Tree()
+        self.nodes = 0  # Leaves evaluated, mates and stalemates included
+
+    def search(self, timeLimit=TIME_LIMIT, maxNodes=None):
+        """
+        Runs batches until timeLimit seconds have passed or maxNodes leaves were evaluated
+        """
+        startTime = time.perf_counter()
+        # The same positions are reached by many descents, so their legal moves are looked up instead of generated
+        moveCache = self.gs.moveCache
+        if moveCache is None:
+            self.gs.moveCache = ChessEngine.MoveCache()
+        try:
+            while time.perf_counter() - startTime < timeLimit and (maxNodes is None or self.nodes < maxNodes):
+                self.runBatch()
+                if self.tree.state[0] != EXPANDED:  # No legal moves at the root
+                    break
+        finally:
+            self.gs.moveCache = moveCache
+
+    def runBatch(self):
+        gs = self.gs
+        tree = self.tree
+        paths = []
+        positions = []
+        for i in range(self.batchSize):
+            path = self.selectLeaf()
+            leaf = path[-1]
+            if tree.state[leaf] == UNEXPANDED:
+                self.expand(leaf)
+            if tree.state[leaf] == EXPANDED:
+                paths.append(path)
+                positions.append(gs.toBytes())
+            else:  # Mate or stalemate: the value is known without the evaluator
+                self.backup(path, -1 if tree.state[leaf] == MATED else 0)
+            for j in range(len(path) - 1):
+                gs.undoMove()
+
+        if positions:
+            scores = self.evaluator(positions)
+            for path, score in zip(paths, scores):
+                self.backup(path, math.tanh(score / VALUE_SCALE))
+
+    # ======================================================== Descent =================================================================
+
+    def selectLeaf(self):
+        # Walks from the root to a node that isn't expanded yet (or has no moves), making the moves on gs and
+        # adding a virtual loss to every node on the way. Returns the path of nodes
+        gs = self.gs
+        tree = self.tree
+        node = 0
+        path = [0]
+        tree.virtualLoss[0] += VIRTUAL_LOSS
+        while tree.state[node] == EXPANDED:
+            node = self.selectChild(node)
+            gs.makeMove(gs.moveFromID(int(tree.moveID[node])))
+            path.append(node)
+            tree.virtualLoss[node] += VIRTUAL_LOSS
+        return path
+
+    def selectChild(self, node):
+        tree = self.tree
+        first = tree.firstChild[node]
+        last = first + tree.numChildren[node]
+        virtualLoss = tree.virtualLoss[first:last]
+        visits = tree.visits[first:last] + virtualLoss
+        parentVisits = tree.visits[node] + tree.virtualLoss[node]
+        # The parent's value is from the other side's view
+        parentValue = -tree.valueSum[node] / tree.visits[node] if tree.visits[node] > 0 else 0
+        q = np.where(visits > 0, (tree.valueSum[first:last] - virtualLoss) / np.maximum(visits, 1),
+                     parentValue - FPU_REDUCTION)
+        u = EXPLORATION * tree.prior[first:last] * math.sqrt(parentVisits) / (1 + visits)
+        return first + int(np.argmax(q + u))
+
+    def expand(self, node):
+        gs = self.gs
+        moves = gs.getValidMoves()
+        if len(moves) == 0:
+            self.tree.state[node] = MATED if gs.inCheck else DRAWN
+            return
+        self.tree.addChildren(node, [move.moveID for move in moves], movePriors(gs, moves))
+
+    def backup(self, path, value):
+        # value is from the view of the side to move at the leaf
+        tree = self.tree
+        for node in reversed(path):
+            value = -value
+            tree.visits[node] += 1
+            tree.valueSum[node] += value
+            tree.virtualLoss[node] -= VIRTUAL_LOSS
+        self.nodes += 1
+
+    # ======================================================== Results =================================================================
+
+    def rootMoves(self):
+        """
+        [(move, visits, score)] of the root moves, most visited first. score is
+        in pawns for the side to move, None for moves that weren't visited
+        """
+        tree = self.tree
+        results = []
+        for child in tree.children(0):
+            visits = int(tree.visits[child])
+            score = None
+            if visits > 0:
+                value = min(max(tree.valueSum[child] / visits, -0.999), 0.999)
+                score = VALUE_SCALE * math.atanh(value)
+            results.append((self.gs.moveFromID(int(tree.moveID[child])), visits, score))
+        results.sort(key=lambda result: result[1], reverse=True)
+        return results
+
+    def principalVariation(self, maxLength=10):
+        # Most visited moves from the root
+        gs = self.gs
+        tree = self.tree
+        node = 0
+        pv = []
+        while tree.state[node] == EXPANDED and len(pv) < maxLength:
+            node = max(tree.children(node), key=lambda child: tree.visits[child])
+            if tree.visits[node] == 0:
+                break
+            move = gs.moveFromID(int(tree.moveID[node]))
+            pv.append(move)
+            gs.makeMove(move)
+        for i in range(len(pv)):
+            gs.undoMove()
+        return pv
+
+
+def movePriors(gs, moves):
+    """
+    Prior of every move: a softmax over the material the move wins by static
+    exchange evaluation plus bonuses for promotions and checks
+    """
+    scores = []
+    for move in moves:
+        score = gs.staticExchangeEvaluation(move) if move.pieceCaptured != '--' else 0
+        if move.isPawnPromotion:
+            score += PROMOTION_PRIOR
+        if gs.givesCheck(move):
+            score += CHECK_PRIOR
+        scores.append(score)
+    scores = np.array(scores, np.float32)
+    priors = np.exp(scores - scores.max())
+    return priors / priors.sum()
+
+# ======================================================== Evaluators ==================================================================
+
+
+def staticEvaluator(positions):
+    """
+    ChessAI.scoreBoard of every position. Tactics are left to the search
+    """
+    scores = []
+    for data in positions:
+        gs = ChessEngine.fromBytes(data)
+        scores.append(ChessAI.scoreBoard(gs) if gs.whiteToMove else -ChessAI.scoreBoard(gs))
+    return scores
+
+
+def quiescenceEvaluator(positions):
+    """
+    Static score after a capture-only search, so leaves don't hang pieces
+    """
+    scores = []
+    for data in positions:
+        gs = ChessEngine.fromBytes(data)
+        turnMultiplier = 1 if gs.whiteToMove else -1
+        scores.append(ChessAI.quiescence(gs, gs.getValidMoves(), -ChessAI.CHECKMATE, ChessAI.CHECKMATE, turnMultiplier))
+    return scores
+
+
+class NNUEEvaluator():
+    """
+    The whole batch through ChessNNUE.evaluateBatch. Only the path is pickled,
+    so it can be used in worker processes too
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.network = None
+
+    def __reduce__(self):
+        return NNUEEvaluator, (self.path,)
+
+    def __call__(self, positions):
+        if self.network is None:
+            self.network = ChessNNUE.Network(self.path)
+        states = [ChessEngine.fromBytes(data) for data in positions]
+        scores = ChessNNUE.evaluateBatch(self.network, states)
+        return [score if gs.whiteToMove else -score for score, gs in zip(scores, states)]
+
+
+class ParallelEvaluator():
+    """
+    Splits every batch between worker processes running evaluator
+    """
+
+    def __init__(self, evaluator=staticEvaluator, workers=2):
+        self.evaluator = evaluator
+        self.workers = workers
+        self.pool = ProcessPoolExecutor(workers)
+
+    def __call__(self, positions):
+        size = -(-len(positions) // self.workers)
+        chunks = [positions[i:i + size] for i in range(0, len(positions), size)]
+        return [score for scores in self.pool.map(self.evaluator, chunks) for score in scores]
+
+    def close(self):
+        self.pool.shutdown()
+
+
+def findBestMoveMCTS(gs, validMoves, timeLimit=TIME_LIMIT, evaluator=None, batchSize=BATCH_SIZE):
+    """
+    Most visited root move after searching for timeLimit seconds, None if there are no moves
+    """
+    if len(validMoves) == 0:
+        return None
+    search = MCTS(gs, evaluator, batchSize)
+    search.search(timeLimit)
+    return search.rootMoves()[0][0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Search positions with Monte Carlo tree search")
+    parser.add_argument("fen", nargs="+")
+    parser.add_argument("--time", type=float, default=TIME_LIMIT, help="Seconds per position")
+    parser.add_argument("--nodes", type=int, help="Leaves evaluated per position")
+    parser.add_argument("--batch", type=int, default=BATCH_SIZE)
+    parser.add_argument("--network", help="Evaluate with this NNUE network file")
+    parser.add_argument("--quiescence", action="store_true", help="Evaluate leaves with a capture search")
+    parser.add_argument("--workers", type=int, default=0, help="Evaluate batches in this many processes")
+    args = parser.parse_args()
+
+    evaluator = staticEvaluator
+    if args.network:
+        evaluator = NNUEEvaluator(args.network)
+    elif args.quiescence:
+        evaluator = quiescenceEvaluator
+    if args.workers > 0:
+        evaluator = ParallelEvaluator(evaluator, args.workers)
+    try:
+        for fen in args.fen:
+            search = MCTS(ChessEngine.fromFEN(fen), evaluator, args.batch)
+            startTime = time.perf_counter()
+            search.search(args.time, args.nodes)
+            seconds = time.perf_counter() - startTime
+            print("%s: %d nodes in %.2fs (%d nodes/s)" % (fen, search.nodes, seconds, search.nodes / max(seconds, 1e-9)))
+            for move, visits, score in search.rootMoves()[:5]:
+                print("  %s %6d %s" % (move.getChessNotation(), visits, "%+.2f" % score if score is not None else ""))
+            print("  pv " + " ".join(move.getChessNotation() for move in search.principalVariation()))
+    finally:
+        if isinstance(evaluator, ParallelEvaluator):
+            evaluator.close()
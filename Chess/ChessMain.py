@@ -11,6 +11,14 @@ DIMENSION = 8  # Dimension of chess board (8x8)
 SQ_SIZE = HEIGHT // DIMENSION
 MAX_FPS = 15  # For Animation
 IMAGES = {}
+HIGHLIGHTS = {}  # Transparent squares for the selected square and its moves
+TEXTS = {}  # Rendered game over texts
+BOARD_SURFACE = None  # Board squares drawn once, blitted instead of 64 rects
+FONT = None
+
+# What was drawn on each square in the last frame: (row, col) -> (piece, highlight)
+# Only squares that changed since then are repainted.
+lastFrame = {}
 
 
 def load_images():
@@ -31,6 +39,35 @@ def load_images():
         # We can access image by saying IMAGES['wp']
 
 
+def load_surfaces():
+    """
+    Pre-render the board background and the highlight squares.
+    Called exactly once in the main, after the display is created.
+    """
+    global colors, BOARD_SURFACE
+    colors = [pygame.Color("white"), pygame.Color("gray")]
+
+    BOARD_SURFACE = pygame.Surface((WIDTH, HEIGHT)).convert()
+    for row in range(DIMENSION):
+        for col in range(DIMENSION):
+            pygame.draw.rect(
+                BOARD_SURFACE,
+                colors[(row + col) % 2],
+                pygame.Rect(
+                    col * SQ_SIZE,
+                    row * SQ_SIZE,
+                    SQ_SIZE,
+                    SQ_SIZE
+                )
+            )
+
+    for name, color in (("selected", "blue"), ("move", "yellow")):
+        s = pygame.Surface((SQ_SIZE, SQ_SIZE))
+        s.set_alpha(100)
+        s.fill(pygame.Color(color))
+        HIGHLIGHTS[name] = s
+
+
 def main():
     """
     main driver of code. 
@@ -40,14 +77,20 @@ def main():
     screen = pygame.display.set_mode((WIDTH, HEIGHT))
     clock = pygame.time.Clock()
     screen.fill(pygame.Color('white'))
+    # Legal moves of positions seen before (after undo, or in the AI search) are looked up, not generated
+    moveCache = ChessEngine.MoveCache()
     gs = ChessEngine.GameState()
-    validMoves = gs.getValidMoves()
+    gs.moveCache = moveCache
+    # Legal moves by square, for finding the move of a click and the squares to highlight
+    moveIndex = gs.getMoveIndex()
+    validMoves = list(moveIndex.moves)
     moveMade = False  # Flag variable when move is made
 
     animate = False  # Flag varible for animating the move
 
     # print(gs.board)
     load_images()
+    load_surfaces()
     running = True
     sq_selected = ()  # No Square is selected, keep track of last click
     player_clicks = []
@@ -58,11 +101,20 @@ def main():
     playerOne = False  # if Human is playing white then true
     playerTwo = True  # if Human is playing black then true
 
+    # Only clicks, keys and window events change what is drawn
+    pygame.event.set_blocked(pygame.MOUSEMOTION)
+
     while running:
         humanTurn = (gs.whiteToMove and playerOne) or\
             (not gs.whiteToMove and playerTwo)
 
-        for e in pygame.event.get():
+        events = pygame.event.get()
+        if not events and (humanTurn or gameOver) and lastFrame:
+            # Nothing on screen changes until the next event, so sleep until then instead of
+            # checking the same frame MAX_FPS times a second
+            events = [pygame.event.wait()]
+
+        for e in events:
             if e.type == pygame.QUIT:
                 running = False
             elif e.type == pygame.MOUSEBUTTONDOWN:
@@ -79,37 +131,37 @@ def main():
                         # Append for two clicks
                         player_clicks.append(sq_selected)
                     if len(player_clicks) == 2:  # After 2nd Click
-                        move = ChessEngine.Move(
-                            player_clicks[0],
-                            player_clicks[1],
-                            gs.board
-                        )
-                        for i in range(len(validMoves)):
-
-                            if move == validMoves[i]:
-                                # if not move.isEnpassantMove == validMoves[i].isEnpassantMove:
-                                #     move.isEnpassantMove = validMoves[i].isEnpassantMove
-                                # print(move.isEnpassantMove == validMoves[i].isEnpassantMove)
-                                print(validMoves[i].getChessNotation())
-                                gs.makeMove(validMoves[i])
-                                moveMade = True
-                                animate = True
-                                # reset user clicks
-                                sq_selected = ()
-                                player_clicks = []
+                        move = moveIndex.findMove(player_clicks[0], player_clicks[1])
+                        if move is not None:
+                            print(move.getChessNotation())
+                            gs.makeMove(move)
+                            moveMade = True
+                            animate = True
+                            # reset user clicks
+                            sq_selected = ()
+                            player_clicks = []
                         if not moveMade:
                             player_clicks = [sq_selected]
 
             elif e.type == pygame.KEYDOWN:  # Key Handler
                 if e.key == pygame.K_z:
-                    # undo move when 'z' is pressed
-                    gs.undoMove()
+                    # undo move when 'z' is pressed, it can be made again with 'y'
+                    if len(gs.moveLog) > 0:
+                        gs.seek(len(gs.moveLog) - 1)
                     moveMade = True
                     animate = False
+                if e.key == pygame.K_y:
+                    # redo the last undone move when 'y' is pressed
+                    if gs.redoMove() is not None:
+                        moveMade = True
+                        animate = True
                 if e.key == pygame.K_r:
                     # Reset board when 'r' is pressed
                     gs = ChessEngine.GameState()
-                    validMoves = gs.getValidMoves()
+                    gs.moveCache = moveCache
+                    ChessAI.newGame()
+                    moveIndex = gs.getMoveIndex()
+                    validMoves = list(moveIndex.moves)
                     sq_selected = ()
                     player_clicks = []
                     moveMade = False
@@ -133,58 +185,88 @@ def main():
         if moveMade:
             if animate:
                 animateMove(gs.moveLog[-1], screen, gs.board, clock)
-            validMoves = gs.getValidMoves()
+            moveIndex = gs.getMoveIndex()
+            validMoves = list(moveIndex.moves)
             moveMade = False
             animate = False
-        drawGameState(screen, gs, validMoves, sq_selected)
+        dirtyRects = drawGameState(screen, gs, moveIndex, sq_selected)
 
+        text = None
         if gs.checkmate:
             gameOver = True
             if gs.whiteToMove:
-                drawText(screen, "Black wins by checkmate")
+                text = "Black wins by checkmate"
             else:
-                drawText(screen, "WHite wins by checkmate")
+                text = "WHite wins by checkmate"
         elif gs.stalemate:
             gameOver = True
-            drawText(screen, "Stalemate")
+            text = "Stalemate"
+        # Repainted squares may have erased part of the text, so draw it again
+        if text is not None and (dirtyRects or lastFrame.get("text") != text):
+            dirtyRects.append(drawText(screen, text))
+        if text is None and lastFrame.get("text") is not None:
+            invalidateFrame()  # Text removed by undo or reset, repaint everything next frame
+        else:
+            lastFrame["text"] = text
 
         clock.tick(MAX_FPS)
-        pygame.display.flip()
+        # Only push the changed parts of the screen to the display
+        pygame.display.update(dirtyRects)
 
 
-def highlightSquares(screen, gs, validMoves, sqSelected):
+def highlightSquares(gs, moveIndex, sqSelected):
     """
-    Highlights square selected and shows possible moves
+    Highlights square selected and shows possible moves.
+    Returns a dict of (row, col) -> name of the highlight surface.
     """
+    highlights = {}
     if sqSelected != ():
         row, col = sqSelected
         if gs.board[row][col][0] == ('w' if gs.whiteToMove else 'b'):
             # Highlight Selected Square
-            s = pygame.Surface((SQ_SIZE, SQ_SIZE))
-            s.set_alpha(100)
-            s.fill(pygame.Color('blue'))
-            screen.blit(s, (col * SQ_SIZE, row * SQ_SIZE))
+            highlights[(row, col)] = "selected"
 
             # Highlight Moves from that square
-            s.fill(pygame.Color('yellow'))
-            for move in validMoves:
-                if move.startRow == row and move.startCol == col:
-                    screen.blit(
-                        s,
-                        (
-                            move.endCol * SQ_SIZE,
-                            move.endRow * SQ_SIZE
-                        )
-                    )
+            for move in moveIndex.movesFrom((row, col)):
+                highlights[(move.endRow, move.endCol)] = "move"
+    return highlights
+
+
+def drawGameState(screen, gs, moveIndex, sqSelected):
+    """
+    Responsible for graphics within current game state.
+    Only squares whose piece or highlight changed since the last frame are
+    drawn. Returns the list of rects that were repainted.
+    """
+    highlights = highlightSquares(gs, moveIndex, sqSelected)
+    dirtyRects = []
+    for row in range(DIMENSION):
+        for col in range(DIMENSION):
+            square = (gs.board[row][col], highlights.get((row, col)))
+            if lastFrame.get((row, col)) != square:
+                lastFrame[(row, col)] = square
+                dirtyRects.append(drawSquare(screen, row, col, *square))
+    return dirtyRects
 
 
-def drawGameState(screen, gs, validMoves, sqSelected):
+def drawSquare(screen, row, col, piece, highlight=None):
     """
-    Responsible for graphics within current game state
+    Repaint a single square: background, highlight then piece
     """
-    drawBoard(screen)  # Draw square on the board
-    highlightSquares(screen, gs, validMoves, sqSelected)
-    drawPieces(screen, gs.board)  # draw pieces on top of squares
+    rect = pygame.Rect(col * SQ_SIZE, row * SQ_SIZE, SQ_SIZE, SQ_SIZE)
+    screen.blit(BOARD_SURFACE, rect, rect)
+    if highlight is not None:
+        screen.blit(HIGHLIGHTS[highlight], rect)
+    if piece != "--":
+        screen.blit(IMAGES[piece], rect)
+    return rect
+
+
+def invalidateFrame():
+    """
+    Forget what is on screen so the next frame repaints every square
+    """
+    lastFrame.clear()
 
 
 def drawBoard(screen):
@@ -192,22 +274,7 @@ def drawBoard(screen):
     Draw the squares on the board.
     Top Left Square is always light.
     """
-    global colors
-    colors = [pygame.Color("white"), pygame.Color("gray")]
-
-    for row in range(DIMENSION):
-        for col in range(DIMENSION):
-            color = colors[(row + col) % 2]
-            pygame.draw.rect(
-                screen,
-                color,
-                pygame.Rect(
-                    col * SQ_SIZE,
-                    row * SQ_SIZE,
-                    SQ_SIZE,
-                    SQ_SIZE
-                )
-            )
+    screen.blit(BOARD_SURFACE, (0, 0))
 
 
 def drawPieces(screen, board):
@@ -232,57 +299,75 @@ def drawPieces(screen, board):
 
 def animateMove(move, screen, board, clock):
     """
-    Animate a move
+    Animate a move.
+    The board without the moving piece is drawn once, then every frame only
+    the square the piece left and the square it moved to are repainted.
     """
-    global colors
-    coords = []  # List of coordinates that the animation will move
     dR = move.endRow - move.startRow
     dC = move.endCol - move.startCol
     framesPerSquare = 10  # Frames to move one square
     frameCount = (abs(dR) + abs(dC)) * framesPerSquare
-    for frame in range(frameCount + 1):
 
+    drawBoard(screen)
+    drawPieces(screen, board)
+    # erase piece moved from its ending square
+    endSquare = pygame.Rect(
+        move.endCol * SQ_SIZE,
+        move.endRow * SQ_SIZE,
+        SQ_SIZE, SQ_SIZE
+    )
+    screen.blit(BOARD_SURFACE, endSquare, endSquare)
+    # Draw Captured Piece on rectangle
+    if move.pieceCaptured != "--":
+        screen.blit(IMAGES[move.pieceCaptured], endSquare)
+    background = screen.copy()
+    pygame.display.flip()
+
+    lastRect = None
+    for frame in range(frameCount + 1):
         row, col = (
             move.startRow + dR * frame / frameCount,
             move.startCol + dC * frame / frameCount
         )
-        drawBoard(screen)
-        drawPieces(screen, board)
-        # erase piece moved from its ending square
-        color = colors[(move.endRow + move.endCol) % 2]
-        endSquare = pygame.Rect(
-            move.endCol * SQ_SIZE,
-            move.endRow * SQ_SIZE,
-            SQ_SIZE, SQ_SIZE
-        )
-        pygame.draw.rect(screen, color, endSquare)
-        # Draw Captured Piece on rectangle
-        if move.pieceCaptured != "--":
-            screen.blit(IMAGES[move.pieceCaptured], endSquare)
+        rect = pygame.Rect(col * SQ_SIZE, row * SQ_SIZE, SQ_SIZE, SQ_SIZE)
+        dirtyRects = [rect]
+        if lastRect is not None:
+            screen.blit(background, lastRect, lastRect)
+            dirtyRects.append(lastRect)
         # Draw moving piece
-        screen.blit(
-            IMAGES[move.pieceMoved],
-            pygame.Rect(
-                col * SQ_SIZE,
-                row * SQ_SIZE,
-                SQ_SIZE,
-                SQ_SIZE
-            )
-        )
-        pygame.display.flip()
+        screen.blit(IMAGES[move.pieceMoved], rect)
+        pygame.display.update(dirtyRects)
+        lastRect = rect
         clock.tick(60)
 
+    invalidateFrame()
+
 
 def drawText(screen, text):
-    font = pygame.font.SysFont("Helvetica", 32, True, False)
-    text_object = font.render(text, 0, pygame.Color("gray"))
+    """
+    Draw text in the middle of the screen with a shadow.
+    The font and the rendered text are created once and reused.
+    Returns the rect that was drawn on.
+    """
+    global FONT
+    if text not in TEXTS:
+        if FONT is None:
+            FONT = pygame.font.SysFont("Helvetica", 32, True, False)
+        TEXTS[text] = (
+            FONT.render(text, 0, pygame.Color("gray")),
+            FONT.render(text, 0, pygame.Color("black"))
+        )
+    text_object, shadow_object = TEXTS[text]
     text_location = pygame.Rect(0, 0, WIDTH, HEIGHT).move(
         WIDTH / 2 - text_object.get_width() // 2,
         HEIGHT / 2 - text_object.get_height() // 2
     )
     screen.blit(text_object, text_location)
-    text_object = font.render(text, 0, pygame.Color("black"))
-    screen.blit(text_object, text_location.move(2, 2))
+    screen.blit(shadow_object, text_location.move(2, 2))
+    return pygame.Rect(
+        text_location.x, text_location.y,
+        text_object.get_width() + 2, text_object.get_height() + 2
+    )
 
 
 if __name__ == "__main__":
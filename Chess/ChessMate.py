@@ -0,0 +1,237 @@
+"""
+Mate solver using depth-first proof-number search (df-pn).
+Instead of searching every move to the mate depth like the alpha-beta
+search, it keeps for every position a proof number (how many more leaf
+positions have to be mated to prove the mate) and a disproof number (how
+many to show there is none), and always expands the position that is
+cheapest to decide. Forced lines with few defences are solved far deeper
+than a full width search can reach.
+    python ChessMate.py "FEN" --moves 5
+Mates are looked for in 1, 2, ... up to the given number of moves, so the
+one found is the shortest. With --checks only checking moves are tried
+for the attacker, which is much faster for puzzles where every move checks.
+"""
+import argparse
+import gc
+import time
+import ChessEngine
+
+
+INF = 10 ** 9  # Proof or disproof number of a decided position
+MAX_NODES = 2000000
+MAX_ENTRIES = 2000000  # Proof number table entries kept
+MAX_EXPANSIONS = 100000  # Positions whose moves and child keys are kept
+# Threshold growth of the best child (the 1 + epsilon trick): it is searched until it is this much worse than the
+# second best, not just worse, so the search switches between siblings less often
+EPSILON = 0.25
+# Starting proof number of a quiet attacker move (df-pn+): mates mostly start with checks, so quiet moves are only
+# tried once the checks look harder than this
+QUIET_PROOF = 2
+
+# Results of MateSolver.solve
+MATE = "mate"
+NO_MATE = "no mate"
+UNKNOWN = "unknown"  # Out of nodes
+
+
+class MateSolver():
+    """
+    Solves mates for the side to move of gs. The table maps (zobristKey, plies
+    left) to (phi, delta): the proof and disproof numbers seen from the side to
+    move, so phi is the proof number where the attacker moves and the disproof
+    number where the defender moves. phi == 0 means the side to move wins.
+    """
+
+    def __init__(self, gs, maxNodes=MAX_NODES, maxEntries=MAX_ENTRIES, checksOnly=False):
+        self.gs = gs
+        self.maxNodes = maxNodes
+        self.maxEntries = maxEntries
+        self.checksOnly = checksOnly
+        self.table = {}
+        self.expansions = {}  # zobristKey -> (moveIDs, child zobrist keys, number of checks first in the list, inCheck)
+        self.nodes = 0
+
+    def solve(self, maxMoves):
+        """
+        Returns (result, moves, line): result is MATE, NO_MATE or UNKNOWN, moves
+        the length of the shortest mate in moves (0 if there is none) and line
+        its moves, attacker moves first
+        """
+        # Positions are revisited all the time, so their legal moves are looked up instead of generated
+        moveCache = self.gs.moveCache
+        if moveCache is None:
+            self.gs.moveCache = ChessEngine.MoveCache()
+        # The tables hold millions of tuples that the cyclic garbage collector would scan again and again,
+        # and the search makes no reference cycles
+        gcEnabled = gc.isenabled()
+        gc.disable()
+        try:
+            for moves in range(1, maxMoves + 1):
+                plies = 2 * moves - 1
+                phi, delta = self.search(plies, INF, INF)
+                if phi == 0:
+                    return MATE, moves, self.principalVariation(plies)
+                if self.nodes >= self.maxNodes:
+                    return UNKNOWN, 0, []
+            return NO_MATE, 0, []
+        finally:
+            self.gs.moveCache = moveCache
+            if gcEnabled:
+                gc.enable()
+
+    # ======================================================== Search ==================================================================
+
+    def search(self, plies, thresholdPhi, thresholdDelta):
+        # Expand the current position until its phi or delta reaches the threshold. Returns (phi, delta)
+        gs = self.gs
+        self.nodes += 1
+        key = (gs.zobristKey, plies)
+        attacker = plies % 2 == 1  # The attacker moves on odd plies left
+
+        moveIDs, childKeys, numChecks, inCheck = self.expand(attacker)
+        if attacker and self.checksOnly:
+            moveIDs, childKeys = moveIDs[:numChecks], childKeys[:numChecks]
+        if len(moveIDs) == 0:
+            if inCheck or attacker:  # Mated, or the attacker is stalemated or has no check
+                self.store(key, INF, 0)
+            else:  # Defender stalemated
+                self.store(key, 0, INF)
+            return self.table[key]
+        if plies == 0:  # Attacker is out of moves and the defender isn't mated
+            self.store(key, 0, INF)
+            return self.table[key]
+        childKeys = [(childKey, plies - 1) for childKey in childKeys]
+        # (phi, delta) of children not searched yet
+        initial = [(1, 1 if i < numChecks or not attacker else QUIET_PROOF) for i in range(len(childKeys))]
+
+        while True:
+            # phi is the smallest delta of a child, delta the sum of the children's phi
+            delta = 0
+            best = -1
+            bestDelta = secondDelta = INF
+            bestPhi = 0
+            for i, childKey in enumerate(childKeys):
+                childPhi, childDelta = self.table.get(childKey, initial[i])
+                delta = min(delta + childPhi, INF)
+                if childDelta < bestDelta:
+                    secondDelta = bestDelta
+                    best, bestDelta, bestPhi = i, childDelta, childPhi
+                elif childDelta < secondDelta:
+                    secondDelta = childDelta
+            phi = bestDelta
+
+            if phi >= thresholdPhi or delta >= thresholdDelta or self.nodes >= self.maxNodes:
+                self.store(key, phi, delta)
+                return phi, delta
+
+            # Thresholds of the best child: stop when it is clearly not the best any more or the parent
+            # would reach its threshold
+            childThresholdPhi = min(thresholdDelta - delta + bestPhi, INF)
+            childThresholdDelta = min(thresholdPhi, int(secondDelta * (1 + EPSILON)) + 1)
+            move = [move for move in gs.getValidMoves() if move.moveID == moveIDs[best]][0]
+            gs.makeMove(move)
+            self.search(plies - 1, childThresholdPhi, childThresholdDelta)
+            gs.undoMove()
+
+    def expand(self, attacker):
+        # (moveIDs, child zobrist keys, number of checks, inCheck) of the current position. Attacker moves that
+        # give check come first, so ties between children go to them
+        gs = self.gs
+        entry = self.expansions.get(gs.zobristKey)
+        if entry is not None:
+            return entry
+
+        checks = []
+        others = []
+        moves = gs.getValidMoves()
+        for move in moves:
+            (checks if attacker and gs.givesCheck(move) else others).append((move.moveID, gs.zobristKeyAfter(move)))
+        moves = checks + others
+        entry = (tuple(moveID for moveID, childKey in moves), tuple(childKey for moveID, childKey in moves),
+                 len(checks), gs.inCheck)
+        if len(self.expansions) >= MAX_EXPANSIONS:
+            self.expansions.clear()
+        self.expansions[gs.zobristKey] = entry
+        return entry
+
+    def store(self, key, phi, delta):
+        if len(self.table) >= self.maxEntries:
+            # Keep decided positions, forget the numbers of undecided ones
+            self.table = {k: v for k, v in self.table.items() if v[0] == 0 or v[1] == 0}
+            if len(self.table) >= self.maxEntries // 2:
+                self.table.clear()
+        self.table[key] = (phi, delta)
+
+    # ======================================================== Mating Line =============================================================
+
+    def principalVariation(self, plies):
+        # Follow the proof: the attacker plays the quickest mate, the defender the slowest
+        gs = self.gs
+        line = []
+        while plies > 0:
+            moves = gs.getValidMoves()
+            attacker = plies % 2 == 1
+            bestMove = None
+            bestPlies = None
+            for move in moves:
+                gs.makeMove(move)
+                matePlies = self.provenIn(plies - 1, not attacker)
+                gs.undoMove()
+                if matePlies is None:
+                    continue
+                if bestMove is None or (matePlies < bestPlies if attacker else matePlies > bestPlies):
+                    bestMove, bestPlies = move, matePlies
+            if bestMove is None:
+                break
+            line.append(bestMove)
+            gs.makeMove(bestMove)
+            plies = bestPlies
+        for i in range(len(line)):
+            gs.undoMove()
+        return line
+
+    def provenIn(self, plies, exact):
+        # Fewest plies left (same parity, at most plies) at which the current position is proven a mate for
+        # the attacker, None if it isn't. The proof only decided some of the shorter ones, so this is just a
+        # bound, unless exact: then the undecided ones are searched now. The defender needs that to find the
+        # longest defence, for the attacker any proven mate is quick enough
+        key = self.gs.zobristKey
+        for p in range(plies % 2, plies + 1, 2):
+            entry = self.table.get((key, p))
+            if exact and (entry is None or (entry[0] != 0 and entry[1] != 0)):
+                self.search(p, INF, INF)
+                entry = self.table[(key, p)]
+            # Attacker to move on odd plies left: proven if phi is 0, else if delta is
+            if entry is not None and entry[0 if p % 2 == 1 else 1] == 0:
+                return p
+        return None
+
+
+def findMate(gs, maxMoves, maxNodes=MAX_NODES, maxEntries=MAX_ENTRIES, checksOnly=False):
+    """
+    Shortest forced mate for the side to move in at most maxMoves moves.
+    Returns (result, moves, line, nodes) with result MATE, NO_MATE or UNKNOWN,
+    see MateSolver.solve
+    """
+    solver = MateSolver(gs, maxNodes, maxEntries, checksOnly)
+    result, moves, line = solver.solve(maxMoves)
+    return result, moves, line, solver.nodes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find forced mates with proof-number search")
+    parser.add_argument("fen", nargs="+")
+    parser.add_argument("--moves", type=int, default=5, help="Longest mate looked for, in moves")
+    parser.add_argument("--nodes", type=int, default=MAX_NODES, help="Node budget per position")
+    parser.add_argument("--entries", type=int, default=MAX_ENTRIES, help="Proof number table size")
+    parser.add_argument("--checks", action="store_true", help="Only try checking moves for the attacker")
+    args = parser.parse_args()
+
+    for fen in args.fen:
+        startTime = time.perf_counter()
+        result, moves, line, nodes = findMate(ChessEngine.fromFEN(fen), args.moves, args.nodes, args.entries,
+                                              args.checks)
+        if result == MATE:
+            result = "mate in %d" % moves
+        print("%s: %s %s (%d nodes, %.2fs)" % (fen, result, " ".join(move.getChessNotation() for move in line),
+                                             nodes, time.perf_counter() - startTime))
@@ -0,0 +1,216 @@
+"""
+Small NNUE style evaluation.
+Inputs are the 768 (piece, square) features of the position, seen from both
+sides: for black the colours are swapped and the board mirrored. The first
+layer's output for each side (the accumulator) is kept in the GameState and
+updated in makeMove / undoMove by adding and subtracting the weight rows of
+the few features a move changes. The other layers are small and run for
+every evaluation:
+    clip([accumulator[us], accumulator[them]]) -> HIDDEN2 -> clip -> score
+The network scores in pawns for the side to move, Accumulator.evaluate
+turns that around for black like scoreBoard.
+Weights are float32 in a binary file that is memory-mapped, not read:
+    header "CNUE", version, hidden size, hidden2 size (little endian uint32)
+    W1 (768 x hidden), b1, W2 (2 * hidden x hidden2), b2, W3 (hidden2), b3
+Use it for a game with attach(gs, network); ChessAI.scoreBoard then uses it.
+"""
+import argparse
+import mmap
+import struct
+import numpy as np
+import ChessEngine
+
+
+NETWORK_MAGIC = b"CNUE"
+networkHeader = struct.Struct("<4sIII")  # magic, version, hidden, hidden2
+HIDDEN = 128
+HIDDEN2 = 32
+NUM_INPUTS = 12 * 64
+
+pieceOrder = [color + piece for color in ("w", "b") for piece in ("p", "N", "B", "R", "Q", "K")]
+pieceIndex = {piece: i for i, piece in enumerate(pieceOrder)}
+
+
+def featurePair(piece, r, c):
+    """
+    Input index of a piece on (r, c) for white's and for black's accumulator
+    """
+    index = pieceIndex[piece]
+    return [index * 64 + r * 8 + c, (index + 6) % 12 * 64 + (7 - r) * 8 + c]
+
+
+# (piece, row, col) -> [white feature, black feature]
+features = {(piece, r, c): featurePair(piece, r, c) for piece in pieceOrder for r in range(8) for c in range(8)}
+
+
+class Network():
+    """
+    Weights of a network file. The arrays are views on the memory map, so
+    loading is instant and processes using the same file share the memory.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.hidden, self.hidden2 = networkHeader.unpack_from(self.map, 0)
+        if magic != NETWORK_MAGIC or version != 1:
+            self.close()
+            raise ValueError("Not a network file: " + path)
+
+        offset = networkHeader.size
+        arrays = []
+        for shape in self.shapes(self.hidden, self.hidden2):
+            count = int(np.prod(shape))
+            arrays.append(np.frombuffer(self.map, dtype="<f4", count=count, offset=offset).reshape(shape))
+            offset += count * 4
+        self.w1, self.b1, self.w2, self.b2, self.w3, self.b3 = arrays
+
+    @staticmethod
+    def shapes(hidden, hidden2):
+        return [(NUM_INPUTS, hidden), (hidden,), (2 * hidden, hidden2), (hidden2,), (hidden2,), (1,)]
+
+    def close(self):
+        # Arrays of this network can't be used afterwards
+        self.w1 = self.b1 = self.w2 = self.b2 = self.w3 = self.b3 = None
+        self.map.close()
+        self.file.close()
+
+
+class Accumulator():
+    """
+    First layer output of both sides for every position of the game since it
+    was attached (or since GameState.seek), the last one is the current
+    position. Set as GameState.accumulator.
+    """
+
+    def __init__(self, network, gs):
+        self.network = network
+        self.gs = gs
+        self.stack = [self.compute(gs)]
+
+    def compute(self, gs):
+        # From scratch: row 0 from white's side, row 1 from black's
+        accumulator = np.tile(self.network.b1, (2, 1))
+        for piece, squares in gs.pieceLocations.items():
+            for r, c in squares:
+                accumulator += self.network.w1[features[(piece, r, c)]]
+        return accumulator
+
+    def makeMove(self, move):
+        # Called by GameState.makeMove: only the features the move changes are updated
+        accumulator = self.stack[-1].copy()
+        w1 = self.network.w1
+        accumulator -= w1[features[(move.pieceMoved, move.startRow, move.startCol)]]
+        piece = move.pieceMoved[0] + 'Q' if move.isPawnPromotion else move.pieceMoved
+        accumulator += w1[features[(piece, move.endRow, move.endCol)]]
+
+        if move.pieceCaptured != '--':
+            if move.enPassant:  # The captured pawn is beside the starting square
+                accumulator -= w1[features[(move.pieceCaptured, move.startRow, move.endCol)]]
+            else:
+                accumulator -= w1[features[(move.pieceCaptured, move.endRow, move.endCol)]]
+
+        if move.isCastleMove:
+            rook = move.pieceMoved[0] + 'R'
+            if move.endCol - move.startCol == 2:  # Kingside castle move
+                fromCol, toCol = move.endCol + 1, move.endCol - 1
+            else:  # Queenside castle move
+                fromCol, toCol = move.endCol - 2, move.endCol + 1
+            accumulator -= w1[features[(rook, move.endRow, fromCol)]]
+            accumulator += w1[features[(rook, move.endRow, toCol)]]
+        self.stack.append(accumulator)
+
+    def undoMove(self):
+        # Called by GameState.undoMove once the board is back. Before the first position there is
+        # nothing to go back to, it is computed from scratch
+        if len(self.stack) > 1:
+            self.stack.pop()
+        else:
+            self.stack[0] = self.compute(self.gs)
+
+    def evaluate(self, whiteToMove):
+        """
+        Score of the current position in pawns, positive good for white
+        """
+        network = self.network
+        accumulator = self.stack[-1]
+        us, them = (accumulator[0], accumulator[1]) if whiteToMove else (accumulator[1], accumulator[0])
+        hidden = np.clip(np.concatenate((us, them)), 0, 1)
+        hidden2 = np.clip(hidden @ network.w2 + network.b2, 0, 1)
+        score = float(hidden2 @ network.w3 + network.b3[0])
+        return score if whiteToMove else -score
+
+
+def evaluateBatch(network, positions):
+    """
+    Scores of a list of GameStates in pawns, positive good for white, all at
+    once: the accumulators are summed from scratch with one gather and the
+    other layers run as matrix products over the whole batch
+    """
+    if not positions:
+        return []
+    indices = [[], []]
+    starts = []
+    sides = []
+    for gs in positions:
+        starts.append(len(indices[0]))
+        sides.append(gs.whiteToMove)
+        for piece, squares in gs.pieceLocations.items():
+            for r, c in squares:
+                white, black = features[(piece, r, c)]
+                indices[0].append(white)
+                indices[1].append(black)
+
+    # Every position has its two kings, so no segment is empty
+    white = np.add.reduceat(network.w1[indices[0]], starts) + network.b1
+    black = np.add.reduceat(network.w1[indices[1]], starts) + network.b1
+    whiteToMove = np.array(sides)[:, None]
+    us = np.where(whiteToMove, white, black)
+    them = np.where(whiteToMove, black, white)
+    hidden = np.clip(np.concatenate((us, them), axis=1), 0, 1)
+    hidden2 = np.clip(hidden @ network.w2 + network.b2, 0, 1)
+    scores = hidden2 @ network.w3 + network.b3[0]
+    return [float(score) if side else -float(score) for score, side in zip(scores, sides)]
+
+
+def attach(gs, network):
+    """
+    Evaluate gs with network from now on (until its next setPosition)
+    """
+    gs.accumulator = Accumulator(network, gs)
+    return gs.accumulator
+
+
+def writeNetwork(path, arrays):
+    """
+    Write the arrays [W1, b1, W2, b2, W3, b3] as a network file
+    """
+    hidden, hidden2 = arrays[2].shape[0] // 2, arrays[2].shape[1]
+    with open(path, "wb") as f:
+        f.write(networkHeader.pack(NETWORK_MAGIC, 1, hidden, hidden2))
+        for array, shape in zip(arrays, Network.shapes(hidden, hidden2)):
+            f.write(np.asarray(array, dtype="<f4").reshape(shape).tobytes())
+
+
+def randomNetwork(hidden=HIDDEN, hidden2=HIDDEN2, seed=0):
+    """
+    Untrained weights, for testing and as a starting point for training
+    """
+    rng = np.random.default_rng(seed)
+    return [rng.normal(0, 0.05, shape).astype(np.float32) for shape in Network.shapes(hidden, hidden2)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create or try out an NNUE network file")
+    parser.add_argument("network", help="Network file")
+    parser.add_argument("--init", action="store_true", help="Write an untrained network to the file")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--fen", help="Print the evaluation of this position")
+    args = parser.parse_args()
+
+    if args.init:
+        writeNetwork(args.network, randomNetwork(seed=args.seed))
+    if args.fen:
+        gs = ChessEngine.fromFEN(args.fen)
+        network = Network(args.network)
+        print("%.3f" % attach(gs, network).evaluate(gs.whiteToMove))
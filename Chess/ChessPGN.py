@@ -0,0 +1,271 @@
+"""
+Streaming PGN reader and an on-disk position index.
+Games are read one at a time so any size of PGN database can be replayed
+through GameState with bounded memory. The index maps a position's zobrist
+key to the moves played from it and their results, and is memory-mapped so
+lookups don't load it into RAM.
+"""
+import mmap
+import os
+import re
+import struct
+import ChessEngine
+
+
+RESULTS = ("1-0", "0-1", "1/2-1/2", "*")
+
+headerPattern = re.compile(r'\[(\w+)\s+"(.*)"\]')
+tokenPattern = re.compile(r'\{|\}|\(|\)|;|[^\s{}();]+')
+moveNumberPattern = re.compile(r'^\d+\.+')
+
+
+def readGames(path):
+    """
+    Yields (headers, sanMoves, result) for every game in the PGN file.
+    Comments, variations, NAGs and move numbers are skipped.
+    """
+    with open(path, encoding="utf-8", errors="replace") as f:
+        headers = {}
+        moves = []
+        commentDepth = 0
+        variationDepth = 0
+        for line in f:
+            if commentDepth == 0 and line.startswith("["):
+                if moves:  # Header of the next game when the last one had no result
+                    yield headers, moves, headers.get("Result", "*")
+                    headers, moves = {}, []
+                match = headerPattern.match(line)
+                if match:
+                    headers[match.group(1)] = match.group(2)
+                continue
+            if line.startswith("%"):  # Escaped line
+                continue
+
+            for token in tokenPattern.findall(line):
+                if commentDepth:
+                    if token == "}":
+                        commentDepth = 0
+                    continue
+                if token == "{":
+                    commentDepth = 1
+                elif token == ";":  # Comment till the end of the line
+                    break
+                elif token == "(":
+                    variationDepth += 1
+                elif token == ")":
+                    variationDepth = max(variationDepth - 1, 0)
+                elif variationDepth or token.startswith("$"):
+                    continue
+                elif token in RESULTS:
+                    yield headers, moves, token
+                    headers, moves = {}, []
+                else:
+                    san = moveNumberPattern.sub("", token)
+                    if san:
+                        moves.append(san)
+
+        if moves:
+            yield headers, moves, headers.get("Result", "*")
+
+
+def parseSAN(gs, san, validMoves):
+    """
+    Find the move in validMoves written as san (standard algebraic notation).
+    Raises ValueError if there isn't exactly one such move.
+    """
+    text = san.rstrip("+#!?")
+    if text in ("O-O", "0-0", "O-O-O", "0-0-0"):
+        direction = 2 if len(text) == 3 else -2
+        for move in validMoves:
+            if move.isCastleMove and move.endCol - move.startCol == direction:
+                return move
+        raise ValueError("Illegal castle move: " + san)
+
+    promotion = None
+    if "=" in text:
+        text, promotion = text.split("=")
+    elif text[-1] in "NBRQ" and text[0].islower():
+        text, promotion = text[:-1], text[-1]
+    if promotion is not None and promotion != "Q":
+        # GameState always promotes to a queen
+        raise ValueError("Under promotion is not supported: " + san)
+
+    piece = text[0] if text[0] in "NBRQK" else "p"
+    if piece != "p":
+        text = text[1:]
+    text = text.replace("x", "").replace("-", "")
+    if len(text) < 2 or text[-2] not in ChessEngine.Move.filesToCols or text[-1] not in ChessEngine.Move.ranksToRows:
+        raise ValueError("Can't parse move: " + san)
+    endRow = ChessEngine.Move.ranksToRows[text[-1]]
+    endCol = ChessEngine.Move.filesToCols[text[-2]]
+
+    candidates = []
+    for move in validMoves:
+        if move.pieceMoved[1] == piece and move.endRow == endRow and move.endCol == endCol and not move.isCastleMove:
+            candidates.append(move)
+    # Disambiguation by file and/or rank of the moving piece
+    for ch in text[:-2]:
+        if ch in ChessEngine.Move.filesToCols:
+            candidates = [m for m in candidates if m.startCol == ChessEngine.Move.filesToCols[ch]]
+        elif ch in ChessEngine.Move.ranksToRows:
+            candidates = [m for m in candidates if m.startRow == ChessEngine.Move.ranksToRows[ch]]
+
+    if len(candidates) != 1:
+        raise ValueError(("Illegal" if not candidates else "Ambiguous") + " move: " + san)
+    return candidates[0]
+
+
+def replayGame(headers, sanMoves):
+    """
+    Yields (gs, move) for every move of the game, before the move is made.
+    Starts from the FEN header if there is one.
+    """
+    if "FEN" in headers:
+        gs = ChessEngine.fromFEN(headers["FEN"])
+    else:
+        gs = ChessEngine.GameState()
+    for san in sanMoves:
+        move = parseSAN(gs, san, gs.getValidMoves())
+        yield gs, move
+        gs.makeMove(move)
+
+
+# ======================================================== Position Index ===============================================================
+# File layout: header, then a hash table of fixed size entries using linear probing.
+# Every entry is one (position, move) pair with its result counts. All moves of a
+# position are on the probe sequence starting at key % capacity, so a lookup stops
+# at the first empty slot. Key 0 marks an empty slot.
+
+INDEX_MAGIC = b"CHIX"
+indexHeader = struct.Struct("<4sIQQ")  # magic, version, capacity, count
+indexEntry = struct.Struct("<QHxxIII")  # key, moveID, white wins, draws, black wins
+MAX_LOAD = 0.7
+
+
+class PositionIndex():
+    """
+    Memory-mapped map of zobrist key -> moves played with result counts.
+    Grows by rebuilding into a file twice as large when it gets too full.
+    """
+
+    def __init__(self, path, capacity=1 << 16, readOnly=False):
+        self.path = path
+        self.readOnly = readOnly
+        if not os.path.exists(path):
+            if readOnly:
+                raise FileNotFoundError(path)
+            createIndexFile(path, capacity)
+        self.open()
+
+    def open(self):
+        self.file = open(self.path, "rb" if self.readOnly else "r+b")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ if self.readOnly else mmap.ACCESS_WRITE)
+        magic, version, self.capacity, self.count = indexHeader.unpack_from(self.map, 0)
+        if magic != INDEX_MAGIC or version != 1:
+            self.close()
+            raise ValueError("Not a position index: " + self.path)
+
+    def close(self):
+        if not self.readOnly:
+            indexHeader.pack_into(self.map, 0, INDEX_MAGIC, 1, self.capacity, self.count)
+        self.map.close()
+        self.file.close()
+
+    def add(self, key, moveID, result):
+        """
+        Count result ("1-0", "1/2-1/2" or "0-1") for moveID played in the position with key
+        """
+        counts = (int(result == "1-0"), int(result == "1/2-1/2"), int(result == "0-1"))
+        self.addCounts(key, moveID, counts)
+
+    def addCounts(self, key, moveID, counts):
+        key = key or 1  # 0 marks empty slots
+        if (self.count + 1) > self.capacity * MAX_LOAD:
+            self.grow()
+        slot = key % self.capacity
+        while True:
+            offset = indexHeader.size + slot * indexEntry.size
+            entryKey, entryMove, white, draw, black = indexEntry.unpack_from(self.map, offset)
+            if entryKey == 0:
+                indexEntry.pack_into(self.map, offset, key, moveID, *counts)
+                self.count += 1
+                return
+            if entryKey == key and entryMove == moveID:
+                indexEntry.pack_into(self.map, offset, key, moveID,
+                                     white + counts[0], draw + counts[1], black + counts[2])
+                return
+            slot = (slot + 1) % self.capacity
+
+    def lookup(self, key):
+        """
+        Returns [(moveID, whiteWins, draws, blackWins)] for the position with key, most played first.
+        An empty list means the position was never seen.
+        """
+        key = key or 1
+        found = []
+        slot = key % self.capacity
+        while True:
+            entryKey, entryMove, white, draw, black = indexEntry.unpack_from(
+                self.map, indexHeader.size + slot * indexEntry.size)
+            if entryKey == 0:
+                break
+            if entryKey == key:
+                found.append((entryMove, white, draw, black))
+            slot = (slot + 1) % self.capacity
+        found.sort(key=lambda entry: entry[1] + entry[2] + entry[3], reverse=True)
+        return found
+
+    def entries(self):
+        for slot in range(self.capacity):
+            entry = indexEntry.unpack_from(self.map, indexHeader.size + slot * indexEntry.size)
+            if entry[0] != 0:
+                yield entry
+
+    def grow(self):
+        oldPath = self.path + ".old"
+        self.close()
+        os.replace(self.path, oldPath)
+        old = PositionIndex(oldPath, readOnly=True)
+        createIndexFile(self.path, old.capacity * 2)
+        self.open()
+        for key, moveID, white, draw, black in old.entries():
+            self.addCounts(key, moveID, (white, draw, black))
+        old.close()
+        os.remove(oldPath)
+
+
+def createIndexFile(path, capacity):
+    with open(path, "wb") as f:
+        f.write(indexHeader.pack(INDEX_MAGIC, 1, capacity, 0))
+        f.truncate(indexHeader.size + capacity * indexEntry.size)
+
+
+def buildIndex(pgnPath, indexPath):
+    """
+    Replay every game of the PGN file and add its positions to the index.
+    Games with an unknown result are skipped, as is the rest of a game after
+    a move that can't be read. Returns (games indexed, games with errors).
+    """
+    index = PositionIndex(indexPath)
+    games = errors = 0
+    try:
+        for headers, sanMoves, result in readGames(pgnPath):
+            if result == "*":
+                continue
+            try:
+                for gs, move in replayGame(headers, sanMoves):
+                    index.add(gs.zobristKey, move.moveID, result)
+            except ValueError:
+                errors += 1
+            games += 1
+    finally:
+        index.close()
+    return games, errors
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) != 3:
+        print("usage: python ChessPGN.py games.pgn games.idx")
+    else:
+        print("%d games indexed, %d with errors" % buildIndex(sys.argv[1], sys.argv[2]))
@@ -0,0 +1,148 @@
+"""
+Profiling harness for the engine.
+Runs a reproducible workload (the bench positions or a self-play game at a
+fixed depth) and writes:
+    PREFIX.txt        self time, cumulative time, calls and calls per node
+    PREFIX.pstats     the raw cProfile data
+    PREFIX.collapsed  collapsed stacks for flamegraph tools
+        python ChessProfile.py --workload bench --depth 2 --output prof
+Also used by ChessBench when it is run with --profile or with the
+CHESS_PROFILE environment variable set to an output prefix. Nothing is
+instrumented unless one of these is used.
+"""
+import argparse
+import cProfile
+import pstats
+import sys
+import time
+import ChessAI
+import ChessEngine
+
+
+SELF_PLAY_PLIES = 12
+TOP_FUNCTIONS = 25
+
+# Hot paths that are always listed in the report
+HOT_PATHS = ["getValidMoves", "checkForPinsAndChecks", "squareUnderAttack",
+             "makeMove", "undoMove", "scoreBoard"]
+
+
+def benchWorkload(depth):
+    """
+    Search every bench position. Returns the number of nodes searched
+    """
+    import ChessBench
+    nodes = 0
+    for name, fen in ChessBench.BENCH_POSITIONS:
+        nodes += ChessBench.search(fen, depth)[1]
+    return nodes
+
+
+def selfPlayWorkload(depth, plies=SELF_PLAY_PLIES):
+    """
+    Play a game from the start position. Returns the number of nodes searched
+    """
+    ChessAI.pawnHashTable.clear()
+    ChessAI.newGame()
+    gs = ChessEngine.GameState()
+    nodes = 0
+    for ply in range(plies):
+        validMoves = gs.getValidMoves()
+        if len(validMoves) == 0:
+            break
+        move = ChessAI.findBestMovesMultiPV(gs, validMoves, 1, depth)[0][0]
+        nodes += ChessAI.counter
+        gs.makeMove(move)
+    return nodes
+
+
+WORKLOADS = {"bench": benchWorkload, "selfplay": selfPlayWorkload}
+
+
+class StackProfiler():
+    """
+    Records the self time of every call stack, in microseconds, with sys.setprofile.
+    Time spent in C functions counts for the Python function calling them.
+    """
+
+    def __init__(self):
+        self.stack = []
+        self.times = {}  # "a;b;c" -> microseconds
+        self.lastTime = 0
+
+    def trace(self, frame, event, arg):
+        if event != "call" and event != "return":
+            return
+        now = time.perf_counter()
+        if self.stack:
+            key = ";".join(self.stack)
+            self.times[key] = self.times.get(key, 0) + (now - self.lastTime) * 1e6
+        if event == "call":
+            code = frame.f_code
+            self.stack.append("%s:%s" % (code.co_filename.rsplit("/", 1)[-1], code.co_name))
+        elif self.stack:
+            self.stack.pop()
+        self.lastTime = time.perf_counter()
+
+    def run(self, function, *args):
+        self.lastTime = time.perf_counter()
+        sys.setprofile(self.trace)
+        try:
+            return function(*args)
+        finally:
+            sys.setprofile(None)
+
+    def write(self, path):
+        with open(path, "w") as f:
+            for stack, micros in sorted(self.times.items()):
+                if micros >= 1:
+                    f.write("%s %d\n" % (stack, micros))
+
+
+def profile(function, args, prefix):
+    """
+    Run function(*args) under cProfile, then again to collect the call stacks.
+    function returns the number of nodes searched. Returns its result.
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        nodes = function(*args)
+    finally:
+        profiler.disable()
+    profiler.dump_stats(prefix + ".pstats")
+    writeReport(pstats.Stats(profiler), nodes, prefix + ".txt")
+
+    stackProfiler = StackProfiler()
+    stackProfiler.run(function, *args)
+    stackProfiler.write(prefix + ".collapsed")
+    return nodes
+
+
+def writeReport(stats, nodes, path):
+    rows = []
+    for (filename, line, name), (primitiveCalls, calls, selfTime, cumulativeTime, callers) in stats.stats.items():
+        rows.append((selfTime, cumulativeTime, calls, "%s:%d(%s)" % (filename.rsplit("/", 1)[-1], line, name), name))
+    rows.sort(reverse=True)
+    hot = [row for row in rows if row[4] in HOT_PATHS]
+    top = [row for row in rows[:TOP_FUNCTIONS] if row not in hot]
+
+    nodes = max(nodes, 1)
+    with open(path, "w") as f:
+        f.write("%d nodes, %.3fs total\n\n" % (nodes, stats.total_tt))
+        f.write("%10s %10s %12s %12s  %s\n" % ("self s", "cum s", "calls", "calls/node", "function"))
+        for title, section in (("Hot paths", hot), ("Top by self time", top)):
+            f.write("\n%s\n" % title)
+            for selfTime, cumulativeTime, calls, location, name in section:
+                f.write("%10.3f %10.3f %12d %12.2f  %s\n" % (selfTime, cumulativeTime, calls, calls / nodes, location))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Profile the engine on a fixed workload")
+    parser.add_argument("--workload", choices=sorted(WORKLOADS), default="bench")
+    parser.add_argument("--depth", type=int, default=2)
+    parser.add_argument("--output", default="profile", help="Prefix of the output files")
+    args = parser.parse_args()
+    profile(WORKLOADS[args.workload], (args.depth,), args.output)
+    with open(args.output + ".txt") as f:
+        print(f.read())
@@ -0,0 +1,247 @@
+"""
+Self-play games for training data, without the UI.
+Worker processes play games with the ChessAI search from varied openings
+(a FEN from a file and/or some random first moves) and send back one
+record per position: the position, the search score, the best move and
+the result of the game. The main process appends them to shard files and
+never holds more than the games in flight, so memory stays the same for
+any number of games.
+Record (RECORD_BYTES, little endian):
+    position   34 bytes of GameState.toBytes
+    score      float32, pawns, positive good for white (like scoreBoard)
+    bestMove   uint16 Move.moveID
+    result     int8, 1 white won, 0 draw, -1 black won
+The files are shard-00000.bin, shard-00001.bin, ... in the output
+directory. loadShard reads one as a NumPy record array.
+Every FLUSH_GAMES games the shard is flushed to disk and checkpoint.json
+records which games are done. Running the same command again continues
+from the checkpoint: records written after it are cut off and those games
+are played again.
+    python ChessSelfPlay.py data --games 10000 --workers 4
+"""
+import argparse
+import json
+import os
+import random
+import struct
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import numpy as np
+import ChessAI
+import ChessEngine
+
+
+recordStruct = struct.Struct("<%dsfHb" % ChessEngine.POSITION_BYTES)
+RECORD_BYTES = recordStruct.size
+recordType = np.dtype([("position", "S%d" % ChessEngine.POSITION_BYTES), ("score", "<f4"),
+                       ("bestMove", "<u2"), ("result", "i1")])
+
+SEARCH_DEPTH = 2
+RANDOM_PLIES = 8  # Random first moves of every game, so no two games are the same
+MAX_PLIES = 300  # Longer games are draws
+SHARD_RECORDS = 1000000
+FLUSH_GAMES = 50
+CHECKPOINT_FILE = "checkpoint.json"
+
+
+def readOpenings(path):
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+
+def playGame(index, seed, depth=SEARCH_DEPTH, randomPlies=RANDOM_PLIES, openings=None, maxPlies=MAX_PLIES):
+    """
+    Plays game number index. The opening only depends on seed and index, so
+    the game can be played again after a restart. Returns (index, records)
+    """
+    rng = random.Random(seed * 1000003 + index)
+    gs = ChessEngine.fromFEN(openings[index % len(openings)]) if openings else ChessEngine.GameState()
+    gs.moveCache = ChessEngine.MoveCache()
+    ChessAI.newGame()
+
+    for i in range(randomPlies):
+        moves = gs.getValidMoves()
+        if len(moves) == 0:
+            break
+        gs.makeMove(rng.choice(moves))
+
+    positions = []  # (position, score, moveID)
+    result = 0
+    seen = {}
+    while len(positions) < maxPlies:
+        moves = gs.getValidMoves()
+        if len(moves) == 0:
+            if gs.checkmate:
+                result = -1 if gs.whiteToMove else 1
+            break
+        seen[gs.zobristKey] = seen.get(gs.zobristKey, 0) + 1
+        if seen[gs.zobristKey] >= 3:  # Threefold repetition
+            break
+        move, score, pv = ChessAI.findBestMovesMultiPV(gs, moves, 1, depth)[0]
+        positions.append((gs.toBytes(), score if gs.whiteToMove else -score, move.moveID))
+        gs.makeMove(move)
+
+    records = b"".join(recordStruct.pack(position, score, moveID, result) for position, score, moveID in positions)
+    return index, records
+
+
+def loadShard(path):
+    """
+    Records of a shard file as a NumPy record array (fields as in recordType)
+    """
+    return np.fromfile(path, dtype=recordType)
+
+
+class ShardWriter():
+    """
+    Appends records to numbered shard files, a new one every maxRecords records
+    """
+
+    def __init__(self, directory, maxRecords=SHARD_RECORDS, shard=0, records=0):
+        self.directory = directory
+        self.maxRecords = maxRecords
+        self.shard = shard
+        self.records = records  # Records in the current shard
+        # Cut off whatever was written after the checkpoint this continues from
+        with open(self.path(shard), "ab") as f:
+            f.truncate(records * RECORD_BYTES)
+        later = shard + 1
+        while os.path.exists(self.path(later)):
+            os.remove(self.path(later))
+            later += 1
+        self.file = open(self.path(shard), "ab")
+
+    def path(self, shard):
+        return os.path.join(self.directory, "shard-%05d.bin" % shard)
+
+    def write(self, data):
+        while data:
+            count = min(len(data) // RECORD_BYTES, self.maxRecords - self.records)
+            self.file.write(data[:count * RECORD_BYTES])
+            self.records += count
+            data = data[count * RECORD_BYTES:]
+            if self.records == self.maxRecords:
+                self.file.close()
+                self.shard += 1
+                self.records = 0
+                self.file = open(self.path(self.shard), "wb")
+
+    def flush(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class Checkpoint():
+    """
+    Games done and the end of the written data, saved in checkpoint.json.
+    Games finish out of order, so the done games are all games below
+    nextGame plus the ones in done.
+    """
+
+    def __init__(self, directory, settings):
+        self.path = os.path.join(directory, CHECKPOINT_FILE)
+        self.settings = settings
+        self.nextGame = 0
+        self.done = set()
+        self.shard = 0
+        self.records = 0
+        self.totalRecords = 0
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                data = json.load(f)
+            if data["settings"] != settings:
+                raise ValueError("%s was written with other settings: %s" % (self.path, data["settings"]))
+            self.nextGame = data["nextGame"]
+            self.done = set(data["done"])
+            self.shard = data["shard"]
+            self.records = data["records"]
+            self.totalRecords = data["totalRecords"]
+
+    def isDone(self, index):
+        return index < self.nextGame or index in self.done
+
+    def gameDone(self, index):
+        self.done.add(index)
+        while self.nextGame in self.done:
+            self.done.remove(self.nextGame)
+            self.nextGame += 1
+
+    def save(self, writer):
+        self.shard = writer.shard
+        self.records = writer.records
+        data = {"settings": self.settings, "nextGame": self.nextGame, "done": sorted(self.done),
+                "shard": self.shard, "records": self.records, "totalRecords": self.totalRecords}
+        # Written next to it and renamed, so a crash never leaves half a checkpoint
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(data, f)
+        os.replace(self.path + ".tmp", self.path)
+
+
+def generate(directory, games, workers=2, seed=0, depth=SEARCH_DEPTH, randomPlies=RANDOM_PLIES, openings=None,
+             maxPlies=MAX_PLIES, shardRecords=SHARD_RECORDS, flushGames=FLUSH_GAMES, log=print):
+    """
+    Plays games 0 .. games - 1 that aren't in the checkpoint of directory yet and writes their records
+    """
+    os.makedirs(directory, exist_ok=True)
+    settings = {"seed": seed, "depth": depth, "randomPlies": randomPlies, "openings": openings,
+                "maxPlies": maxPlies, "shardRecords": shardRecords}
+    checkpoint = Checkpoint(directory, settings)
+    writer = ShardWriter(directory, shardRecords, checkpoint.shard, checkpoint.records)
+    openingFENs = readOpenings(openings) if openings else None
+    todo = (index for index in range(games) if not checkpoint.isDone(index))
+    startTime = time.perf_counter()
+    finished = 0
+
+    try:
+        with ProcessPoolExecutor(workers) as pool:
+            pending = set()
+            while True:
+                # Only a few games per worker in flight, the others are submitted as these finish
+                for index in todo:
+                    pending.add(pool.submit(playGame, index, seed, depth, randomPlies, openingFENs, maxPlies))
+                    if len(pending) >= 2 * workers:
+                        break
+                if not pending:
+                    break
+                completed, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in completed:
+                    index, records = future.result()
+                    writer.write(records)
+                    checkpoint.totalRecords += len(records) // RECORD_BYTES
+                    checkpoint.gameDone(index)
+                    finished += 1
+                    if finished % flushGames == 0:
+                        writer.flush()
+                        checkpoint.save(writer)
+                        if log is not None:
+                            log("%d games, %d positions, %.1fs" % (finished, checkpoint.totalRecords,
+                                                                   time.perf_counter() - startTime))
+    finally:
+        writer.flush()
+        checkpoint.save(writer)
+        writer.close()
+    return checkpoint.totalRecords
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate training data from self-play games")
+    parser.add_argument("output", help="Directory for the shards and the checkpoint")
+    parser.add_argument("--games", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--depth", type=int, default=SEARCH_DEPTH, help="Search depth per move")
+    parser.add_argument("--random-plies", type=int, default=RANDOM_PLIES, help="Random first moves of every game")
+    parser.add_argument("--openings", help="File with a starting FEN per line, used in turn")
+    parser.add_argument("--max-plies", type=int, default=MAX_PLIES)
+    parser.add_argument("--shard-records", type=int, default=SHARD_RECORDS)
+    parser.add_argument("--flush-games", type=int, default=FLUSH_GAMES)
+    args = parser.parse_args()
+
+    total = generate(args.output, args.games, args.workers, args.seed, args.depth, args.random_plies,
+                     args.openings and os.path.abspath(args.openings), args.max_plies, args.shard_records,
+                     args.flush_games)
+    print("%d positions in %s" % (total, args.output))
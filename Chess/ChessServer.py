@@ -0,0 +1,211 @@
+"""
+Local analysis server.
+Speaks newline delimited JSON over TCP on localhost. Every request is one line:
+    {"id": 1, "fen": "...", "depth": 3, "multipv": 1, "timeout": 10}
+and gets one line back with the same id:
+    {"id": 1, "moves": [{"move": "e2e4", "score": 0.2, "pv": ["e2e4", ...]}]}
+or {"id": 1, "error": "..."}.
+Searches run in a pool of worker processes that import the engine once.
+Identical requests in flight share one search and finished results are kept
+in an LRU cache keyed by position, depth and multipv.
+A search stops when the last request waiting for it times out: every search
+in flight has a deadline in shared memory that the worker checks while it
+searches, and requests joining it move the deadline later.
+"""
+import argparse
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import ChessAI
+import ChessEngine
+
+
+HOST = "127.0.0.1"
+PORT = 8765
+WORKERS = 2
+MAX_PENDING = 64  # Searches queued or running before new requests are refused
+CACHE_SIZE = 4096  # Finished results kept
+MAX_DEPTH = 6
+DEFAULT_TIMEOUT = 30  # Seconds
+
+
+deadlineMemory = None  # Worker side of AnalysisServer.deadlineMemory
+deadlines = None
+
+
+def attachDeadlines(name):
+    """
+    Worker initializer
+    """
+    global deadlineMemory, deadlines
+    deadlineMemory = shared_memory.SharedMemory(name=name)
+    deadlines = deadlineMemory.buf.cast("d")
+
+
+def analyse(fen, depth, numPV, slot):
+    """
+    Runs in a worker process. Stops at the time in deadlines[slot].
+    Returns (moves, depth of the last finished iteration)
+    """
+    # Every request starts from an empty transposition table, so its result doesn't depend on the ones before
+    ChessAI.newGame()
+    gs = ChessEngine.fromFEN(fen)
+    validMoves = gs.getValidMoves()
+    if len(validMoves) == 0:
+        return [], depth
+    ChessAI.stopFlag = lambda: time.time() >= deadlines[slot]
+    try:
+        results = ChessAI.findBestMovesMultiPV(gs, validMoves, numPV, depth)
+    finally:
+        ChessAI.stopFlag = None
+    finishedDepth = ChessAI.depthTimes[-1][0] if ChessAI.depthTimes else 0
+    return [
+        {
+            "move": move.getChessNotation(),
+            "score": score,
+            "pv": [pvMove.getChessNotation() for pvMove in pv]
+        }
+        for move, score, pv in results
+    ], finishedDepth
+
+
+class AnalysisServer():
+
+    def __init__(self, workers=WORKERS, maxPending=MAX_PENDING, cacheSize=CACHE_SIZE):
+        self.workers = workers
+        # Deadline (time.time) of every search in flight, one slot each
+        self.deadlineMemory = shared_memory.SharedMemory(create=True, size=8 * maxPending)
+        self.deadlines = self.deadlineMemory.buf.cast("d")
+        self.freeSlots = list(range(maxPending))
+        self.pool = ProcessPoolExecutor(max_workers=workers, initializer=attachDeadlines,
+                                        initargs=(self.deadlineMemory.name,))
+        self.maxPending = maxPending
+        self.cacheSize = cacheSize
+        self.cache = OrderedDict()  # (zobristKey, depth, numPV) -> result
+        self.inFlight = {}  # (zobristKey, depth, numPV) -> (asyncio.Future, deadline slot)
+        self.hits = 0
+        self.misses = 0
+
+    async def start(self, host=HOST, port=PORT):
+        # Start every worker now so the first requests don't pay for it
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[
+            loop.run_in_executor(self.pool, ChessEngine.GameState)
+            for i in range(self.workers)
+        ])
+        return await asyncio.start_server(self.handleClient, host, port)
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        self.deadlines.release()
+        self.deadlineMemory.close()
+        self.deadlineMemory.unlink()
+
+    async def handleClient(self, reader, writer):
+        lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                task = asyncio.create_task(self.handleRequest(line, writer, lock))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            # A request failing must not lose the replies to the others
+            await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            writer.close()
+
+    async def handleRequest(self, line, writer, lock):
+        requestId = None
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("request must be a JSON object")
+            requestId = request.get("id")
+            reply = {"moves": await self.search(request)}
+        except asyncio.TimeoutError:
+            reply = {"error": "timeout"}
+        except (ValueError, KeyError, TypeError) as e:
+            reply = {"error": str(e)}
+        except BusyError:
+            reply = {"error": "busy"}
+        except Exception as e:  # Anything else from the engine or a worker, the client still gets a reply
+            reply = {"error": "%s: %s" % (type(e).__name__, e)}
+        reply["id"] = requestId
+        async with lock:
+            writer.write((json.dumps(reply) + "\n").encode())
+            await writer.drain()
+
+    async def search(self, request):
+        depth = int(request.get("depth", ChessAI.DEPTH))
+        numPV = int(request.get("multipv", 1))
+        timeout = float(request.get("timeout", DEFAULT_TIMEOUT))
+        if not 1 <= depth <= MAX_DEPTH or numPV < 1:
+            raise ValueError("depth must be 1 to %d and multipv at least 1" % MAX_DEPTH)
+        gs = ChessEngine.fromFEN(request["fen"])
+        fen = gs.getFEN()
+        key = (gs.zobristKey, depth, numPV)
+
+        if key in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        self.misses += 1
+
+        deadline = time.time() + timeout
+        entry = self.inFlight.get(key)
+        if entry is None:
+            if len(self.inFlight) >= self.maxPending:
+                raise BusyError()
+            slot = self.freeSlots.pop()
+            self.deadlines[slot] = deadline
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self.pool, analyse, fen, depth, numPV, slot)
+            self.inFlight[key] = (future, slot)
+            future.add_done_callback(lambda f: self.finished(key, f))
+        else:
+            # The search goes on until the last request waiting for it gives up
+            future, slot = entry
+            self.deadlines[slot] = max(self.deadlines[slot], deadline)
+        # A request timing out must not cancel the search other requests wait for
+        moves, finishedDepth = await asyncio.wait_for(asyncio.shield(future), timeout)
+        if finishedDepth < depth:  # Stopped at the deadline
+            raise asyncio.TimeoutError()
+        return moves
+
+    def finished(self, key, future):
+        self.freeSlots.append(self.inFlight.pop(key)[1])
+        # Searches stopped before their depth aren't kept
+        if not future.cancelled() and future.exception() is None and future.result()[1] >= key[1]:
+            self.cache[key] = future.result()[0]
+            if len(self.cache) > self.cacheSize:
+                self.cache.popitem(last=False)
+
+
+class BusyError(Exception):
+    pass
+
+
+async def serve(host, port, workers):
+    analysisServer = AnalysisServer(workers)
+    server = await analysisServer.start(host, port)
+    print("Analysis server on %s:%d with %d workers" % (host, port, workers))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        analysisServer.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local chess analysis server")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    args = parser.parse_args()
+    asyncio.run(serve(args.host, args.port, args.workers))
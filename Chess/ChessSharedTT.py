@@ -0,0 +1,179 @@
+"""
+Transposition table in shared memory, so searches in several processes
+share what they find (Lazy SMP).
+Every entry is two 64-bit words: the packed data, and the zobrist key XOR the
+data. Writes aren't locked. If two processes write the same entry at once
+the words may come from different writes, then the key check fails and the
+entry is just a miss.
+Packed data: moveID (16 bits) | depth (8) | flag (2) | age (6) | score (32,
+in thousandths of a pawn). The age is bumped for every new search so entries
+from old searches are replaced first.
+The header also holds a stop flag: ParallelSearcher sets it when the
+main worker is done, and the other workers then stop their search.
+"""
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import shared_memory
+import ChessAI
+import ChessEngine
+
+
+TT_SIZE_MB = 16
+ENTRY_BYTES = 16
+HEADER_WORDS = 2  # Word 0 holds the current age, word 1 the stop flag
+MASK64 = (1 << 64) - 1
+
+
+class SharedTranspositionTable():
+    """
+    Same methods as ChessAI.TranspositionTable. Create it in the main process
+    and pass it (or its name) to the workers, which attach to the same memory.
+    """
+
+    def __init__(self, sizeMB=TT_SIZE_MB, name=None):
+        if name is None:
+            size = HEADER_WORDS * 8 + sizeMB * 1024 * 1024 // ENTRY_BYTES * ENTRY_BYTES
+            self.memory = shared_memory.SharedMemory(create=True, size=size)
+            self.owner = True
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.words = self.memory.buf.cast("Q")
+        self.numEntries = (len(self.words) - HEADER_WORDS) // 2
+        if self.owner:
+            self.words[0] = 0
+
+    def __reduce__(self):
+        # Workers attach to the same memory instead of getting a copy
+        return SharedTranspositionTable, (0, self.memory.name)
+
+    def get(self, key):
+        index = HEADER_WORDS + (key % self.numEntries) * 2
+        data = self.words[index]
+        if self.words[index + 1] ^ data != key:
+            return None
+        moveID = data & 0xFFFF
+        return (
+            (data >> 16) & 0xFF,
+            ((data >> 32) - (1 << 31)) / 1000,
+            (data >> 24) & 3,
+            moveID if moveID else None
+        )
+
+    def store(self, key, depth, score, flag, moveID):
+        index = HEADER_WORDS + (key % self.numEntries) * 2
+        age = self.words[0]
+        data = self.words[index]
+        if data and self.words[index + 1] ^ data != key and (data >> 26) & 63 == age \
+                and (data >> 16) & 0xFF > depth:
+            return  # Keep a deeper entry of another position from this search
+        data = (moveID or 0) | min(depth, 255) << 16 | flag << 24 | age << 26 | \
+            (round(score * 1000) + (1 << 31)) << 32
+        self.words[index] = data
+        self.words[index + 1] = (key ^ data) & MASK64
+
+    def newSearch(self):
+        # Only the process that created the table ages it, so workers starting
+        # their part of the same search don't
+        if self.owner:
+            self.words[0] = (self.words[0] + 1) & 63
+            self.words[1] = 0
+
+    def stop(self):
+        self.words[1] = 1
+
+    def stopped(self):
+        return self.words[1] != 0
+
+    def clear(self):
+        self.memory.buf[:] = bytes(len(self.memory.buf))
+
+    def close(self):
+        self.words.release()
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+def attachWorker(name):
+    """
+    Worker initializer: use the shared table for every search in this process,
+    and stop searching when its stop flag is set
+    """
+    # Attached by name: a forked worker would otherwise get a copy of the owner, which ages the table
+    table = SharedTranspositionTable(name=name)
+    ChessAI.transpositionTable = table
+    ChessAI.stopFlag = table.stopped
+
+
+def searchWorker(data, numPV, depth):
+    gs = ChessEngine.fromBytes(data)
+    results = ChessAI.findBestMovesMultiPV(gs, gs.getValidMoves(), numPV, depth)
+    # A stopped worker returns its last finished iteration
+    finishedDepth = ChessAI.depthTimes[-1][0] if ChessAI.depthTimes else 0
+    return ([(move.moveID, score, [pvMove.moveID for pvMove in pv]) for move, score, pv in results], ChessAI.counter,
+            finishedDepth)
+
+
+class ParallelSearcher():
+    """
+    Lazy SMP: every worker searches the same position with a shared
+    transposition table, half of them one ply deeper so they fill the table
+    ahead of the others. The worker processes and the table are kept between
+    searches, so later searches start at once and find the entries of the
+    earlier ones. close() releases them.
+    """
+
+    def __init__(self, workers=2, sizeMB=TT_SIZE_MB):
+        self.workers = workers
+        self.table = SharedTranspositionTable(sizeMB)
+        self.pool = ProcessPoolExecutor(workers, initializer=attachWorker, initargs=(self.table.memory.name,))
+        self.running = []  # Futures of the last search, stopped helpers may not have returned yet
+
+    def search(self, gs, numPV=1, depth=ChessAI.DEPTH):
+        """
+        As soon as the first full depth worker is done the others are stopped,
+        without waiting for them. Returns the result of the deepest search
+        finished by then (as findBestMovesMultiPV does) and the nodes searched
+        by the workers that have returned.
+        """
+        # Stopped helpers return within a few nodes, and must be gone before the stop flag is cleared
+        wait(self.running)
+        self.table.newSearch()
+        data = gs.toBytes()
+        self.running = [self.pool.submit(searchWorker, data, numPV, depth + i % 2) for i in range(self.workers)]
+        # The first worker done has searched to full depth, a deeper helper may be the one
+        wait(self.running, return_when=FIRST_COMPLETED)
+        self.table.stop()
+        # Workers that happen to be done too count, the others stop on their own
+        finished = [future.result() for future in self.running if future.done()]
+        results, nodes, finishedDepth = max(finished, key=lambda result: result[2])
+        nodes = sum(result[1] for result in finished)
+
+        validMoves = {move.moveID: move for move in gs.getValidMoves()}
+        bestMoves = []
+        for moveID, score, pvIDs in results:
+            pv = []
+            for pvID in pvIDs:
+                move = [m for m in gs.getValidMoves() if m.moveID == pvID][0]
+                pv.append(move)
+                gs.makeMove(move)
+            for i in range(len(pv)):
+                gs.undoMove()
+            bestMoves.append((validMoves[moveID], score, pv))
+        return bestMoves, nodes
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        self.table.close()
+
+
+def findBestMovesParallel(gs, numPV=1, depth=ChessAI.DEPTH, workers=2, sizeMB=TT_SIZE_MB):
+    """
+    One search with a ParallelSearcher of its own. Use a ParallelSearcher
+    directly to search several positions.
+    """
+    searcher = ParallelSearcher(workers, sizeMB)
+    try:
+        return searcher.search(gs, numPV, depth)
+    finally:
+        searcher.close()
@@ -0,0 +1,210 @@
+"""
+Texel tuning of the evaluation weights.
+Reads labelled positions (a FEN and the result of the game it is from) one
+at a time, turns each into the feature counts scoreBoard uses (material and
+pawn structure, white minus black) and keeps them in one NumPy array. The
+weights are then fitted by gradient descent on the logistic loss between
+sigmoid(K * eval) and the results, all positions at once.
+    python ChessTune.py positions.epd --output weights.json
+    python ChessTune.py --pgn games.pgn --output weights.json
+A position line is a FEN followed by the result anywhere after it: 1-0,
+0-1, 1/2-1/2 (optionally quoted, as in c9 "1-0";) or a number from 0 to 1,
+all from white's point of view. ChessAI loads the written file at startup.
+"""
+import argparse
+import json
+import re
+import time
+import numpy as np
+import ChessAI
+import ChessEngine
+import ChessPGN
+
+
+FEATURES = ["p", "N", "B", "R", "Q", "doubled", "isolated"] + ["passed%d" % i for i in range(len(ChessAI.PASSED_PAWN_BONUS))]
+featureIndex = {name: i for i, name in enumerate(FEATURES)}
+NUM_FEATURES = len(FEATURES)
+
+CHUNK = 65536  # Positions converted to an array at a time
+EPOCHS = 2000
+LEARNING_RATE = 0.01
+
+resultPattern = re.compile(r'1-0|0-1|1/2-1/2')
+resultValues = {"1-0": 1.0, "0-1": 0.0, "1/2-1/2": 0.5}
+
+
+def readPositions(path):
+    """
+    Yields (fen, result) for every line of a file of labelled positions
+    """
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 4:
+                continue
+            fen = " ".join(fields[:4])
+            rest = fields[4:]
+            if len(rest) >= 2 and rest[0].isdigit() and rest[1].isdigit():
+                rest = rest[2:]  # Halfmove clock and move number
+            match = resultPattern.search(" ".join(rest))
+            if match is not None:
+                yield fen, resultValues[match.group()]
+            elif rest:
+                try:
+                    yield fen, float(rest[-1].strip('[]";'))
+                except ValueError:
+                    continue
+
+
+def readGamePositions(path):
+    """
+    Yields (gs, result) for every position of every finished game of a PGN file
+    """
+    for headers, sanMoves, result in ChessPGN.readGames(path):
+        if result not in resultValues:
+            continue
+        try:
+            for gs, move in ChessPGN.replayGame(headers, sanMoves):
+                yield gs, resultValues[result]
+        except ValueError:
+            continue  # Rest of a game with a move that can't be read
+
+
+def extractFeatures(gs):
+    """
+    Feature counts of the position, white minus black, so that
+    ChessAI.scoreBoard(gs) == features . weightVector() outside of mate
+    """
+    features = [0] * NUM_FEATURES
+    for piece, squares in gs.pieceLocations.items():
+        if piece[1] != "K":
+            features[featureIndex[piece[1]]] += len(squares) if piece[0] == "w" else -len(squares)
+
+    doubled, isolated, passed, whitePassed, blackPassed = ChessAI.countPawnTerms(gs)
+    features[featureIndex["doubled"]] = doubled
+    features[featureIndex["isolated"]] = isolated
+    for i, count in enumerate(passed):
+        features[featureIndex["passed%d" % i]] = count
+    return features
+
+
+def loadFeatures(positions):
+    """
+    positions yields (gs or fen, result). Positions in check are skipped since
+    their score depends on the search more than on the evaluation.
+    Returns (features, results) as float32 arrays
+    """
+    chunks = []
+    resultChunks = []
+    rows = []
+    results = []
+    for position, result in positions:
+        gs = ChessEngine.fromFEN(position) if isinstance(position, str) else position
+        if gs.checkForPinsAndChecks()[0]:
+            continue
+        rows.append(extractFeatures(gs))
+        results.append(result)
+        if len(rows) == CHUNK:
+            chunks.append(np.array(rows, dtype=np.float32))
+            resultChunks.append(np.array(results, dtype=np.float32))
+            rows, results = [], []
+    chunks.append(np.array(rows, dtype=np.float32).reshape(-1, NUM_FEATURES))
+    resultChunks.append(np.array(results, dtype=np.float32))
+    return np.concatenate(chunks), np.concatenate(resultChunks)
+
+
+def weightVector():
+    """
+    Current evaluation weights of ChessAI in feature order
+    """
+    weights = [ChessAI.pieceScore[piece] for piece in ("p", "N", "B", "R", "Q")]
+    weights += [-ChessAI.DOUBLED_PAWN_PENALTY, -ChessAI.ISOLATED_PAWN_PENALTY]
+    weights += ChessAI.PASSED_PAWN_BONUS
+    return np.array(weights, dtype=np.float64)
+
+
+def sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+
+def loss(features, results, weights, scale):
+    """
+    Mean logistic loss of the predicted results sigmoid(scale * eval)
+    """
+    predicted = np.clip(sigmoid(scale * (features @ weights.astype(np.float32))), 1e-7, 1 - 1e-7)
+    return float(-np.mean(results * np.log(predicted) + (1 - results) * np.log(1 - predicted)))
+
+
+def fitScale(features, results, weights):
+    """
+    The scale K that fits the results best with the starting weights, so that
+    only the relative size of the weights is tuned
+    """
+    scales = np.linspace(0.05, 5, 100)
+    best = min(scales, key=lambda scale: loss(features, results, weights, scale))
+    for step in (0.025, 0.005, 0.001):
+        candidates = np.arange(best - 4 * step, best + 4 * step, step)
+        best = min((scale for scale in candidates if scale > 0), key=lambda scale: loss(features, results, weights, scale))
+    return float(best)
+
+
+def tune(features, results, weights, scale, epochs=EPOCHS, rate=LEARNING_RATE, log=None):
+    """
+    Adam gradient descent on the logistic loss over all positions. Returns the weights
+    """
+    weights = weights.copy()
+    first = np.zeros_like(weights)
+    second = np.zeros_like(weights)
+    beta1, beta2 = 0.9, 0.999
+    for epoch in range(1, epochs + 1):
+        # float32 like features, so they are never copied to float64
+        predicted = sigmoid(scale * (features @ weights.astype(np.float32)))
+        gradient = scale * (features.T @ (predicted - results)).astype(np.float64) / len(results)
+        first = beta1 * first + (1 - beta1) * gradient
+        second = beta2 * second + (1 - beta2) * gradient * gradient
+        weights -= rate * (first / (1 - beta1 ** epoch)) / (np.sqrt(second / (1 - beta2 ** epoch)) + 1e-8)
+        if log is not None and (epoch % 100 == 0 or epoch == epochs):
+            log(epoch, loss(features, results, weights, scale))
+    return weights
+
+
+def writeWeights(path, weights, scale, positions, finalLoss):
+    values = [round(float(w), 4) for w in weights]
+    data = {
+        "pieceScore": dict(zip(("p", "N", "B", "R", "Q"), values[:5]), K=0),
+        "doubledPawnPenalty": -values[featureIndex["doubled"]],
+        "isolatedPawnPenalty": -values[featureIndex["isolated"]],
+        "passedPawnBonus": values[featureIndex["passed0"]:],
+        "scale": scale,
+        "positions": positions,
+        "loss": finalLoss,
+    }
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tune the evaluation weights on labelled positions")
+    parser.add_argument("positions", nargs="?", help="File with a FEN and a result on every line")
+    parser.add_argument("--pgn", help="Use every position of the games in this PGN file instead")
+    parser.add_argument("--output", default=ChessAI.WEIGHTS_FILE)
+    parser.add_argument("--epochs", type=int, default=EPOCHS)
+    parser.add_argument("--rate", type=float, default=LEARNING_RATE)
+    args = parser.parse_args()
+    if not args.positions and not args.pgn:
+        parser.error("give a positions file or --pgn")
+
+    startTime = time.perf_counter()
+    features, results = loadFeatures(readGamePositions(args.pgn) if args.pgn else readPositions(args.positions))
+    print("%d positions in %.1fs" % (len(results), time.perf_counter() - startTime))
+    if len(results) == 0:
+        raise SystemExit("no positions")
+
+    weights = weightVector()
+    scale = fitScale(features, results, weights)
+    print("K = %.3f, loss %.5f" % (scale, loss(features, results, weights, scale)))
+    weights = tune(features, results, weights, scale, args.epochs, args.rate,
+                   lambda epoch, value: print("epoch %d loss %.5f" % (epoch, value)))
+    finalLoss = loss(features, results, weights, scale)
+    writeWeights(args.output, weights, scale, len(results), finalLoss)
+    print("Weights written to %s" % args.output)
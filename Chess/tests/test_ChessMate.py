@@ -0,0 +1,64 @@
+import ChessEngine
+import ChessMate
+
+
+def forcedMate(gs, moves):
+    # True if the side to move mates in at most moves, found by trying every move
+    for move in gs.getValidMoves():
+        gs.makeMove(move)
+        replies = gs.getValidMoves()
+        if len(replies) == 0:
+            mate = gs.checkmate
+        elif moves == 1:
+            mate = False
+        else:
+            mate = True
+            for reply in replies:
+                gs.makeMove(reply)
+                escaped = not forcedMate(gs, moves - 1)
+                gs.undoMove()
+                if escaped:
+                    mate = False
+                    break
+        gs.undoMove()
+        if mate:
+            return True
+    return False
+
+
+def shortestMate(fen, maxMoves):
+    gs = ChessEngine.fromFEN(fen)
+    for moves in range(1, maxMoves + 1):
+        if forcedMate(gs, moves):
+            return moves
+    return 0
+
+
+def checkMate(fen, maxMoves):
+    result, moves, line, nodes = ChessMate.findMate(ChessEngine.fromFEN(fen), maxMoves)
+    expected = shortestMate(fen, maxMoves)
+    assert result == (ChessMate.MATE if expected else ChessMate.NO_MATE)
+    assert moves == expected
+    if not expected:
+        return
+    # The line is a whole mate of that length: the defender may not give up sooner
+    assert len(line) == 2 * moves - 1
+    gs = ChessEngine.fromFEN(fen)
+    for move in line:
+        assert move.moveID in [legal.moveID for legal in gs.getValidMoves()]
+        gs.makeMove(move)
+    gs.getValidMoves()
+    assert gs.checkmate
+
+
+def testMateLengthAgainstBruteForce():
+    # Kd5 and Kxc5 both answer Bc5+ with a proven mate, but only Kxc5 lasts until mate in 3
+    checkMate("r1b1kb1r/pppp1ppp/5q2/4n3/3KP3/2N3PN/PPP4P/R1BQ1B1R b kq - 0 1", 3)
+
+
+def testMateInOne():
+    checkMate("6k1/5ppp/8/8/8/8/8/R5K1 w - - 0 1", 2)
+
+
+def testNoMate():
+    checkMate("4k3/8/8/8/8/8/8/4K2R w K - 0 1", 1)
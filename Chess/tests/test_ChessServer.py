@@ -0,0 +1,44 @@
+import asyncio
+import json
+import time
+import ChessServer
+
+
+MIDDLEGAME = "r1bq1rk1/pp2bppp/2n1pn2/2pp4/3P4/2PBPN2/PP1N1PPP/R1BQ1RK1 w - - 0 8"
+START = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+
+
+async def request(port, message):
+    reader, writer = await asyncio.open_connection(ChessServer.HOST, port)
+    writer.write((json.dumps(message) + "\n").encode())
+    await writer.drain()
+    reply = json.loads(await reader.readline())
+    writer.close()
+    return reply
+
+
+async def timedOutSearchFreesWorker():
+    analysisServer = ChessServer.AnalysisServer(workers=1, maxPending=1)
+    server = await analysisServer.start(port=0)
+    port = server.sockets[0].getsockname()[1]
+    try:
+        reply = await request(port, {"id": 1, "fen": MIDDLEGAME, "depth": 6, "timeout": 0.5})
+        assert reply == {"id": 1, "error": "timeout"}
+        # The worker stops at the deadline instead of finishing the depth 6 search
+        startTime = time.time()
+        while analysisServer.inFlight and time.time() - startTime < 2:
+            await asyncio.sleep(0.05)
+        assert analysisServer.inFlight == {}
+        reply = await request(port, {"id": 2, "fen": START, "depth": 1, "timeout": 5})
+        assert reply["id"] == 2 and len(reply["moves"]) == 1
+        assert time.time() - startTime < 5
+        # The stopped search was not cached as a depth 6 result
+        assert len(analysisServer.cache) == 1
+    finally:
+        server.close()
+        await server.wait_closed()
+        analysisServer.close()
+
+
+def test_timedOutSearchFreesWorker():
+    asyncio.run(timedOutSearchFreesWorker())